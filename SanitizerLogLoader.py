@@ -1,16 +1,16 @@
-import pickle
-import sys
+import argparse
+
+import registry_paths
+import sanitizer_report
 
-def read_and_print_data(file_path):
-    try:
-        with open(file_path, 'rb') as file:
-            non_utf8_files = pickle.load(file)
 
+def read_and_print_data(file_path, directory=None, recursive=False, offset=0, limit=None):
+    try:
         file_count = 0
 
-        for record in non_utf8_files:
-            ascii_name = record.get("ASCII Equivalent", "N/A")
-            directory_path = record.get("Directory Path", "N/A")
+        for record in sanitizer_report.read_records(file_path, directory, recursive, offset, limit):
+            ascii_name = record.get("ascii_name", "N/A")
+            directory_path = registry_paths.display_path(record.get("directory_path", "N/A"))
             print(f"ASCII Equivalent: {ascii_name} | Directory Path: {directory_path}")
             file_count += 1
 
@@ -19,14 +19,42 @@ def read_and_print_data(file_path):
     except Exception as e:
         print(f"Error reading file: {e}")
 
+
+def import_into_database(file_path, hostname=None):
+    import registry_database
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        count = sanitizer_report.import_report(cnx, file_path, hostname)
+        print(f"Imported {count} records into non_utf8_files")
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
+
+
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python script_name.py <path_to_pickle_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Page through or import a sanitizer report of non-UTF-8 file names.')
+    parser.add_argument('file_path', type=str, help='path to the report file')
+    parser.add_argument('--directory', type=str, default=None, help='only show files in this directory')
+    parser.add_argument('-r', '--recursive', action='store_true', help='with --directory, include subdirectories')
+    parser.add_argument('--offset', type=int, default=0, help='number of matching records to skip')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of records to show')
+    parser.add_argument('--import', dest='import_db', action='store_true',
+                        help='bulk-import the report into the registry database instead of printing it')
+    parser.add_argument('--host', type=str, default=None,
+                        help='host the report was written on (default: the host recorded in its index)')
+    parser.add_argument('--write', type=str, metavar='DIRECTORY', default=None,
+                        help='scan DIRECTORY and write a new report to file_path')
+    args = parser.parse_args()
+
+    if args.write:
+        count = sanitizer_report.write_report(args.file_path, args.write)
+        print(f"Wrote {count} records to {args.file_path}")
+    elif args.import_db:
+        import_into_database(args.file_path, args.host)
+    else:
+        read_and_print_data(args.file_path, args.directory, args.recursive, args.offset, args.limit)
 
-    file_path = sys.argv[1]
-    read_and_print_data(file_path)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Archive Scanner
+---------------
+Index the members of zip and tar archives without extracting them, so
+duplicate content inside archives can be found like any other file.
+
+Each archive is read once as a stream: tar archives (plain, gz, bz2, xz)
+through tarfile's stream mode, where the archive's own MD5 is computed from
+the same bytes, and zip archives member by member through zipfile. Every
+regular member is hashed block by block; member rows are written in batches
+and the list of members tarfile keeps is cleared as it goes, so memory stays
+flat for archives of any size or member count.
+
+Each archive gets a row in archives before it is read, and its members are
+committed in batches under that row's id; the archive's MD5, the same content
+key the chunk manifests use, is filled in once the last member is stored. An
+archive copied to several places is indexed once and archives already
+indexed are skipped on later scans. Archives nested in archives are hashed as
+members but not opened.
+"""
+
+import argparse
+import hashlib
+import os
+import tarfile
+import time
+import zipfile
+import zlib
+
+import exclusion_rules
+import page_cache
+import registry_database
+import registry_paths
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Bytes per member read
+BLOCK_SIZE = page_cache.BLOCK_SIZE
+
+# Member rows per executemany
+BATCH_SIZE = 1000
+
+# Errors of a damaged or truncated archive; the archive is reported and skipped
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError, OSError, ValueError)
+
+
+def archive_format(file_path):
+    """'zip', 'tar' or None, from the file name."""
+    name = file_path.lower()
+    if name.endswith(ZIP_EXTENSIONS):
+        return "zip"
+    if name.endswith(TAR_EXTENSIONS):
+        return "tar"
+    return None
+
+
+class _HashingReader:
+    """File object over a page_cache.BlockReader that hashes every byte read through it."""
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.hash = hashlib.md5()
+        self.block = b""
+        self.pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.block):
+                self.block = bytes(self.reader.read())
+                self.pos = 0
+                if not self.block:
+                    break
+                self.hash.update(self.block)
+            end = len(self.block) if size < 0 else min(len(self.block), self.pos + size)
+            parts.append(self.block[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b"".join(parts)
+
+    def hexdigest(self):
+        """MD5 of the whole file; reads whatever the archive reader left."""
+        while self.read(BLOCK_SIZE):
+            pass
+        return self.hash.hexdigest()
+
+
+def _hash_stream(f):
+    hash_md5 = hashlib.md5()
+    size = 0
+    for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+        hash_md5.update(block)
+        size += len(block)
+    return hash_md5.digest(), size
+
+
+def _datetime(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def tar_members(file_path, cache_mode="dontneed"):
+    """
+    Yield (member path, md5 digest, size, modification date) of the regular
+    files in a tar archive, in archive order, and return the archive's MD5
+    hex as the generator's value.
+    """
+    with page_cache.BlockReader(file_path, cache_mode) as reader:
+        source = _HashingReader(reader)
+        with tarfile.open(fileobj=source, mode="r|*") as tar:
+            while True:
+                member = tar.next()
+                if member is None:
+                    break
+                # tarfile remembers every member it has seen; only the current one is needed
+                tar.members = []
+                if not member.isfile():
+                    continue
+                md5_digest, size = _hash_stream(tar.extractfile(member))
+                yield member.name, md5_digest, size, _datetime(member.mtime)
+        return source.hexdigest()
+
+
+def zip_members(file_path):
+    """Yield (member path, md5 digest, size, modification date) of the files in a zip archive."""
+    with zipfile.ZipFile(file_path) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            with archive.open(info) as f:
+                md5_digest, size = _hash_stream(f)
+            yield info.filename, md5_digest, size, time.strftime('%Y-%m-%d %H:%M:%S', info.date_time + (0, 0, -1))
+
+
+def file_md5(file_path, cache_mode="dontneed"):
+    hash_md5 = hashlib.md5()
+    with page_cache.BlockReader(file_path, cache_mode) as reader:
+        for block in iter(reader.read, b""):
+            hash_md5.update(block)
+    return hash_md5.hexdigest()
+
+
+def known_md5(cnx, file_path):
+    """The MD5 hex of a file's current version in the registry, if its modification time still matches."""
+    mtime = _datetime(os.path.getmtime(file_path))
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT md5_checksum FROM file_metadata WHERE file_path_hash = %s "
+                       "AND valid_to_scan_id IS NULL AND modification_date = %s",
+                       (registry_paths.path_hash(file_path), mtime))
+        row = cursor.fetchone()
+        return registry_database.bin_to_hex(row[0]) if row else None
+    finally:
+        cursor.close()
+
+
+def is_indexed(cnx, md5_checksum):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM archives WHERE md5_checksum = %s", (registry_database.md5_to_bin(md5_checksum),))
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def _discard(cnx, archive_id):
+    """Delete a partly indexed archive and its members. Commits."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("DELETE FROM archive_members WHERE archive_id = %s", (archive_id,))
+        cursor.execute("DELETE FROM archives WHERE id = %s", (archive_id,))
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def index_archive(cnx, file_path, md5_checksum=None, cache_mode="dontneed"):
+    """
+    Record the members of one archive. md5_checksum is the archive's MD5 if
+    already known; tar archives compute it in the same pass, zip archives
+    need a separate read. Returns (archive md5 hex, members, member bytes), or
+    None if the archive was already indexed. Commits.
+    """
+    kind = archive_format(file_path)
+    if kind == "zip" and md5_checksum is None:
+        md5_checksum = file_md5(file_path, cache_mode)
+    if md5_checksum and is_indexed(cnx, md5_checksum):
+        return None
+
+    count = total = 0
+    rows = []
+    cursor = cnx.cursor()
+    archive_id = None
+    try:
+        # The archive row comes first so member batches can be committed under its id
+        cursor.execute("INSERT INTO archives (archive_format) VALUES (%s)", (kind,))
+        archive_id = cursor.lastrowid
+        cnx.commit()
+
+        def write():
+            cursor.executemany(
+                "INSERT INTO archive_members (archive_id, member_index, member_path, md5_checksum, "
+                "file_size, modification_date) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+            cnx.commit()
+            rows.clear()
+
+        members = tar_members(file_path, cache_mode) if kind == "tar" else zip_members(file_path)
+        while True:
+            try:
+                member_path, md5_digest, size, modification_date = next(members)
+            except StopIteration as done:
+                md5_checksum = md5_checksum or done.value
+                break
+            rows.append((archive_id, count, registry_paths.path_to_db(member_path), md5_digest, size,
+                         modification_date))
+            count += 1
+            total += size
+            if len(rows) >= BATCH_SIZE:
+                write()
+        if rows:
+            write()
+
+        if is_indexed(cnx, md5_checksum):
+            # Another copy was indexed meanwhile
+            _discard(cnx, archive_id)
+            return None
+        cursor.execute("UPDATE archives SET md5_checksum = %s, member_count = %s, member_bytes = %s, "
+                       "indexed = NOW() WHERE id = %s",
+                       (registry_database.md5_to_bin(md5_checksum), count, total, archive_id))
+        cnx.commit()
+        return md5_checksum, count, total
+    except BaseException:
+        cnx.rollback()
+        if archive_id is not None:
+            _discard(cnx, archive_id)
+        raise
+    finally:
+        cursor.close()
+
+
+def scan_archives(cnx, directory_path, rules=None, cache_mode="dontneed", verbose=False):
+    """Index the archives under a directory. Returns (indexed, skipped, failed, members)."""
+    rules = rules or exclusion_rules.load_rules()
+    indexed = skipped = failed = members = 0
+    for root, dirs, files in exclusion_rules.walk(directory_path, rules):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if archive_format(file_path) is None:
+                continue
+            try:
+                md5_checksum = known_md5(cnx, file_path)
+                result = None if md5_checksum and is_indexed(cnx, md5_checksum) else \
+                    index_archive(cnx, file_path, md5_checksum, cache_mode)
+            except ARCHIVE_ERRORS as e:
+                print(f"Cannot index {registry_paths.display_path(file_path)}: {e}")
+                failed += 1
+                continue
+            if result is None:
+                skipped += 1
+                continue
+            indexed += 1
+            members += result[1]
+            if verbose:
+                print(f"{result[0]}  {result[1]} members, {result[2] / 1e6:.1f} MB  "
+                      f"{registry_paths.display_path(file_path)}")
+    return indexed, skipped, failed, members
+
+
+def find_in_archives(cnx, md5_checksum, limit=50):
+    """Yield (member path, archive md5 hex, example archive path) of archive members with a content."""
+    cursor = cnx.cursor(buffered=True)
+    lookup = cnx.cursor()
+    try:
+        # Members of archives still being indexed have no archive MD5 yet
+        cursor.execute("SELECT m.member_path, a.md5_checksum FROM archive_members m "
+                       "JOIN archives a ON a.id = m.archive_id "
+                       "WHERE m.md5_checksum = %s AND a.md5_checksum IS NOT NULL LIMIT %s",
+                       (registry_database.md5_to_bin(md5_checksum), limit))
+        for member_path, archive_md5 in cursor:
+            lookup.execute("SELECT file_path FROM file_metadata WHERE md5_checksum = %s "
+                           "AND valid_to_scan_id IS NULL LIMIT 1", (archive_md5,))
+            row = lookup.fetchone()
+            yield (registry_paths.path_from_db(member_path), registry_database.bin_to_hex(archive_md5),
+                   registry_paths.path_from_db(row[0]) if row else None)
+    finally:
+        lookup.close()
+        cursor.close()
+
+
+def archived_summary(cnx):
+    """Return (indexed archives, members, member bytes, member bytes whose content also exists as a file)."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(member_count), 0), COALESCE(SUM(member_bytes), 0) "
+                       "FROM archives WHERE md5_checksum IS NOT NULL")
+        archives, count, total = cursor.fetchone()
+        cursor.execute(
+            "SELECT COALESCE(SUM(m.file_size), 0) FROM archives a JOIN archive_members m ON m.archive_id = a.id "
+            "WHERE a.md5_checksum IS NOT NULL AND EXISTS "
+            "(SELECT 1 FROM file_metadata f WHERE f.md5_checksum = m.md5_checksum AND f.valid_to_scan_id IS NULL)")
+        outside = cursor.fetchone()[0]
+        return int(archives), int(count), int(total), int(outside)
+    finally:
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the members of zip and tar archives without extracting them.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = subparsers.add_parser('scan', help='index the archives under a directory')
+    scan_parser.add_argument('directory_path', type=str, help='directory to scan')
+    scan_parser.add_argument('--exclusions', type=str, default=None,
+                             help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE})')
+    scan_parser.add_argument('--cache-mode', choices=page_cache.MODES, default='dontneed',
+                             help='page cache use while reading tar archives (default: dontneed)')
+    scan_parser.add_argument('-v', '--verbose', action='store_true', help='print every indexed archive')
+
+    lookup_parser = subparsers.add_parser('lookup', help='list the archives holding a content')
+    lookup_parser.add_argument('target', type=str, help='a file to hash, or an MD5 in hex')
+    lookup_parser.add_argument('--limit', type=int, default=50, help='members to list (default: 50)')
+
+    subparsers.add_parser('summary', help='totals of the indexed archives')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if not cnx or not registry_database.is_connection_valid(cnx):
+        print("Failed to connect to the database or connection timed out.")
+    else:
+        try:
+            if args.command == 'scan':
+                indexed, skipped, failed, members = scan_archives(
+                    cnx, args.directory_path, exclusion_rules.load_rules(args.exclusions), args.cache_mode, args.verbose)
+                print(f"Indexed {indexed} archives with {members} members, "
+                      f"{skipped} already indexed, {failed} could not be read")
+            elif args.command == 'lookup':
+                md5_checksum = file_md5(args.target) if os.path.exists(args.target) else args.target
+                for member_path, archive_md5, archive_path in find_in_archives(cnx, md5_checksum, args.limit):
+                    print(f"{registry_paths.display_path(archive_path) if archive_path else archive_md5}"
+                          f"  ->  {registry_paths.display_path(member_path)}")
+            else:
+                archives, count, total, outside = archived_summary(cnx)
+                print(f"{archives} archives indexed with {count} members, {total / 1e9:.2f} GB uncompressed")
+                print(f"Member content also present as registered files: {outside / 1e9:.2f} GB")
+        finally:
+            cnx.close()
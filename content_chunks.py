@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Content Chunks
+--------------
+Content-defined chunking for finding data shared between files that are not
+exact duplicates (re-saved media, appended logs, project file versions).
+
+A gear rolling hash picks chunk boundaries from the content itself, so an
+insertion only changes the chunks around it and the rest of the file still
+matches. The chunker is fed the same buffers the MD5 is computed from, so
+chunking adds no extra read pass. Chunk digests go into the chunks index and
+each file content gets a manifest in file_chunks, keyed by the file's MD5 so
+identical files share one manifest.
+"""
+
+import argparse
+import hashlib
+
+import registry_database
+import registry_paths
+
+# numpy computes the rolling hash over whole buffers; without it chunking runs
+# byte by byte in Python at a few MB/s
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Chunk size bounds in bytes
+DEFAULT_MIN_SIZE = 16 * 1024
+DEFAULT_AVG_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 256 * 1024
+
+# The gear hash only depends on the last 64 bytes it has seen
+GEAR_WINDOW = 64
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+# Rows per executemany
+BATCH_SIZE = 1000
+
+
+def _gear_table():
+    """256 fixed pseudo-random 64-bit values; derived from MD5 so every host agrees."""
+    return [int.from_bytes(hashlib.md5(bytes([i])).digest()[:8], "big") for i in range(256)]
+
+
+GEAR = _gear_table()
+
+if NUMPY_AVAILABLE:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+
+# Bytes hashed per numpy pass; the intermediate arrays then stay in the CPU cache
+HASH_BLOCK = 32 * 1024
+
+
+def _window_hashes(data):
+    """
+    Gear hash after each byte of data, as a uint64 array. Each value is the
+    sum of gear[b] << k over the last GEAR_WINDOW bytes, built by doubling the
+    window six times instead of rolling byte by byte; the first
+    GEAR_WINDOW - 1 values cover fewer bytes.
+    """
+    hashes = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+    width = 1
+    while width < GEAR_WINDOW:
+        hashes[width:] += hashes[:-width] << numpy.uint64(width)
+        width *= 2
+    return hashes
+
+
+def _candidates(data, first, threshold):
+    """Positions after each byte from index first on where the gear hash is below threshold."""
+    threshold = numpy.uint64(threshold)
+    positions = []
+    for block in range(first, len(data), HASH_BLOCK):
+        context = max(0, block - GEAR_WINDOW + 1)
+        hashes = _window_hashes(data[context:block + HASH_BLOCK])
+        positions.extend((numpy.flatnonzero(hashes[block - context:] < threshold) + block + 1).tolist())
+    return positions
+
+
+class Chunker:
+    """
+    Split a stream into content-defined chunks. Feed it with update() and call
+    finish() at the end; both return the chunks completed so far as
+    (offset, length, md5 digest) tuples.
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, avg_size=DEFAULT_AVG_SIZE, max_size=DEFAULT_MAX_SIZE):
+        if min_size < GEAR_WINDOW or not min_size < avg_size < max_size:
+            raise ValueError(f"chunk sizes must satisfy {GEAR_WINDOW} <= min < avg < max")
+        self.min_size = min_size
+        self.max_size = max_size
+        # A boundary is a hash below the threshold, one in avg_size - min_size
+        # positions past the minimum, so chunks average avg_size
+        self.threshold = (MASK_64 + 1) // (avg_size - min_size)
+        self.buffer = bytearray()
+        self.offset = 0
+        self.scanned = 0
+        self.hash = 0
+
+    def _emit(self, start, end, chunks):
+        with memoryview(self.buffer) as view:
+            chunks.append((self.offset, end - start, hashlib.md5(view[start:end]).digest()))
+        self.offset += end - start
+
+    def update(self, data):
+        self.buffer += data
+        if NUMPY_AVAILABLE:
+            return self._update_vectorized()
+        return self._update_bytewise()
+
+    def _update_vectorized(self):
+        # Hashes depend only on the window, so boundaries can be found for the
+        # whole buffer at once and then picked in order
+        first = max(self.scanned, self.min_size)
+        chunks = []
+        start = 0
+        if first < len(self.buffer):
+            with memoryview(self.buffer) as view:
+                candidates = _candidates(view, first, self.threshold)
+            for cut in candidates:
+                while cut - start > self.max_size:
+                    self._emit(start, start + self.max_size, chunks)
+                    start += self.max_size
+                if cut - start > self.min_size:
+                    self._emit(start, cut, chunks)
+                    start = cut
+        while len(self.buffer) - start >= self.max_size:
+            self._emit(start, start + self.max_size, chunks)
+            start += self.max_size
+        del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        return chunks
+
+    def _update_bytewise(self):
+        chunks = []
+        gear = GEAR
+        threshold = self.threshold
+        while True:
+            end = min(len(self.buffer), self.max_size)
+            # Bytes before the minimum size cannot end a chunk; only the last
+            # GEAR_WINDOW of them influence the hash at the first candidate
+            start = max(self.scanned, self.min_size - GEAR_WINDOW)
+            h = self.hash
+            buffer = self.buffer
+            cut = None
+            # Warm the hash up to the minimum size, then look for a boundary
+            for byte in buffer[start:min(end, self.min_size)]:
+                h = ((h << 1) + gear[byte]) & MASK_64
+            position = max(start, self.min_size)
+            for byte in buffer[position:end]:
+                h = ((h << 1) + gear[byte]) & MASK_64
+                position += 1
+                if h < threshold:
+                    cut = position
+                    break
+            if cut is None:
+                if end == self.max_size:
+                    cut = end
+                else:
+                    self.hash = h
+                    self.scanned = max(end, start)
+                    return chunks
+            self._emit(0, cut, chunks)
+            del self.buffer[:cut]
+            self.scanned = 0
+            self.hash = 0
+
+    def finish(self):
+        chunks = []
+        if self.buffer:
+            self._emit(0, len(self.buffer), chunks)
+            self.buffer = bytearray()
+        return chunks
+
+
+def chunk_file(file_path, chunker=None, read_size=1024 * 1024):
+    """Return (md5 hex, chunks) of a file in one read pass."""
+    chunker = chunker or Chunker()
+    hash_md5 = hashlib.md5()
+    chunks = []
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(read_size), b""):
+            hash_md5.update(block)
+            chunks.extend(chunker.update(block))
+    chunks.extend(chunker.finish())
+    return hash_md5.hexdigest(), chunks
+
+
+def manifest_exists(cnx, md5_checksum):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM file_chunks WHERE file_md5 = %s LIMIT 1",
+                       (registry_database.md5_to_bin(md5_checksum),))
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def store_manifest(cnx, md5_checksum, chunks):
+    """Record the chunks of a file content unless it already has a manifest. Does not commit."""
+    file_md5 = registry_database.md5_to_bin(md5_checksum)
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM file_chunks WHERE file_md5 = %s LIMIT 1", (file_md5,))
+        if cursor.fetchone() is not None:
+            return False
+        for i in range(0, len(chunks), BATCH_SIZE):
+            batch = chunks[i:i + BATCH_SIZE]
+            cursor.executemany(
+                "INSERT IGNORE INTO chunks (digest, length) VALUES (%s, %s)",
+                [(digest, length) for _, length, digest in batch])
+            cursor.executemany(
+                "INSERT IGNORE INTO file_chunks (file_md5, seq, chunk_digest, chunk_offset, length) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                [(file_md5, i + n, digest, offset, length) for n, (offset, length, digest) in enumerate(batch)])
+        return True
+    finally:
+        cursor.close()
+
+
+# Chunks that appear in more than one distinct file content
+SHARED_CHUNKS = ("SELECT chunk_digest FROM file_chunks GROUP BY chunk_digest "
+                 "HAVING COUNT(DISTINCT file_md5) > 1")
+
+
+def shared_summary(cnx):
+    """Return (chunked bytes, unique chunk bytes, bytes in chunks shared between files)."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(SUM(length), 0) FROM file_chunks")
+        total = int(cursor.fetchone()[0])
+        cursor.execute("SELECT COALESCE(SUM(length), 0) FROM chunks")
+        unique = int(cursor.fetchone()[0])
+        cursor.execute(
+            f"SELECT COALESCE(SUM(fc.length), 0) FROM file_chunks fc JOIN ({SHARED_CHUNKS}) s "
+            f"ON s.chunk_digest = fc.chunk_digest")
+        shared = int(cursor.fetchone()[0])
+        return total, unique, shared
+    finally:
+        cursor.close()
+
+
+def _example_path(cursor, file_md5):
+    cursor.execute(
+        "SELECT file_path FROM file_metadata WHERE md5_checksum = %s AND valid_to_scan_id IS NULL LIMIT 1",
+        (file_md5,))
+    row = cursor.fetchone()
+    return registry_paths.path_from_db(row[0]) if row else None
+
+
+def top_sharing_files(cnx, limit=20):
+    """Yield (md5 hex, example path, file bytes, bytes shared with other files), most shared first."""
+    query = (f"SELECT fc.file_md5, SUM(fc.length), SUM(CASE WHEN s.chunk_digest IS NULL THEN 0 ELSE fc.length END) AS shared "
+             f"FROM file_chunks fc LEFT JOIN ({SHARED_CHUNKS}) s ON s.chunk_digest = fc.chunk_digest "
+             f"GROUP BY fc.file_md5 HAVING shared > 0 ORDER BY shared DESC LIMIT %s")
+    cursor = cnx.cursor(buffered=True)
+    lookup = cnx.cursor()
+    try:
+        cursor.execute(query, (limit,))
+        for file_md5, size, shared in cursor:
+            yield (registry_database.bin_to_hex(file_md5), _example_path(lookup, file_md5),
+                   int(size), int(shared))
+    finally:
+        lookup.close()
+        cursor.close()
+
+
+def similar_files(cnx, md5_checksum, limit=20):
+    """Yield (md5 hex, example path, bytes shared) of the file contents sharing most data with one file."""
+    query = ("SELECT other.file_md5, SUM(other.length) AS shared "
+             "FROM (SELECT DISTINCT chunk_digest FROM file_chunks WHERE file_md5 = %s) mine "
+             "JOIN file_chunks other ON other.chunk_digest = mine.chunk_digest "
+             "WHERE other.file_md5 != %s GROUP BY other.file_md5 ORDER BY shared DESC LIMIT %s")
+    file_md5 = registry_database.md5_to_bin(md5_checksum)
+    cursor = cnx.cursor(buffered=True)
+    lookup = cnx.cursor()
+    try:
+        cursor.execute(query, (file_md5, file_md5, limit))
+        for other_md5, shared in cursor:
+            yield registry_database.bin_to_hex(other_md5), _example_path(lookup, other_md5), int(shared)
+    finally:
+        lookup.close()
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report data shared between files from the chunk index.')
+    parser.add_argument('--top', type=int, default=20, help='number of files to list (default: 20)')
+    parser.add_argument('--like', type=str, default=None, metavar='PATH',
+                        help='list the files sharing the most data with this file')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        if args.like:
+            md5_checksum, chunks = chunk_file(args.like)
+            if not manifest_exists(cnx, md5_checksum):
+                store_manifest(cnx, md5_checksum, chunks)
+                cnx.commit()
+            print(f"Files sharing data with {registry_paths.display_path(args.like)} ({md5_checksum}):")
+            for other_md5, path, shared in similar_files(cnx, md5_checksum, args.top):
+                print(f"{shared / 1e6:>12.2f} MB  {other_md5}  {registry_paths.display_path(path) if path else '-'}")
+        else:
+            total, unique, shared = shared_summary(cnx)
+            print(f"Chunked data: {total / 1e9:.2f} GB, unique chunks: {unique / 1e9:.2f} GB, "
+                  f"saving {(total - unique) / 1e9:.2f} GB with chunk-level deduplication")
+            print(f"Data in chunks shared between different files: {shared / 1e9:.2f} GB")
+            print()
+            for md5_checksum, path, size, shared in top_sharing_files(cnx, args.top):
+                print(f"{shared / 1e6:>12.2f} of {size / 1e6:>10.2f} MB shared  {md5_checksum}  "
+                      f"{registry_paths.display_path(path) if path else '-'}")
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
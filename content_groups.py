@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Content Groups
+--------------
+Duplicate content aggregate over the active rows of files. content_groups
+holds one row per MD5 with the file size, the number of active copies and
+the bytes wasted by all copies but one; content_group_hosts breaks the
+copies down per host. Both are updated in bulk from the changes each scan
+applies to files (apply_changes), so the wasted-space report reads an index
+in wasted_bytes order instead of grouping every file.
+
+The duplicates table only records what was seen at insert time; this report
+replaces it. rebuild fills the aggregate for an existing database.
+"""
+
+import argparse
+import sys
+
+import mysql.connector
+
+import file_registry_log
+import registry_database
+import registry_paths
+
+# Digests per IN list / rows per executemany
+BATCH_SIZE = 1000
+
+DEFAULT_LIMIT = 20
+
+REPORT_COLUMNS = ("md5", "file_size", "copies", "wasted_bytes", "host_count", "hosts", "example_path")
+
+
+def _batches(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def apply_changes(cnx, changes):
+    """
+    Add file changes to the aggregate. changes holds (host_id, md5 digest,
+    file_size, copies) tuples, with copies +1 for a file that became active
+    with this content and -1 for one that stopped being active. Does not commit.
+    """
+    per_host = {}
+    sizes = {}
+    for host_id, md5_digest, file_size, copies in changes:
+        if md5_digest is None:
+            continue
+        md5_digest = bytes(md5_digest)
+        per_host[(host_id, md5_digest)] = per_host.get((host_id, md5_digest), 0) + copies
+        if file_size is not None:
+            sizes[md5_digest] = file_size
+    per_host = {key: copies for key, copies in per_host.items() if copies}
+    if not per_host:
+        return 0
+
+    per_digest = {}
+    for (_, md5_digest), copies in per_host.items():
+        per_digest[md5_digest] = per_digest.get(md5_digest, 0) + copies
+    digests = list(per_digest)
+
+    cursor = cnx.cursor()
+    try:
+        for batch in _batches([(md5_digest, sizes.get(md5_digest, 0), copies)
+                               for md5_digest, copies in per_digest.items()]):
+            cursor.executemany(
+                "INSERT INTO content_groups (md5_checksum, file_size, copies) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE copies = copies + VALUES(copies), "
+                "file_size = GREATEST(file_size, VALUES(file_size))", batch)
+        for batch in _batches([(host_id, md5_digest, copies)
+                               for (host_id, md5_digest), copies in per_host.items()]):
+            cursor.executemany(
+                "INSERT INTO content_group_hosts (host_id, md5_checksum, copies) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE copies = copies + VALUES(copies)", batch)
+
+        # Derived columns of the touched groups, set-based
+        for batch in _batches(digests):
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"DELETE FROM content_group_hosts WHERE md5_checksum IN ({placeholders}) "
+                           f"AND copies <= 0", batch)
+            cursor.execute(f"DELETE FROM content_groups WHERE md5_checksum IN ({placeholders}) "
+                           f"AND copies <= 0", batch)
+            cursor.execute(
+                f"UPDATE content_groups g SET g.wasted_bytes = g.file_size * (g.copies - 1), "
+                f"g.host_count = (SELECT COUNT(*) FROM content_group_hosts h WHERE h.md5_checksum = g.md5_checksum) "
+                f"WHERE g.md5_checksum IN ({placeholders})", batch)
+            cursor.execute(
+                f"UPDATE content_group_hosts h JOIN content_groups g ON g.md5_checksum = h.md5_checksum "
+                f"SET h.wasted_bytes = g.wasted_bytes WHERE h.md5_checksum IN ({placeholders})", batch)
+    finally:
+        cursor.close()
+    return len(digests)
+
+
+def rebuild(cnx):
+    """Recompute the aggregate from files with set-based statements. Commits."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("DELETE FROM content_group_hosts")
+        cursor.execute("DELETE FROM content_groups")
+        cursor.execute(
+            "INSERT INTO content_group_hosts (host_id, md5_checksum, copies) "
+            "SELECT host_id, md5_checksum, COUNT(*) FROM files "
+            "WHERE status = 'active' AND md5_checksum IS NOT NULL GROUP BY host_id, md5_checksum")
+        cursor.execute(
+            "INSERT INTO content_groups (md5_checksum, file_size, copies, host_count) "
+            "SELECT md5_checksum, MAX(file_size), COUNT(*), COUNT(DISTINCT host_id) FROM files "
+            "WHERE status = 'active' AND md5_checksum IS NOT NULL GROUP BY md5_checksum")
+        cursor.execute("UPDATE content_groups SET wasted_bytes = file_size * (copies - 1)")
+        cursor.execute(
+            "UPDATE content_group_hosts h JOIN content_groups g ON g.md5_checksum = h.md5_checksum "
+            "SET h.wasted_bytes = g.wasted_bytes")
+        cnx.commit()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(copies > 1), 0), COALESCE(SUM(wasted_bytes), 0) "
+                       "FROM content_groups")
+        groups, duplicated, wasted = cursor.fetchone()
+        return int(groups), int(duplicated), int(wasted)
+    finally:
+        cursor.close()
+
+
+def _group_details(cursor, md5_digest, host_id=None, pattern=None):
+    """Hostnames holding a group, and one example path (on host_id / under pattern if given)."""
+    cursor.execute(
+        "SELECT GROUP_CONCAT(hs.hostname ORDER BY hs.hostname SEPARATOR ',') FROM content_group_hosts h "
+        "JOIN hosts hs ON hs.id = h.host_id WHERE h.md5_checksum = %s", (md5_digest,))
+    hosts = cursor.fetchone()[0]
+    query = "SELECT file_path FROM files WHERE md5_checksum = %s AND status = 'active'"
+    args = [md5_digest]
+    if host_id is not None:
+        query += " AND host_id = %s"
+        args.append(host_id)
+    if pattern is not None:
+        query += " AND file_path LIKE %s"
+        args.append(pattern)
+    cursor.execute(query + " LIMIT 1", args)
+    row = cursor.fetchone()
+    return hosts, registry_paths.path_from_db(row[0]) if row else None
+
+
+def top_groups(cnx, host_id=None, under=None, limit=DEFAULT_LIMIT, min_copies=2):
+    """
+    Yield report rows (see REPORT_COLUMNS) for the groups wasting the most
+    bytes, optionally only groups with a copy on host_id and/or under a path.
+    """
+    args = []
+    if under:
+        # Groups are walked down idx_content_groups_wasted and each is probed
+        # for a copy in the subtree through idx_files_md5, stopping after
+        # limit hits instead of collecting every digest under the path first
+        pattern = registry_paths.prefix_pattern(under)
+        in_subtree = ("SELECT 1 FROM files f WHERE f.md5_checksum = g.md5_checksum "
+                      "AND f.status = 'active' AND f.file_path LIKE %s")
+        args.append(pattern)
+        if host_id is not None:
+            in_subtree += " AND f.host_id = %s"
+            args.append(host_id)
+        query = (f"SELECT g.md5_checksum, g.file_size, g.copies, g.wasted_bytes, g.host_count "
+                 f"FROM content_groups g WHERE EXISTS ({in_subtree}) AND g.copies >= %s "
+                 f"ORDER BY g.wasted_bytes DESC LIMIT %s")
+    elif host_id is not None:
+        pattern = None
+        query = ("SELECT g.md5_checksum, g.file_size, g.copies, g.wasted_bytes, g.host_count "
+                 "FROM content_group_hosts h JOIN content_groups g ON g.md5_checksum = h.md5_checksum "
+                 "WHERE h.host_id = %s AND g.copies >= %s ORDER BY h.wasted_bytes DESC LIMIT %s")
+        args.append(host_id)
+    else:
+        pattern = None
+        query = ("SELECT md5_checksum, file_size, copies, wasted_bytes, host_count FROM content_groups "
+                 "WHERE copies >= %s ORDER BY wasted_bytes DESC LIMIT %s")
+    args += [min_copies, limit]
+
+    cursor = cnx.cursor(buffered=True)
+    lookup = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        for md5_digest, file_size, copies, wasted_bytes, host_count in cursor:
+            hosts, example = _group_details(lookup, md5_digest, host_id, pattern)
+            yield (registry_database.bin_to_hex(md5_digest), int(file_size), int(copies), int(wasted_bytes),
+                   int(host_count), hosts, example)
+    finally:
+        lookup.close()
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the duplicate content wasting the most space.')
+    parser.add_argument('--host', type=str, default=None, help='only groups with a copy on this host')
+    parser.add_argument('--under', type=str, default=None, help='only groups with a copy below this path')
+    parser.add_argument('--min-copies', type=int, default=2, help='only groups with at least this many copies (default: 2)')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help=f'groups to list (default: {DEFAULT_LIMIT})')
+    parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help='output format')
+    parser.add_argument('--rebuild', action='store_true', help='recompute the aggregate from files first')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        try:
+            if args.rebuild:
+                groups, duplicated, wasted = rebuild(cnx)
+                print(f"Rebuilt {groups} content groups, {duplicated} duplicated, {wasted / 1e9:.2f} GB wasted",
+                      file=sys.stderr)
+            host_id = None
+            if args.host:
+                host_id = registry_database.get_host_id(cnx, args.host, create=False)
+            if args.host and host_id is None:
+                print(f"Host {args.host} is not in the registry.")
+            else:
+                rows = top_groups(cnx, host_id, args.under, args.limit, args.min_copies)
+                file_registry_log.write_rows(rows, REPORT_COLUMNS, args.format)
+        except mysql.connector.Error as err:
+            print(f"Error reading content groups: {err}")
+        finally:
+            cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
@@ -1,26 +1,41 @@
 -- File Registry Database Setup
 -- This script creates the necessary tables for the File Registry system
 
--- Files table - Stores information about each file in the registry
-CREATE TABLE files (
+-- Hosts table - Dictionary of scanned hosts referenced by id from the file tables
+CREATE TABLE IF NOT EXISTS hosts (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    hostname VARCHAR(255),
+    hostname VARCHAR(255) NOT NULL,
     ip_address VARCHAR(255),
     os_version VARCHAR(255),
-    file_path VARCHAR(255),
-    md5_checksum VARCHAR(32),
+    UNIQUE INDEX idx_hosts_hostname (hostname)
+);
+
+-- Files table - Stores information about each file in the registry
+-- Digests are stored as BINARY(16); use HEX()/UNHEX() to read or write them as text
+-- Paths are stored as the raw bytes returned by the filesystem so names that are not valid UTF-8 survive
+CREATE TABLE files (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    host_id INT,
+    file_path VARBINARY(1024),
+    md5_checksum BINARY(16),
     file_size BIGINT,
     modification_date DATETIME,
     duplicate_id INT,
     first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
     last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-    status ENUM('active', 'missing', 'likely_deleted', 'deleted', 'moved') DEFAULT 'active'
+    status ENUM('active', 'missing', 'likely_deleted', 'deleted', 'moved') DEFAULT 'active',
+    missed_scans INT DEFAULT 0,
+    INDEX idx_files_host_path (host_id, file_path),
+    INDEX idx_files_status (status, last_seen),
+    INDEX idx_files_path (file_path),
+    INDEX idx_files_md5 (md5_checksum),
+    INDEX idx_files_size (file_size)
 );
 
 -- Duplicates table - Tracks duplicate files across the system
 CREATE TABLE duplicates (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    file_path VARCHAR(255),
+    file_path VARBINARY(1024),
     count INT,
     detection_date DATETIME DEFAULT CURRENT_TIMESTAMP
 );
@@ -28,7 +43,7 @@ CREATE TABLE duplicates (
 -- Scan Log table - Records scanning activity
 CREATE TABLE scan_log (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    directory_path VARCHAR(255),
+    directory_path VARBINARY(1024),
     host_name VARCHAR(255),
     host_ip VARCHAR(15),
     os_version VARCHAR(255),
@@ -38,20 +53,32 @@ CREATE TABLE scan_log (
     status VARCHAR(50) DEFAULT 'in-progress',
     scan_duration INT,
     scan_start_time DATETIME,
-    scan_end_time DATETIME
+    scan_end_time DATETIME,
+    files_scanned BIGINT,
+    bytes_scanned BIGINT,
+    INDEX idx_scan_log_host (host_name, directory_path(255), scan_start_time)
 );
 
 -- Metadata table - Stores file metadata including MD5 checksums
+-- Each row is one version of a file, valid from scan_log_id until valid_to_scan_id (NULL while current)
 CREATE TABLE IF NOT EXISTS file_metadata (
     id INT AUTO_INCREMENT PRIMARY KEY,
     scan_log_id INT,
-    file_path VARCHAR(1024) NOT NULL,
-    md5_checksum VARCHAR(32) NOT NULL,
+    file_path VARBINARY(1024) NOT NULL,
+    md5_checksum BINARY(16) NOT NULL,
     file_size BIGINT,
     modification_date DATETIME,
     scan_date DATETIME,
-    file_path_hash VARCHAR(32) NOT NULL,
-    UNIQUE INDEX (file_path_hash, scan_log_id)
+    file_path_hash BINARY(16) NOT NULL,
+    host_id INT,
+    valid_to_scan_id INT,
+    UNIQUE INDEX idx_metadata_path_scan (file_path_hash, scan_log_id),
+    INDEX idx_metadata_current (host_id, file_path_hash, valid_to_scan_id),
+    INDEX idx_metadata_path (file_path(255), scan_log_id),
+    last_verified DATETIME,
+    INDEX idx_metadata_scan (scan_log_id, file_size),
+    INDEX idx_metadata_verified (host_id, valid_to_scan_id, last_verified),
+    INDEX idx_metadata_md5 (md5_checksum)
 );
 
 -- File History table - Tracks changes to files over time
@@ -59,11 +86,134 @@ CREATE TABLE IF NOT EXISTS file_history (
     id INT AUTO_INCREMENT PRIMARY KEY,
     file_id INT,
     event_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-    event_type ENUM('created', 'modified', 'deleted', 'moved', 'status_change'),
-    old_md5 VARCHAR(32),
-    new_md5 VARCHAR(32),
-    old_path VARCHAR(1024),
-    new_path VARCHAR(1024),
+    event_type ENUM('created', 'modified', 'deleted', 'moved', 'status_change', 'verify_failed',
+                    'verify_unconfirmed'),
+    old_md5 BINARY(16),
+    new_md5 BINARY(16),
+    old_path VARBINARY(1024),
+    new_path VARBINARY(1024),
     old_status VARCHAR(50),
     new_status VARCHAR(50)
 );
+
+-- Scan Work Units table - Work queue of subtrees for distributed scans
+CREATE TABLE IF NOT EXISTS scan_work_units (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    job_id INT NOT NULL,
+    parent_unit_id INT,
+    directory_path VARBINARY(1024) NOT NULL,
+    include_subdirs TINYINT DEFAULT 1,
+    status ENUM('pending', 'leased', 'done', 'failed') DEFAULT 'pending',
+    lease_owner VARCHAR(255),
+    lease_expires DATETIME,
+    attempts INT DEFAULT 0,
+    scan_log_id INT,
+    files_processed INT DEFAULT 0,
+    created DATETIME DEFAULT CURRENT_TIMESTAMP,
+    completed DATETIME,
+    INDEX idx_work_units_queue (job_id, status, lease_expires)
+);
+
+-- Non-UTF-8 Files table - Bulk-imported sanitizer reports of files whose names are not valid UTF-8
+CREATE TABLE IF NOT EXISTS non_utf8_files (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    host_id INT,
+    directory_path VARBINARY(1024) NOT NULL,
+    file_name VARBINARY(255) NOT NULL,
+    ascii_name VARCHAR(255),
+    report_date DATETIME,
+    INDEX idx_non_utf8_dir (host_id, directory_path)
+);
+
+-- Chunks table - Index of content-defined chunks, one row per distinct chunk
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BINARY(16) PRIMARY KEY,
+    length INT NOT NULL
+);
+
+-- File Chunks table - Chunk manifest of each file content, keyed by the file's MD5
+CREATE TABLE IF NOT EXISTS file_chunks (
+    file_md5 BINARY(16) NOT NULL,
+    seq INT NOT NULL,
+    chunk_digest BINARY(16) NOT NULL,
+    chunk_offset BIGINT NOT NULL,
+    length INT NOT NULL,
+    PRIMARY KEY (file_md5, seq),
+    INDEX idx_file_chunks_digest (chunk_digest, file_md5)
+);
+
+-- Directory Sizes table - Recursive file counts and bytes of every directory holding current file versions
+-- Kept up to date from version deltas; duplicate_* count files whose MD5 has another current copy
+CREATE TABLE IF NOT EXISTS directory_sizes (
+    host_id INT NOT NULL,
+    path_hash BINARY(16) NOT NULL,
+    directory_path VARBINARY(1024) NOT NULL,
+    parent_hash BINARY(16),
+    depth INT NOT NULL,
+    file_count BIGINT NOT NULL DEFAULT 0,
+    total_bytes BIGINT NOT NULL DEFAULT 0,
+    duplicate_files BIGINT NOT NULL DEFAULT 0,
+    duplicate_bytes BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (host_id, path_hash),
+    INDEX idx_directory_sizes_parent (host_id, parent_hash, total_bytes),
+    INDEX idx_directory_sizes_bytes (host_id, depth, total_bytes),
+    INDEX idx_directory_sizes_duplicates (host_id, depth, duplicate_bytes)
+);
+
+-- Content Groups table - Duplicate content aggregate over the active rows of files, one row per MD5
+-- Maintained in bulk as scans change files; wasted_bytes = file_size * (copies - 1)
+CREATE TABLE IF NOT EXISTS content_groups (
+    md5_checksum BINARY(16) PRIMARY KEY,
+    file_size BIGINT NOT NULL DEFAULT 0,
+    copies INT NOT NULL DEFAULT 0,
+    wasted_bytes BIGINT NOT NULL DEFAULT 0,
+    host_count INT NOT NULL DEFAULT 0,
+    INDEX idx_content_groups_wasted (wasted_bytes)
+);
+
+-- Content Group Hosts table - Copies of each content group per host
+CREATE TABLE IF NOT EXISTS content_group_hosts (
+    host_id INT NOT NULL,
+    md5_checksum BINARY(16) NOT NULL,
+    copies INT NOT NULL DEFAULT 0,
+    wasted_bytes BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (host_id, md5_checksum),
+    INDEX idx_content_group_hosts_md5 (md5_checksum),
+    INDEX idx_content_group_hosts_wasted (host_id, wasted_bytes)
+);
+
+-- Content Metadata table - Extractor results per content, shared by every copy of the MD5
+-- A content is re-extracted only when the extractor's version changes
+CREATE TABLE IF NOT EXISTS content_metadata (
+    md5_checksum BINARY(16) NOT NULL,
+    extractor VARCHAR(64) NOT NULL,
+    extractor_version INT NOT NULL,
+    metadata JSON,
+    extracted DATETIME,
+    PRIMARY KEY (md5_checksum, extractor),
+    INDEX idx_content_metadata_extractor (extractor, extractor_version)
+);
+
+-- Archives table - zip and tar archives whose members have been indexed. A row is added when
+-- indexing starts; the archive's MD5 and indexed are filled in once all members are stored
+CREATE TABLE IF NOT EXISTS archives (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    md5_checksum BINARY(16),
+    archive_format VARCHAR(16) NOT NULL,
+    member_count INT NOT NULL DEFAULT 0,
+    member_bytes BIGINT NOT NULL DEFAULT 0,
+    indexed DATETIME,
+    UNIQUE INDEX idx_archives_md5 (md5_checksum)
+);
+
+-- Archive Members table - Regular files inside indexed archives, hashed without extraction
+CREATE TABLE IF NOT EXISTS archive_members (
+    archive_id INT NOT NULL,
+    member_index INT NOT NULL,
+    member_path VARBINARY(1024) NOT NULL,
+    md5_checksum BINARY(16) NOT NULL,
+    file_size BIGINT,
+    modification_date DATETIME,
+    PRIMARY KEY (archive_id, member_index),
+    INDEX idx_archive_members_md5 (md5_checksum)
+);
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Digest Filter
+-------------
+Compact Bloom filter of the (MD5, file size) pairs known to the registry, for
+remote scanners that want to know whether content is already registered
+without a database round trip per file.
+
+    python digest_filter.py export known.bloom --fp-rate 0.001
+    python md5_metadata_scanner.py /ingest --storage xattr --known-filter known.bloom
+
+A filter answers "definitely new" or "probably known"; the false-positive
+rate is chosen at export and stored in the file. When the scanner has a
+database connection, probable matches are confirmed in batches against the
+table the filter was exported from, on the same (MD5, size) pair. The file
+is a small header followed by the bit array and is memory-mapped by readers.
+"""
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import registry_paths
+
+MAGIC = b"FRBLOOM1"
+VERSION = 2
+
+# magic, version, hash count, items, bits, false-positive rate, source
+HEADER = struct.Struct("<8sIIQQd16s")
+
+# Version 1 files have no source and were exported from content groups
+HEADER_V1 = struct.Struct("<8sIIQQd")
+
+DEFAULT_FP_RATE = 0.01
+
+FETCH_SIZE = 5000
+
+# Probable matches confirmed per query
+CONFIRM_BATCH_SIZE = 1000
+
+# Count, export and confirmation queries per source; confirmation is completed
+# with an IN list of digests and matched on (digest, size)
+SOURCES = {
+    # One row per content with an active copy
+    "groups": ("SELECT COUNT(*) FROM content_groups",
+               "SELECT md5_checksum, file_size FROM content_groups",
+               "SELECT md5_checksum, file_size FROM content_groups WHERE md5_checksum IN "),
+    # Current file_metadata versions
+    "metadata": ("SELECT COUNT(*) FROM file_metadata WHERE valid_to_scan_id IS NULL",
+                 "SELECT md5_checksum, file_size FROM file_metadata WHERE valid_to_scan_id IS NULL",
+                 "SELECT DISTINCT md5_checksum, file_size FROM file_metadata "
+                 "WHERE valid_to_scan_id IS NULL AND md5_checksum IN "),
+}
+
+
+def filter_size(items, fp_rate):
+    """Return (bits, hash count) for a Bloom filter of items with the given false-positive rate."""
+    items = max(items, 1)
+    bits = max(64, math.ceil(-items * math.log(fp_rate) / math.log(2) ** 2))
+    hashes = max(1, round(bits / items * math.log(2)))
+    return bits, hashes
+
+
+def _positions(md5_digest, file_size, bits, hashes):
+    # Double hashing: k positions from two 64-bit halves of one digest
+    key = hashlib.md5(bytes(md5_digest) + (file_size or 0).to_bytes(8, "little", signed=True)).digest()
+    h1 = int.from_bytes(key[:8], "little")
+    h2 = int.from_bytes(key[8:], "little") | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class DigestFilter:
+    """A Bloom filter over (md5 digest, file size) pairs."""
+
+    def __init__(self, bits, hashes, items=0, fp_rate=DEFAULT_FP_RATE, data=None, source="groups"):
+        self.bits = bits
+        self.hashes = hashes
+        self.items = items
+        self.fp_rate = fp_rate
+        self.source = source
+        self.data = data if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_items(cls, items, fp_rate=DEFAULT_FP_RATE, source="groups"):
+        bits, hashes = filter_size(items, fp_rate)
+        return cls(bits, hashes, 0, fp_rate, source=source)
+
+    def add(self, md5_digest, file_size):
+        data = self.data
+        for position in _positions(md5_digest, file_size, self.bits, self.hashes):
+            data[position >> 3] |= 1 << (position & 7)
+        self.items += 1
+
+    def might_contain(self, md5_digest, file_size):
+        """False if the pair was never added; True if it probably was."""
+        data = self.data
+        return all(data[position >> 3] & (1 << (position & 7))
+                   for position in _positions(md5_digest, file_size, self.bits, self.hashes))
+
+    def expected_fp_rate(self):
+        """False-positive rate for the number of items actually added."""
+        return (1 - math.exp(-self.hashes * self.items / self.bits)) ** self.hashes
+
+    def save(self, output_path):
+        """Write the filter to a temporary file and rename it into place."""
+        directory = os.path.dirname(os.path.abspath(output_path))
+        out = tempfile.NamedTemporaryFile(dir=directory, prefix=".filter-", delete=False)
+        try:
+            out.write(HEADER.pack(MAGIC, VERSION, self.hashes, self.items, self.bits, self.fp_rate,
+                                  self.source.encode("ascii")))
+            out.write(self.data)
+            out.close()
+            os.replace(out.name, output_path)
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Map a filter file read-only."""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hashes, items, bits, fp_rate = HEADER_V1.unpack_from(data)
+        if magic != MAGIC or version not in (1, VERSION):
+            raise ValueError(f"{path} is not a digest filter")
+        header = HEADER_V1 if version == 1 else HEADER
+        source = "groups" if version == 1 else header.unpack_from(data)[6].rstrip(b"\0").decode("ascii")
+        if source not in SOURCES:
+            raise ValueError(f"{path} was exported from an unknown source: {source}")
+        if len(data) < header.size + (bits + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+        return cls(bits, hashes, items, fp_rate, memoryview(data)[header.size:], source)
+
+
+def export_filter(cnx, output_path, source="groups", fp_rate=DEFAULT_FP_RATE):
+    """Write a filter of the registry's known contents. Returns the filter."""
+    count_query, query, _ = SOURCES[source]
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(count_query)
+        digest_filter = DigestFilter.for_items(int(cursor.fetchone()[0]), fp_rate, source)
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for md5_digest, file_size in rows:
+                if md5_digest is not None:
+                    digest_filter.add(md5_digest, file_size)
+    finally:
+        cursor.close()
+    digest_filter.save(output_path)
+    return digest_filter
+
+
+class KnownContent:
+    """
+    Classify scanned files against a DigestFilter. Probable matches are kept
+    and, given a connection, confirmed in batches against the source the
+    filter was exported from; the rest are new. Paths of new content are
+    written to new_list if given.
+    """
+
+    def __init__(self, digest_filter, cnx=None, new_list=None):
+        self.filter = digest_filter
+        self.cnx = cnx
+        self.new_list = new_list
+        self.pending = []
+        self.new = self.new_bytes = 0
+        self.known = self.known_bytes = 0
+        self.probable = self.probable_bytes = 0
+        self.false_positives = 0
+
+    def _new(self, file_path, file_size):
+        self.new += 1
+        self.new_bytes += file_size
+        if self.new_list:
+            self.new_list.write(registry_paths.display_path(file_path) + "\n")
+
+    def check(self, file_path, md5_checksum, file_size):
+        """Return 'new' or 'probable' for a file's MD5 hex and size."""
+        md5_digest = bytes.fromhex(md5_checksum)
+        if not self.filter.might_contain(md5_digest, file_size):
+            self._new(file_path, file_size)
+            return "new"
+        self.pending.append((file_path, md5_digest, file_size))
+        if self.cnx and len(self.pending) >= CONFIRM_BATCH_SIZE:
+            self.confirm()
+        return "probable"
+
+    def confirm(self):
+        """Look up the pending probable matches in one query."""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        if not self.cnx:
+            for _, _, file_size in pending:
+                self.probable += 1
+                self.probable_bytes += file_size
+            return
+        digests = list({md5_digest for _, md5_digest, _ in pending})
+        cursor = self.cnx.cursor()
+        try:
+            placeholders = ", ".join(["%s"] * len(digests))
+            cursor.execute(f"{SOURCES[self.filter.source][2]}({placeholders})", digests)
+            found = {(bytes(md5_digest), file_size) for md5_digest, file_size in cursor.fetchall()}
+        finally:
+            cursor.close()
+        for file_path, md5_digest, file_size in pending:
+            if (md5_digest, file_size) in found:
+                self.known += 1
+                self.known_bytes += file_size
+            else:
+                self.false_positives += 1
+                self._new(file_path, file_size)
+
+    def summary(self):
+        self.confirm()
+        lines = [f"New content: {self.new} files, {self.new_bytes / 1e9:.2f} GB"]
+        if self.known or self.false_positives:
+            lines.append(f"Already registered: {self.known} files, {self.known_bytes / 1e9:.2f} GB "
+                         f"({self.false_positives} filter false positives)")
+        if self.probable:
+            lines.append(f"Probably registered (not confirmed): {self.probable} files, "
+                         f"{self.probable_bytes / 1e9:.2f} GB")
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export or inspect a Bloom filter of the known digests.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='write a filter of the registry contents')
+    export_parser.add_argument('output', type=str, help='filter file to write')
+    export_parser.add_argument('--source', choices=list(SOURCES), default='groups',
+                               help='contents with an active copy (groups, default) or current metadata versions')
+    export_parser.add_argument('--fp-rate', type=float, default=DEFAULT_FP_RATE,
+                               help=f'false-positive rate (default: {DEFAULT_FP_RATE})')
+
+    info_parser = subparsers.add_parser('info', help='show the size and accuracy of a filter')
+    info_parser.add_argument('filter', type=str, help='filter file')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        try:
+            digest_filter = DigestFilter.load(args.filter)
+        except (OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        print(f"{digest_filter.items} contents from {digest_filter.source} in {digest_filter.bits // 8 / 1e6:.2f} MB, "
+              f"{digest_filter.hashes} hashes, false-positive rate {digest_filter.expected_fp_rate():.4%} "
+              f"(exported for {digest_filter.fp_rate:.4%})")
+        sys.exit(0)
+
+    if not 0 < args.fp_rate < 1:
+        parser.error("--fp-rate must be between 0 and 1")
+
+    import registry_database
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        try:
+            digest_filter = export_filter(cnx, args.output, args.source, args.fp_rate)
+            print(f"Wrote {digest_filter.items} contents to {args.output} "
+                  f"({os.path.getsize(args.output) / 1e6:.2f} MB, false-positive rate {digest_filter.expected_fp_rate():.4%})")
+        finally:
+            cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Directory Sizes
+---------------
+Materialized du for the registry. directory_sizes holds, for every directory
+that contains registered files, the recursive file count and bytes below it
+and how much of that is duplicated content (files whose MD5 has at least one
+other current copy, on any host).
+
+The table is kept up to date from the version deltas written by
+metadata_snapshots: every version that starts or ends is recorded here and
+flush() adds the net change to each ancestor directory in the same
+transaction, so a scan costs work proportional to what changed, not to the
+size of the tree. Looking up a subtree is a primary key read. rebuild fills
+the table from the current versions, for existing databases.
+"""
+
+import argparse
+import os
+import platform
+
+import registry_database
+import registry_paths
+
+# Rows per executemany / IN list
+BATCH_SIZE = 1000
+
+DEFAULT_LIMIT = 20
+
+# (host_id, file_path, md5 digest) -> [file_size, net count], waiting for flush()
+_pending = {}
+
+
+def ancestors(file_path):
+    """The directories containing file_path, innermost first."""
+    directory = os.path.dirname(file_path)
+    while directory:
+        yield directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+
+def _parent(directory):
+    parent = os.path.dirname(directory)
+    return None if not parent or parent == directory else parent
+
+
+def _depth(directory):
+    return len([part for part in directory.split(os.sep) if part])
+
+
+def record(host_id, file_path, md5_digest, file_size, sign):
+    """Note that a current version started (sign 1) or ended (sign -1). Applied by flush()."""
+    key = (host_id, file_path, md5_digest)
+    entry = _pending.setdefault(key, [file_size or 0, 0])
+    entry[1] += sign
+    if entry[1] == 0:
+        del _pending[key]
+
+
+def discard():
+    """Forget the recorded changes, after the transaction that wrote them was rolled back."""
+    _pending.clear()
+
+
+def _duplicate_deltas(cursor, changes):
+    """
+    Yield (host_id, file_path, file_size, sign) for files whose duplicate
+    status changed, given changes already written to file_metadata.
+    """
+    by_digest = {}
+    for (host_id, file_path, md5_digest), (file_size, net) in changes.items():
+        by_digest.setdefault(md5_digest, []).append((host_id, file_path, file_size, net))
+
+    digests = list(by_digest)
+    after = {}
+    for i in range(0, len(digests), BATCH_SIZE):
+        batch = digests[i:i + BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(batch))
+        cursor.execute(
+            f"SELECT md5_checksum, COUNT(*) FROM file_metadata "
+            f"WHERE md5_checksum IN ({placeholders}) AND valid_to_scan_id IS NULL "
+            f"GROUP BY md5_checksum", batch)
+        after.update((bytes(digest), count) for digest, count in cursor.fetchall())
+
+    flipped = []
+    for digest, files in by_digest.items():
+        copies_after = after.get(digest, 0)
+        copies_before = copies_after - sum(net for _, _, _, net in files)
+        for host_id, file_path, file_size, net in files:
+            if net > 0 and copies_after > 1:
+                yield host_id, file_path, file_size, 1
+            elif net < 0 and copies_before > 1:
+                yield host_id, file_path, file_size, -1
+        # Copies this flush did not touch change status when the count crosses 1
+        if (copies_before > 1) != (copies_after > 1):
+            flipped.append(digest)
+
+    for i in range(0, len(flipped), BATCH_SIZE):
+        batch = flipped[i:i + BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(batch))
+        cursor.execute(
+            f"SELECT host_id, file_path, md5_checksum, file_size FROM file_metadata "
+            f"WHERE md5_checksum IN ({placeholders}) AND valid_to_scan_id IS NULL", batch)
+        for host_id, file_path, md5_digest, file_size in cursor.fetchall():
+            md5_digest = bytes(md5_digest)
+            file_path = registry_paths.path_from_db(file_path)
+            if (host_id, file_path, md5_digest) in changes:
+                continue
+            yield host_id, file_path, file_size or 0, 1 if after.get(md5_digest, 0) > 1 else -1
+
+
+def _write_totals(cursor, totals):
+    """Add {(host_id, directory): [files, bytes, duplicate files, duplicate bytes]} to directory_sizes."""
+    rows = [(host_id, registry_paths.path_hash(directory), registry_paths.path_to_db(directory),
+             registry_paths.path_hash(_parent(directory)) if _parent(directory) else None,
+             _depth(directory), *counts)
+            for (host_id, directory), counts in totals.items() if any(counts)]
+    for i in range(0, len(rows), BATCH_SIZE):
+        cursor.executemany(
+            "INSERT INTO directory_sizes (host_id, path_hash, directory_path, parent_hash, depth, "
+            "file_count, total_bytes, duplicate_files, duplicate_bytes) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE file_count = file_count + VALUES(file_count), "
+            "total_bytes = total_bytes + VALUES(total_bytes), "
+            "duplicate_files = duplicate_files + VALUES(duplicate_files), "
+            "duplicate_bytes = duplicate_bytes + VALUES(duplicate_bytes)",
+            rows[i:i + BATCH_SIZE])
+
+    # Directories left without files are dropped
+    emptied = [(host_id, registry_paths.path_hash(directory))
+               for (host_id, directory), counts in totals.items() if counts[0] < 0]
+    for i in range(0, len(emptied), BATCH_SIZE):
+        cursor.executemany(
+            "DELETE FROM directory_sizes WHERE host_id = %s AND path_hash = %s AND file_count <= 0",
+            emptied[i:i + BATCH_SIZE])
+
+
+def flush(cnx):
+    """
+    Apply the recorded version changes to directory_sizes. Call before the
+    commit that makes the versions permanent. Does not commit.
+    """
+    if not _pending:
+        return 0
+    changes = dict(_pending)
+    _pending.clear()
+
+    totals = {}
+    cursor = cnx.cursor()
+    try:
+        for (host_id, file_path, _), (file_size, net) in changes.items():
+            for directory in ancestors(file_path):
+                counts = totals.setdefault((host_id, directory), [0, 0, 0, 0])
+                counts[0] += net
+                counts[1] += net * file_size
+        for host_id, file_path, file_size, sign in _duplicate_deltas(cursor, changes):
+            for directory in ancestors(file_path):
+                counts = totals.setdefault((host_id, directory), [0, 0, 0, 0])
+                counts[2] += sign
+                counts[3] += sign * file_size
+        _write_totals(cursor, totals)
+    finally:
+        cursor.close()
+    return len(changes)
+
+
+def rebuild(cnx, host_id=None):
+    """Recompute directory_sizes from the current versions, for one host or all. Commits."""
+    query = ("SELECT fm.host_id, fm.file_path, fm.file_size, d.md5_checksum IS NOT NULL "
+             "FROM file_metadata fm LEFT JOIN ("
+             "SELECT md5_checksum FROM file_metadata WHERE valid_to_scan_id IS NULL "
+             "GROUP BY md5_checksum HAVING COUNT(*) > 1) d ON d.md5_checksum = fm.md5_checksum "
+             "WHERE fm.valid_to_scan_id IS NULL AND fm.host_id IS NOT NULL")
+    args = []
+    if host_id is not None:
+        query += " AND fm.host_id = %s"
+        args.append(host_id)
+
+    totals = {}
+    files = 0
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        for file_host_id, file_path, file_size, duplicated in cursor:
+            file_size = file_size or 0
+            files += 1
+            for directory in ancestors(registry_paths.path_from_db(file_path)):
+                counts = totals.setdefault((file_host_id, directory), [0, 0, 0, 0])
+                counts[0] += 1
+                counts[1] += file_size
+                if duplicated:
+                    counts[2] += 1
+                    counts[3] += file_size
+    finally:
+        cursor.close()
+
+    cursor = cnx.cursor()
+    try:
+        if host_id is None:
+            cursor.execute("DELETE FROM directory_sizes")
+        else:
+            cursor.execute("DELETE FROM directory_sizes WHERE host_id = %s", (host_id,))
+        _write_totals(cursor, totals)
+        cnx.commit()
+    finally:
+        cursor.close()
+    return files, len(totals)
+
+
+SIZE_COLUMNS = "directory_path, file_count, total_bytes, duplicate_files, duplicate_bytes"
+
+
+def _row(row):
+    directory_path, file_count, total_bytes, duplicate_files, duplicate_bytes = row
+    return (registry_paths.path_from_db(directory_path), int(file_count), int(total_bytes),
+            int(duplicate_files), int(duplicate_bytes))
+
+
+def directory_size(cnx, host_id, directory_path):
+    """Return (path, files, bytes, duplicate files, duplicate bytes) of a subtree, or None if empty."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {SIZE_COLUMNS} FROM directory_sizes WHERE host_id = %s AND path_hash = %s",
+            (host_id, registry_paths.path_hash(directory_path.rstrip(os.sep) or os.sep)))
+        row = cursor.fetchone()
+        return _row(row) if row else None
+    finally:
+        cursor.close()
+
+
+def subdirectories(cnx, host_id, directory_path, limit=DEFAULT_LIMIT):
+    """Yield the largest immediate subdirectories of a directory."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {SIZE_COLUMNS} FROM directory_sizes WHERE host_id = %s AND parent_hash = %s "
+            f"ORDER BY total_bytes DESC LIMIT %s",
+            (host_id, registry_paths.path_hash(directory_path.rstrip(os.sep) or os.sep), limit))
+        for row in cursor.fetchall():
+            yield _row(row)
+    finally:
+        cursor.close()
+
+
+def top_directories(cnx, host_id, by="bytes", depth=None, under=None, limit=DEFAULT_LIMIT):
+    """Yield the directories with the most bytes or duplicate bytes, optionally at one depth or under a path."""
+    order = "duplicate_bytes" if by == "duplicates" else "total_bytes"
+    conditions = ["host_id = %s"]
+    args = [host_id]
+    if depth is not None:
+        conditions.append("depth = %s")
+        args.append(depth)
+    if under:
+        conditions.append("directory_path LIKE %s")
+        args.append(registry_paths.prefix_pattern(under))
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            f"SELECT {SIZE_COLUMNS} FROM directory_sizes WHERE {' AND '.join(conditions)} "
+            f"ORDER BY {order} DESC LIMIT %s", (*args, limit))
+        for row in cursor.fetchall():
+            yield _row(row)
+    finally:
+        cursor.close()
+
+
+def print_row(row):
+    directory_path, file_count, total_bytes, duplicate_files, duplicate_bytes = row
+    print(f"{total_bytes / 1e9:>10.2f} GB {file_count:>10} files  "
+          f"{duplicate_bytes / 1e9:>8.2f} GB duplicated  {registry_paths.display_path(directory_path)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recursive directory sizes and duplicated bytes from the registry.')
+    parser.add_argument('--host', type=str, default=platform.node(), help='hostname to report on (default: this host)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    du_parser = subparsers.add_parser('du', help='size of a directory and its largest subdirectories')
+    du_parser.add_argument('directory_path', type=str, help='the directory to report on')
+    du_parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT,
+                           help=f'subdirectories to list (default: {DEFAULT_LIMIT})')
+
+    top_parser = subparsers.add_parser('top', help='largest or most duplicated directories')
+    top_parser.add_argument('--by', choices=['bytes', 'duplicates'], default='bytes', help='sort order (default: bytes)')
+    top_parser.add_argument('--depth', type=int, default=None,
+                            help='only directories this many levels below the file system root')
+    top_parser.add_argument('--under', type=str, default=None, help='only directories below this path')
+    top_parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help=f'rows to list (default: {DEFAULT_LIMIT})')
+
+    subparsers.add_parser('rebuild', help='recompute the table for the host from the current file versions')
+
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        host_id = registry_database.get_host_id(cnx, args.host, create=False)
+        if host_id is None:
+            print(f"Host {args.host} is not in the registry.")
+        elif args.command == 'du':
+            row = directory_size(cnx, host_id, args.directory_path)
+            if row is None:
+                print(f"No registered files under {registry_paths.display_path(args.directory_path)} on {args.host}")
+            else:
+                print_row(row)
+                for child in subdirectories(cnx, host_id, args.directory_path, args.limit):
+                    print_row(child)
+        elif args.command == 'top':
+            for row in top_directories(cnx, host_id, args.by, args.depth, args.under, args.limit):
+                print_row(row)
+        else:
+            files, directories = rebuild(cnx, host_id)
+            print(f"Rebuilt {directories} directories from {files} current files on {args.host}")
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
@@ -0,0 +1,266 @@
+"""
+Exclusion Rules
+---------------
+One compiled matcher deciding which directories and files the scanners skip.
+
+Rules are read from config/exclusions.json:
+
+    {
+        "exclude": ["*.tmp", "/scratch/", "**/cache/*.tmp", "node_modules/", "!keep.tmp"],
+        "regex": ["\\.~lock\\..*#$"],
+        "extensions": [".bak", ".part"],
+        "min_size": 4096,
+        "max_size": null,
+        "max_age_days": null,
+        "min_age_days": null
+    }
+
+"exclude" uses gitignore syntax relative to the scan root: a pattern without a
+slash matches a name at any depth, a pattern containing a slash is anchored to
+the root, a trailing slash matches directories only, "**" spans directories and
+a leading "!" re-includes what an earlier pattern excluded (the last matching
+pattern wins). Regexes are searched in the root-relative path of files and
+directories. The size, extension and age predicates apply to files only and
+exclude files smaller than min_size, larger than max_size, modified more than
+max_age_days ago or less than min_age_days ago.
+
+Without config/exclusions.json the legacy excluded_dirs.json and
+excluded_files.json name lists are used, or the built-in defaults below.
+Excluded directories are pruned during the walk, so nothing under them is read.
+"""
+
+import json
+import os
+import re
+import time
+
+RULES_FILE = "config/exclusions.json"
+
+# Legacy exact-name lists, looked up in the working directory and then in config/
+LEGACY_DIRS_FILES = ["excluded_dirs.json", "config/excluded_dirs.json"]
+LEGACY_FILES_FILES = ["excluded_files.json", "config/excluded_files.json"]
+
+DEFAULT_EXCLUDED_DIRS = [".git", ".gitold", ".snapshots", ".snapshot", "SNAPSHOTS", "snapshot"]
+DEFAULT_EXCLUDED_FILES = ["._.DS_Store", ".DS_Store", ".localized", ".Spotlight-V100", ".Trashes",
+                          ".fseventsd", ".local", ".kde"]
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def glob_to_regex(pattern):
+    """Translate the body of a gitignore pattern into a regex for a root-relative path."""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:[^/]*/)*")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            out.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    prefix = "^" if anchored else "(?:^|/)"
+    return prefix + "".join(out) + "$"
+
+
+class ExclusionRules:
+    """Compiled exclusion rules. Paths passed in are relative to the scan root with '/' separators."""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.dir_names = set(config.get("exclude_dirs", []))
+        self.file_names = set(config.get("exclude_files", []))
+        self.ordered = []
+
+        patterns = config.get("exclude", [])
+        has_negation = any(p.startswith("!") for p in patterns)
+        dir_regexes = []
+        file_regexes = []
+        for pattern in patterns:
+            negate = pattern.startswith("!")
+            pattern = pattern[1:] if negate else pattern
+            if not pattern or pattern.startswith("#"):
+                continue
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+
+            # Plain names are set lookups unless their order matters
+            if not has_negation and "/" not in pattern and not _GLOB_CHARS.search(pattern):
+                self.dir_names.add(pattern)
+                if not dir_only:
+                    self.file_names.add(pattern)
+                continue
+
+            regex = glob_to_regex(pattern)
+            if has_negation:
+                self.ordered.append((re.compile(regex), negate, dir_only))
+            else:
+                dir_regexes.append(regex)
+                if not dir_only:
+                    file_regexes.append(regex)
+
+        for regex in config.get("regex", []):
+            dir_regexes.append(f"(?:{regex})")
+            file_regexes.append(f"(?:{regex})")
+
+        # All non-ordered patterns of a kind collapse into one regex
+        self.dir_regex = re.compile("|".join(dir_regexes)) if dir_regexes else None
+        self.file_regex = re.compile("|".join(file_regexes)) if file_regexes else None
+
+        self.extensions = {e.lower() if e.startswith(".") else "." + e.lower()
+                           for e in config.get("extensions", [])}
+        self.min_size = config.get("min_size")
+        self.max_size = config.get("max_size")
+        self.max_age_days = config.get("max_age_days")
+        self.min_age_days = config.get("min_age_days")
+        self.needs_stat = any(v is not None for v in
+                              (self.min_size, self.max_size, self.max_age_days, self.min_age_days))
+
+    def _ordered_match(self, rel_path, is_dir):
+        for regex, negate, dir_only in reversed(self.ordered):
+            if dir_only and not is_dir:
+                continue
+            if regex.search(rel_path):
+                return not negate
+        return False
+
+    def excludes_dir(self, rel_path, name):
+        """True if the directory at rel_path should not be descended into."""
+        if name in self.dir_names:
+            return True
+        if self.dir_regex is not None and self.dir_regex.search(rel_path):
+            return True
+        return bool(self.ordered) and self._ordered_match(rel_path, True)
+
+    def excludes_file(self, rel_path, name, stat=None):
+        """
+        True if the file at rel_path should be skipped. stat is an os.stat_result
+        or a callable returning one; it is only used by the size and age rules.
+        """
+        if name in self.file_names:
+            return True
+        if self.extensions and os.path.splitext(name)[1].lower() in self.extensions:
+            return True
+        if self.file_regex is not None and self.file_regex.search(rel_path):
+            return True
+        if self.ordered and self._ordered_match(rel_path, False):
+            return True
+        if self.needs_stat and stat is not None:
+            try:
+                st = stat() if callable(stat) else stat
+            except OSError:
+                return False
+            return self._excluded_by_stat(st)
+        return False
+
+    def _excluded_by_stat(self, st):
+        if self.min_size is not None and st.st_size < self.min_size:
+            return True
+        if self.max_size is not None and st.st_size > self.max_size:
+            return True
+        age_days = (time.time() - st.st_mtime) / 86400
+        if self.max_age_days is not None and age_days > self.max_age_days:
+            return True
+        if self.min_age_days is not None and age_days < self.min_age_days:
+            return True
+        return False
+
+    def excludes(self, path, root, is_dir=None):
+        """Check a single absolute path under root, e.g. from a file system event."""
+        rel_path = relative_path(path, root)
+        name = os.path.basename(path)
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        if is_dir:
+            return self.excludes_dir(rel_path, name)
+        return self.excludes_file(rel_path, name, lambda: os.stat(path))
+
+
+def relative_path(path, root):
+    """path relative to root with '/' separators, as the rules expect."""
+    rel_path = os.path.relpath(path, root)
+    return rel_path.replace(os.sep, "/") if os.sep != "/" else rel_path
+
+
+def _read_json(candidates):
+    for path in candidates:
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return None
+
+
+def load_rules(path=None):
+    """Load and compile the exclusion rules (see the module docstring for the lookup order)."""
+    if path is not None or os.path.exists(RULES_FILE):
+        with open(path or RULES_FILE) as f:
+            return ExclusionRules(json.load(f))
+
+    excluded_dirs = _read_json(LEGACY_DIRS_FILES)
+    excluded_files = _read_json(LEGACY_FILES_FILES)
+    return ExclusionRules({
+        "exclude_dirs": excluded_dirs if excluded_dirs is not None else DEFAULT_EXCLUDED_DIRS,
+        "exclude_files": excluded_files if excluded_files is not None else DEFAULT_EXCLUDED_FILES,
+    })
+
+
+def walk(top, rules, root=None):
+    """
+    Like os.walk(top) but with excluded directories pruned before they are
+    read and excluded files left out. Paths are matched relative to root,
+    which defaults to top. Yields (dirpath, dirnames, filenames); dirnames may
+    be pruned further in place.
+    """
+    root = root or top
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        rel_dir = relative_path(dirpath, root)
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        dirnames = []
+        filenames = []
+        # Symlinked directories are listed but not followed, as in os.walk
+        symlinks = set()
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not rules.excludes_dir(rel_dir + entry.name, entry.name):
+                            dirnames.append(entry.name)
+                            if entry.is_symlink():
+                                symlinks.add(entry.name)
+                    elif not rules.excludes_file(rel_dir + entry.name, entry.name, entry.stat):
+                        filenames.append(entry.name)
+        except OSError:
+            continue
+        yield dirpath, dirnames, filenames
+        stack.extend(os.path.join(dirpath, d) for d in reversed(dirnames) if d not in symlinks)
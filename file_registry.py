@@ -5,13 +5,16 @@ import json
 import time
 import argparse
 import socket
-from tqdm import tqdm
 import getpass
 from datetime import datetime
 import xattr
 
 import mysql.connector
+import content_groups
+import exclusion_rules
 import registry_database
+import registry_paths
+import registry_status
 import logging
 
 logging.basicConfig(filename='error_log.log', level=logging.ERROR,
@@ -19,9 +22,6 @@ logging.basicConfig(filename='error_log.log', level=logging.ERROR,
 
 file_count = 0
 
-def sanitize_string(input_str):
-    return input_str.encode('utf-8', 'replace').decode('utf-8')
-
 def file_exists_in_database(cnx, file_path):
 
     cursor = cnx.cursor()
@@ -29,7 +29,7 @@ def file_exists_in_database(cnx, file_path):
     try:
         # Check if the file_path exists in the table
         query = "SELECT 1 FROM files WHERE file_path = %s"
-        cursor.execute(query, (file_path,))
+        cursor.execute(query, (registry_paths.path_to_db(file_path),))
         result = cursor.fetchone()
         return result is not None
     finally:
@@ -40,49 +40,54 @@ def add_to_database(cnx, hostname, ip_address, os_version, file_path, md5_checks
 
     cursor = cnx.cursor()
 
+    host_id = registry_database.get_host_id(cnx, hostname, ip_address, os_version)
+    md5_digest = registry_database.md5_to_bin(md5_checksum)
+
+    db_path = registry_paths.path_to_db(file_path)
+
     # Check if the file_path exists in the table
-    cursor.execute("SELECT md5_checksum FROM files WHERE file_path = %s", (file_path,))
+    cursor.execute("SELECT md5_checksum FROM files WHERE file_path = %s", (db_path,))
     result = cursor.fetchone()
     if result is not None:
-        if result[0] == md5_checksum:
-            print(f"File {file_path} already exists in the table with the same md5 checksum.")
+        if registry_database.bin_to_hex(result[0]) == md5_checksum:
+            print(f"File {registry_paths.display_path(file_path)} already exists in the table with the same md5 checksum.")
             return
         else:
-            print(f"File {file_path} already exists in the table with a different md5 checksum. Updating the existing entry.")
-            cursor.execute("UPDATE files SET md5_checksum = %s, file_size = %s, modification_date = %s WHERE file_path = %s", (md5_checksum, file_size, modification_date, file_path))
+            print(f"File {registry_paths.display_path(file_path)} already exists in the table with a different md5 checksum. Updating the existing entry.")
+            cursor.execute("UPDATE files SET md5_checksum = %s, file_size = %s, modification_date = %s WHERE file_path = %s", (md5_digest, file_size, modification_date, db_path))
             cnx.commit()
             cursor.close()
             return
 
     # Insert the hostname, IP address, OS version, file path, MD5 checksum, file size, and modification date into the database
     add_server = ("INSERT INTO files "
-                  "(hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date) "
-                  "VALUES (%s, %s, %s, %s, %s, %s, %s)")
-    data_server = (hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date)
+                  "(host_id, file_path, md5_checksum, file_size, modification_date) "
+                  "VALUES (%s, %s, %s, %s, %s)")
+    data_server = (host_id, db_path, md5_digest, file_size, modification_date)
     cursor.execute(add_server, data_server)
 
     # Check if the MD5 checksum is unique or a duplicate
-    cursor.execute("SELECT COUNT(*) FROM files WHERE md5_checksum = %s", (md5_checksum,))
+    cursor.execute("SELECT COUNT(*) FROM files WHERE md5_checksum = %s", (md5_digest,))
     result = cursor.fetchone()
     if result:
         count = result[0]
         if count > 1:
-            print(f"Duplicate file found: {file_path}", len(file_path))
+            print(f"Duplicate file found: {registry_paths.display_path(file_path)}", len(db_path))
             # Add the duplicate file to the duplicates table
             add_duplicate = ("INSERT INTO duplicates "
                              "(file_path, count) "
                              "VALUES (%s, %s)")
-            data_duplicate = (file_path, count)
+            data_duplicate = (db_path, count)
             cursor.execute(add_duplicate, data_duplicate)
 
             # Get the ID of the duplicate file in duplicates
-            cursor.execute("SELECT id FROM duplicates WHERE file_path = %s", (file_path,))
+            cursor.execute("SELECT id FROM duplicates WHERE file_path = %s", (db_path,))
             result = cursor.fetchone()
             if result:
                 duplicate_id = result[0]
 
                 # Update the duplicate ID in files
-                cursor.execute("UPDATE files SET duplicate_id = %s WHERE file_path = %s", (duplicate_id, file_path))
+                cursor.execute("UPDATE files SET duplicate_id = %s WHERE file_path = %s", (duplicate_id, db_path))
 
     # Commit the changes and close the connection
     cnx.commit()
@@ -92,17 +97,23 @@ def add_to_database_bulk_open(cnx):
     cursor = cnx.cursor()
     return cursor
 
-def add_to_database_bulk_add(cnx, cursor, hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date):
+def add_to_database_bulk_add(cnx, cursor, hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date, last_seen=None):
     """
     file_data is a list of tuples, each tuple contains:
     (hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date)
+    last_seen defaults to the current time when not given.
     """
 
+    if last_seen is None:
+        last_seen = datetime.now()
+
+    host_id = registry_database.get_host_id(cnx, hostname, ip_address, os_version)
+
     # Prepare SQL queries
-    insert_query = ("INSERT INTO files (hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date) "
-                    "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+    insert_query = ("INSERT INTO files (host_id, file_path, md5_checksum, file_size, modification_date, last_seen) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)")
 
-    data = (hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date)
+    data = (host_id, registry_paths.path_to_db(file_path), registry_database.md5_to_bin(md5_checksum), file_size, modification_date, last_seen)
 
     # Process each file
     try:
@@ -113,8 +124,9 @@ def add_to_database_bulk_add(cnx, cursor, hostname, ip_address, os_version, file
         print("Data causing error: ", data)
         #logging.error(f"Error occurred during insert: {err}")
         #logging.error(f"Data causing error: {data}")
-        logging.error("Data causing error: ", sanitize_string(file_path))
-        return
+        logging.error("Data causing error: %s", registry_paths.display_path(file_path))
+        return False
+    return True
 
 def add_to_database_bulk_commit(cnx):
     cnx.commit()
@@ -132,7 +144,7 @@ def get_file_paths(cnx):
     try:
         cursor.execute("SELECT file_path FROM files")
         # Fetch all results and extract 'file_path' into a list
-        file_paths = [item[0] for item in cursor.fetchall()]
+        file_paths = [registry_paths.path_from_db(item[0]) for item in cursor.fetchall()]
         return file_paths
     except mysql.connector.Error as err:
         print(f"Error fetching file paths: {err}")
@@ -145,8 +157,7 @@ def get_stored_md5_checksum(file_path):
 
     try:
         md5_checksum = xattr.getxattr(file_path, "user.md5_checksum")
-        safe_file_path = file_path.encode('utf-8', 'replace').decode('utf-8')
-        print("File ", file_count, safe_file_path)
+        print("File ", file_count, registry_paths.display_path(file_path))
         file_count += 1
         return md5_checksum.decode("utf-8")  # Convert bytes to string
     except OSError:
@@ -160,20 +171,27 @@ def optimized_search(all_files, file_paths_list):
     file_count = 0
     for file_path in all_files:
         if file_path in file_paths_set:
-            print("Found match", file_count, file_path)
+            print("Found match", file_count, registry_paths.display_path(file_path))
         else:
-            print("NEW", file_count, file_path)
+            print("NEW", file_count, registry_paths.display_path(file_path))
         file_count += 1
 
     return
 
 
-def scan_directory(cnx, directory_path):
-    # Load excluded directories and files from JSON files
-    with open('excluded_dirs.json') as f:
-        excluded_dirs = set(json.load(f))
-    with open('excluded_files.json') as f:
-        excluded_files = set(json.load(f))
+def scan_directory(cnx, directory_path, likely_deleted_after=registry_status.DEFAULT_LIKELY_DELETED_AFTER, rules=None,
+                   staging_scan_id=None, walk_workers=1):
+    """
+    Register the files under directory_path. With staging_scan_id (a scan_log
+    id), new files are written to that scan's staging table and merged into
+    files at the end instead of being inserted one by one. walk_workers other
+    than 1 lists directories on that many threads (0: the per-mount setting).
+    """
+    # Scan start time, used to tell which registry rows this scan did not see
+    scan_start = datetime.now().replace(microsecond=0)
+
+    # Exclusion rules, from config/exclusions.json or the legacy excluded_*.json lists
+    rules = rules or exclusion_rules.load_rules()
 
     # loading cached database
     print("loading files database to cach")
@@ -183,38 +201,41 @@ def scan_directory(cnx, directory_path):
     # Prepare a list to store all file paths
     print("scaning files...")
     all_files = []
+    # Stat results of a parallel walk, by position in all_files
+    file_stats = []
+    seen_files = []
     print("file_paths len in database", len(file_paths_list))
     file_count = 0
     match_count = 0
     add_count = 0
 
-    enable_exclude_files = True
     enable_match_check = True
 
     # Convert one of the lists (the larger one, ideally) to a set for faster lookup
-    excluded_files_set = set(excluded_files)
     file_paths_set = set(file_paths_list)
 
-    for root, dirs, files in os.walk(directory_path):
-        # Filter out the excluded directories
-        dirs[:] = [d for d in dirs if d not in excluded_dirs]
-
-        for file in files:
-            # Skip the excluded files
-            if enable_exclude_files and file in excluded_files_set:
-                print("skipping", file)
-                continue
-           
+    # Excluded directories are never descended and excluded files never listed
+    if walk_workers == 1:
+        tree = ((root, dirs, [(file, None) for file in files])
+                for root, dirs, files in exclusion_rules.walk(directory_path, rules))
+    else:
+        import parallel_walk
+        tree = ((root, dirs, [(entry.name, parallel_walk.cached_stat(entry)) for entry in entries])
+                for root, dirs, entries in parallel_walk.walk_entries(directory_path, rules, walk_workers or None))
+    for root, dirs, files in tree:
+        for file, stat in files:
             file_count += 1;
 
             file_path = os.path.join(root, file)
             
             if enable_match_check and file_path in file_paths_set:
-                print("found match", file_count, file_path)
+                print("found match", file_count, registry_paths.display_path(file_path))
                 match_count = match_count+1
+                seen_files.append(file_path)
                 continue
 
             all_files.append(file_path)
+            file_stats.append(stat)
             if add_count % 1000 == 0:
                 print("adding file ", add_count, "     ", end='\r')
             add_count = add_count+1
@@ -222,6 +243,12 @@ def scan_directory(cnx, directory_path):
     print("found matching files ", match_count)
     print("file count :", len(all_files))
 
+    hostname = platform.node()
+
+    # Stamp last_seen on every registered path this scan observed
+    print("updating last seen ...")
+    registry_status.mark_files_seen(cnx, hostname, seen_files, scan_start)
+
     # Save the all_files list to a JSON file
     with open('file_tree.json', 'w') as json_file:
         json.dump(all_files, json_file, indent=4)
@@ -229,7 +256,8 @@ def scan_directory(cnx, directory_path):
     #optimized_search(all_files, file_paths_list)
 
         
-    # Initialize tqdm progress bar
+    # Initialize tqdm progress bar, imported here as only full scans need it
+    from tqdm import tqdm
     pbar = tqdm(total=len(all_files), unit="file")
 
 
@@ -237,11 +265,14 @@ def scan_directory(cnx, directory_path):
 
 
     file_count = 0
-    hostname = platform.node()
     ip_address = socket.gethostbyname(hostname)
     os_version = platform.platform()
+    host_id = registry_database.get_host_id(cnx, hostname, ip_address, os_version)
 
-
+    staging = None
+    if staging_scan_id is not None:
+        import scan_staging
+        staging = scan_staging.StagingTable(cnx, staging_scan_id, host_id)
 
 
 
@@ -250,31 +281,47 @@ def scan_directory(cnx, directory_path):
     for i in range(0, len(all_files), batch_size):
         # Create a batch of file data
         batch_files = all_files[i:i + batch_size]
+        batch_stats = file_stats[i:i + batch_size]
 
         cursor = add_to_database_bulk_open(cnx)
+        # New active copies for the content_groups aggregate
+        group_changes = []
 
-        for file_path in batch_files:
+        for file_path, stat in zip(batch_files, batch_stats):
             # Add the batch data to the database
             md5_checksum = get_stored_md5_checksum(file_path)
             if md5_checksum is None :
                 continue
-            safe_file_path = file_path.encode('utf-8', 'replace').decode('utf-8')
-            print("ADDING to DB ", file_count, safe_file_path, md5_checksum)
+            print("ADDING to DB ", file_count, registry_paths.display_path(file_path), md5_checksum)
 
             file_count += 1
 
             # Get the file size and modification date
-            file_size = os.path.getsize(file_path)
-            modification_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(file_path)))
-            add_to_database_bulk_add(cnx, cursor, hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date)
-
+            stat = stat or os.stat(file_path)
+            file_size = stat.st_size
+            modification_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))
+            if staging:
+                staging.add(file_path, md5_checksum, file_size, modification_date, scan_start)
+            elif add_to_database_bulk_add(cnx, cursor, hostname, ip_address, os_version, file_path, md5_checksum, file_size, modification_date, scan_start):
+                group_changes.append((host_id, registry_database.md5_to_bin(md5_checksum), file_size, 1))
+
+        content_groups.apply_changes(cnx, group_changes)
         add_to_database_bulk_commit(cnx)
         add_to_database_bulk_close(cursor)
 
         print(f"Processed batch {i // batch_size + 1}")
 
+    if staging:
+        staged, new, changed = staging.merge("files")
+        print(f"merged {staged} staged files: {new} new, {changed} changed")
+
     print("done adding", len(all_files))
 
+    # Move files this scan did not see to missing / likely_deleted
+    print("reconciling file status ...")
+    summary = registry_status.reconcile_scan(cnx, hostname, directory_path, scan_start, likely_deleted_after)
+    registry_status.print_summary(summary)
+
     return
 
     for file_path in all_files:
@@ -282,7 +329,7 @@ def scan_directory(cnx, directory_path):
         md5_checksum = get_stored_md5_checksum(file_path)
         if md5_checksum is None :
             continue
-        print("ADDING to DB ", file_count, file_path, md5_checksum)
+        print("ADDING to DB ", file_count, registry_paths.display_path(file_path), md5_checksum)
 
         file_count += 1
 
@@ -335,11 +382,13 @@ def log_scan(cnx, directory_path):
         add_log = ("INSERT INTO scan_log "
                    "(directory_path, host_name, host_ip, user_name, date_time_issued) "
                    "VALUES (%s, %s, %s, %s, %s)")
-        data_log = (directory_path, hostname, ip_address, user_name, date_time_issued)
+        data_log = (registry_paths.path_to_db(directory_path), hostname, ip_address, user_name, date_time_issued)
         cursor.execute(add_log, data_log)
         cnx.commit()
+        return cursor.lastrowid
     except mysql.connector.Error as err:
         print(f"Error logging scan: {err}")
+        return None
     finally:
         cursor.close()
 
@@ -347,13 +396,22 @@ def log_scan(cnx, directory_path):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scan a directory and add its files to a MySQL database.')
     parser.add_argument('directory_path', type=str, help='the path to the directory to scan')
+    parser.add_argument('--likely-deleted-after', type=int, default=registry_status.DEFAULT_LIKELY_DELETED_AFTER,
+                        help='number of missed scans before a file is marked likely_deleted')
+    parser.add_argument('--exclusions', type=str, default=None,
+                        help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE} or the legacy excluded_*.json lists)')
+    parser.add_argument('--walk-threads', type=int, default=1,
+                        help='threads listing directories in parallel; 0 uses config/parallel_walk.json (default: 1)')
+    parser.add_argument('--staging', action='store_true',
+                        help='stage new files in a table of this scan and merge them at the end (for concurrent scanners)')
     args = parser.parse_args()
 
 
     cnx = registry_database.get_database_connection()
     if cnx and registry_database.is_connection_valid(cnx):
-        log_scan(cnx, args.directory_path)  # Log the scan details
-        scan_directory(cnx, args.directory_path)  # Assuming scan_directory now also takes cnx as an argument
+        scan_log_id = log_scan(cnx, args.directory_path)  # Log the scan details
+        scan_directory(cnx, args.directory_path, args.likely_deleted_after, exclusion_rules.load_rules(args.exclusions),
+                       scan_log_id if args.staging else None, args.walk_threads)  # Assuming scan_directory now also takes cnx as an argument
         cnx.close()
         print("Done")
     else:
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+File Registry CLI
+-----------------
+One entry point for the registry tools:
+
+    file-registry find shot_010 --snapshot registry.snap
+    file-registry hash /projects --chunks
+    file-registry log trends --format csv
+
+Each subcommand runs the matching tool exactly as if its script had been
+started directly, with the remaining arguments. Only the chosen tool is
+imported, so the database driver, tqdm and xattr are loaded by the commands
+that use them and not by every invocation. `file-registry benchmark` measures
+how long each command takes to start in a fresh interpreter.
+"""
+
+import argparse
+import os
+import runpy
+import sys
+
+# subcommand -> (module, description)
+COMMANDS = {
+    "scan": ("file_registry", "register the files under a directory"),
+    "hash": ("md5_metadata_scanner", "compute and store MD5 checksums"),
+    "find": ("find_in_registry", "search registered paths, or a snapshot offline"),
+    "log": ("file_registry_log", "scan throughput and duration analytics"),
+    "setup": ("setup", "create the configuration and the database"),
+    "status": ("registry_status", "active space under a directory"),
+    "du": ("directory_sizes", "recursive directory sizes and duplicated bytes"),
+    "dupes": ("content_groups", "duplicate content wasting the most space"),
+    "export": ("registry_export", "stream tables to NDJSON/Parquet files and bulk-load them"),
+    "snapshot": ("registry_snapshot", "export or query an offline snapshot"),
+    "filter": ("digest_filter", "export a Bloom filter of the known digests"),
+    "verify-replica": ("verify_replica", "compare a replica with its source"),
+    "archives": ("archive_scanner", "index the members of zip and tar archives"),
+    "extract": ("metadata_extractors", "content metadata extractors and their results"),
+    "chunks": ("content_chunks", "near-duplicate reports from the chunk index"),
+    "scrub": ("integrity_scrub", "throttled re-verification of stored checksums"),
+    "coordinate": ("scan_coordinator", "distributed scans with leased work units"),
+    "walk": ("parallel_walk", "time a parallel directory walk"),
+    "staging": ("scan_staging", "list, merge or drop scan staging tables"),
+    "watch": ("registry_watcher", "apply file changes as they happen"),
+    "serve": ("registry_query_service", "local HTTP search service"),
+    "history": ("metadata_snapshots", "point-in-time metadata and compaction"),
+    "migrate": ("migrate_compact_schema", "online schema migrations"),
+    "sanitizer": ("SanitizerLogLoader", "page through or import a sanitizer report"),
+}
+
+# Startup budget for a command before it does any work, in milliseconds
+STARTUP_BUDGET_MS = 100
+
+TOOL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_command(command, arguments):
+    """Run a tool's command line in this process with the given arguments."""
+    module = COMMANDS[command][0]
+    sys.argv = [f"file-registry {command}", *arguments]
+    if TOOL_DIRECTORY not in sys.path:
+        sys.path.insert(0, TOOL_DIRECTORY)
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+
+def _time_import(module, repeat):
+    """Return (best wall time of a fresh interpreter importing module, best in-process import time) in ms."""
+    import subprocess
+    import time
+
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module}; print((time.perf_counter() - start) * 1000)")
+    best_wall = best_import = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], cwd=TOOL_DIRECTORY,
+                                capture_output=True, text=True)
+        wall = (time.perf_counter() - start) * 1000
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            raise ImportError(lines[-1] if lines else f"{module} failed to import")
+        import_ms = float(result.stdout.strip().splitlines()[-1])
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_import = import_ms if best_import is None else min(best_import, import_ms)
+    return best_wall, best_import
+
+
+def benchmark(commands=None, repeat=5):
+    """Print interpreter start-up and per-command import times."""
+    import subprocess
+    import time
+
+    baseline = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        baseline = elapsed if baseline is None else min(baseline, elapsed)
+    print(f"{'interpreter':<12} {baseline:>8.1f} ms")
+
+    cli_wall, cli_import = _time_import("file_registry_cli", repeat)
+    print(f"{'cli':<12} {cli_wall:>8.1f} ms  (import {cli_import:.1f} ms)")
+
+    for command in commands or COMMANDS:
+        module = COMMANDS[command][0]
+        try:
+            wall, import_ms = _time_import(f"file_registry_cli, {module}", repeat)
+        except ImportError as e:
+            print(f"{command:<12} {'-':>8}     {e}")
+            continue
+        flag = "" if wall < STARTUP_BUDGET_MS else f"  over {STARTUP_BUDGET_MS} ms"
+        print(f"{command:<12} {wall:>8.1f} ms  (import {import_ms:.1f} ms){flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="file-registry",
+        description="File Registry tools. Run `file-registry COMMAND --help` for a command's options.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<12} {description}"
+                                         for name, (_, description) in COMMANDS.items()))
+    parser.add_argument("command", choices=[*COMMANDS, "benchmark"], metavar="COMMAND",
+                        help="tool to run, or benchmark to time command start-up")
+    parser.add_argument("arguments", nargs=argparse.REMAINDER, help="arguments for the command")
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        bench_parser = argparse.ArgumentParser(prog="file-registry benchmark",
+                                               description="Time interpreter start-up and command imports.")
+        bench_parser.add_argument("commands", nargs="*", metavar="COMMAND",
+                                  help="commands to time (default: all)")
+        bench_parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, best is kept (default: 5)")
+        bench_args = bench_parser.parse_args(args.arguments)
+        unknown = [command for command in bench_args.commands if command not in COMMANDS]
+        if unknown:
+            bench_parser.error(f"unknown command: {', '.join(unknown)}")
+        benchmark(bench_args.commands or None, bench_args.repeat)
+        return 0
+
+    run_command(args.command, args.arguments)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,189 @@
 # Andreas Carlen
 # 04/01/2024
 
+"""
+Scan history analytics over scan_log.
+
+    scans   one row per scan with its duration, files, bytes, files/sec and GB/s
+    trends  one row per host and volume: scan count, failures, average duration
+            and throughput over all scans against the recent ones, sorted so the
+            volumes that slowed down the most come first
+
+Rows are computed with SQL aggregates and streamed from the server in batches,
+and can be printed as a table, CSV or JSON lines.
+"""
+
+import argparse
+import csv
+import datetime
+import decimal
+import json
+import sys
+
+import mysql.connector
+
 import registry_database
+import registry_paths
 
-cnx = registry_database.get_database_connection()
+DEFAULT_LIMIT = 100
+DEFAULT_RECENT_DAYS = 7
+FETCH_SIZE = 500
 
-def read_and_print_log(cnx):
-    cursor = cnx.cursor()
+# Versions written by the scan s; with delta storage this is the changed files
+# only, used as the file count of scans logged before files_scanned was
+# recorded. Correlated so only the selected scans are counted, through
+# idx_metadata_scan; inside COALESCE they only run where the column is NULL.
+VERSIONS = "(SELECT COUNT(*) FROM file_metadata m WHERE m.scan_log_id = s.id)"
+VERSION_BYTES = "(SELECT SUM(m.file_size) FROM file_metadata m WHERE m.scan_log_id = s.id)"
 
-    try:
-        query = "SELECT * FROM scan_log"
-        cursor.execute(query)
-
-        # Fetch all the rows in the result set
-        rows = cursor.fetchall()
-
-        # Print the log entries
-        for row in rows:
-            print(f"Directory Path: {row[1]}, Host Name: {row[2]}, Host IP: {row[3]}, User Name: {row[4]}, Date and Time Issued: {row[5]}")
-            #print("id", row[0])
-            #print("path", row[1])
-            #print("host", row[2])
-            #print("ip", row[3])
-            #print("user ", row[4])
-            #print("Date ", row[5])
-        #print(rows)
-    except mysql.connector.Error as err:
-        print(f"Error reading log: {err}")
+SCAN_COLUMNS = ("id", "host", "directory_path", "scan_type", "status", "scan_start_time",
+                "duration", "files", "bytes", "changed_files", "files_per_sec", "gb_per_sec")
 
+# Completed with the conditions and LIMIT of the inner scan_log query
+SCAN_SELECT = (
+    "SELECT id, host_name, directory_path, scan_type, status, scan_start_time, scan_duration, "
+    "COALESCE(files_scanned, changed_files, 0) AS files, bytes, changed_files, "
+    "COALESCE(files_scanned, changed_files, 0) / NULLIF(scan_duration, 0) AS files_per_sec, "
+    "bytes / NULLIF(scan_duration, 0) / 1e9 AS gb_per_sec "
+    "FROM (SELECT s.id, s.host_name, s.directory_path, s.scan_type, s.status, s.scan_start_time, "
+    f"s.scan_duration, s.files_scanned, COALESCE(s.bytes_scanned, {VERSION_BYTES}, 0) AS bytes, "
+    f"{VERSIONS} AS changed_files "
+    "FROM scan_log s WHERE {conditions} ORDER BY s.id LIMIT %s) s ORDER BY id")
+
+TREND_COLUMNS = ("host", "directory_path", "scans", "failed", "last_scan", "avg_duration",
+                 "avg_files_per_sec", "recent_files_per_sec", "avg_gb_per_sec", "recent_gb_per_sec",
+                 "throughput_ratio")
+
+
+def _filters(host=None, path=None, status=None, since=None):
+    conditions = []
+    args = []
+    if host:
+        conditions.append("s.host_name = %s")
+        args.append(host)
+    if path:
+        conditions.append("(s.directory_path = %s OR s.directory_path LIKE %s)")
+        args += [registry_paths.path_to_db(path), registry_paths.prefix_pattern(path)]
+    if status:
+        conditions.append("s.status = %s")
+        args.append(status)
+    if since:
+        conditions.append("s.scan_start_time >= %s")
+        args.append(since)
+    return conditions, args
+
+
+def _stream(cnx, query, args):
+    """Run query on an unbuffered cursor and yield rows as the server sends them."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
     finally:
         cursor.close()
 
-read_and_print_log(cnx)
+
+def scan_throughput(cnx, host=None, path=None, status=None, since=None, after=0, limit=DEFAULT_LIMIT):
+    """Yield per-scan throughput rows with an id greater than after, oldest first."""
+    conditions, args = _filters(host, path, status, since)
+    conditions.insert(0, "s.id > %s")
+    query = SCAN_SELECT.format(conditions=" AND ".join(conditions))
+    for row in _stream(cnx, query, [after, *args, limit]):
+        yield row
+
+
+def volume_trends(cnx, host=None, path=None, since=None, recent_days=DEFAULT_RECENT_DAYS, limit=DEFAULT_LIMIT):
+    """
+    Yield per host and volume aggregates. Throughput is averaged over completed
+    scans; throughput_ratio is the recent average over the overall one, so
+    values below 1 are volumes that have become slower to scan.
+    """
+    conditions, args = _filters(host, path, None, since)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = (
+        "SELECT host_name, directory_path, COUNT(*) AS scans, SUM(status = 'failed') AS failed, "
+        "MAX(scan_start_time) AS last_scan, AVG(scan_duration) AS avg_duration, "
+        "AVG(CASE WHEN is_completed THEN files_per_sec END) AS avg_files_per_sec, "
+        "AVG(CASE WHEN is_completed AND is_recent THEN files_per_sec END) AS recent_files_per_sec, "
+        "AVG(CASE WHEN is_completed THEN gb_per_sec END) AS avg_gb_per_sec, "
+        "AVG(CASE WHEN is_completed AND is_recent THEN gb_per_sec END) AS recent_gb_per_sec, "
+        "AVG(CASE WHEN is_completed AND is_recent THEN files_per_sec END) / "
+        "NULLIF(AVG(CASE WHEN is_completed THEN files_per_sec END), 0) AS throughput_ratio "
+        "FROM (SELECT s.host_name, s.directory_path, s.status, s.scan_start_time, s.scan_duration, "
+        f"COALESCE(s.files_scanned, {VERSIONS}, 0) / NULLIF(s.scan_duration, 0) AS files_per_sec, "
+        f"COALESCE(s.bytes_scanned, {VERSION_BYTES}, 0) / NULLIF(s.scan_duration, 0) / 1e9 AS gb_per_sec, "
+        "s.status = 'completed' AS is_completed, s.scan_start_time >= NOW() - INTERVAL %s DAY AS is_recent "
+        f"FROM scan_log s {where}) scans "
+        "GROUP BY host_name, directory_path "
+        "ORDER BY throughput_ratio IS NULL, throughput_ratio, failed DESC LIMIT %s")
+    for row in _stream(cnx, query, [recent_days, *args, limit]):
+        yield row
+
+
+def _value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return registry_paths.display_path(value)
+    return value
+
+
+def write_rows(rows, columns, output_format="table", out=sys.stdout):
+    """Write rows as a plain table, CSV or JSON lines. Returns the row count."""
+    count = 0
+    writer = csv.writer(out) if output_format == "csv" else None
+    if writer:
+        writer.writerow(columns)
+    elif output_format == "table":
+        print("  ".join(columns), file=out)
+
+    for row in rows:
+        values = [_value(v) for v in row]
+        if output_format == "json":
+            out.write(json.dumps(dict(zip(columns, values))) + "\n")
+        elif writer:
+            writer.writerow(values)
+        else:
+            print("  ".join(f"{v:.2f}" if isinstance(v, float) else str(v) for v in values), file=out)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report scan throughput, duration trends and failing scans from scan_log.')
+    parser.add_argument('report', nargs='?', choices=['scans', 'trends'], default='scans',
+                        help='per-scan rows or per host/volume trends (default: scans)')
+    parser.add_argument('--host', type=str, default=None, help='only scans from this host')
+    parser.add_argument('--path', type=str, default=None, help='only scans of this directory or below it')
+    parser.add_argument('--status', type=str, default=None,
+                        help='only scans with this status, e.g. failed or in-progress (scans report)')
+    parser.add_argument('--since', type=str, default=None, help='only scans started on or after this date')
+    parser.add_argument('--recent-days', type=int, default=DEFAULT_RECENT_DAYS,
+                        help=f'window compared against the overall average (trends report, default: {DEFAULT_RECENT_DAYS})')
+    parser.add_argument('--after', type=int, default=0, help='continue after this scan id (scans report)')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help=f'maximum rows (default: {DEFAULT_LIMIT})')
+    parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help='output format')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        try:
+            if args.report == 'scans':
+                rows = scan_throughput(cnx, args.host, args.path, args.status, args.since, args.after, args.limit)
+                columns = SCAN_COLUMNS
+            else:
+                rows = volume_trends(cnx, args.host, args.path, args.since, args.recent_days, args.limit)
+                columns = TREND_COLUMNS
+            write_rows(rows, columns, args.format)
+        except mysql.connector.Error as err:
+            print(f"Error reading log: {err}")
+        finally:
+            cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
@@ -1,17 +1,16 @@
-import os
-import mysql.connector
-import platform
-import hashlib
 import json
-import time
 import argparse
-import socket
-from tqdm import tqdm
-import getpass
-from datetime import datetime
+import importlib.util
+import registry_paths
+
+# The database is not needed to search a snapshot, so the driver is only
+# imported once a connection is made
+DB_AVAILABLE = importlib.util.find_spec("mysql") is not None
 
 
 def get_database_connection():
+    import mysql.connector
+
     # Load the credentials from the JSON file
     with open('credentials.json') as f:
         credentials = json.load(f)
@@ -39,10 +38,12 @@ def is_connection_valid(cnx):
 
 
 def search_file_path_substring_in_database(cnx, search_substring):
+    import mysql.connector
+
     cursor = cnx.cursor()
     try:
-        query = "SELECT EXISTS(SELECT 1 FROM files WHERE file_path LIKE %s)"
-        search_pattern = "%" + search_substring + "%"
+        query = f"SELECT EXISTS(SELECT 1 FROM files WHERE {registry_paths.like_ignore_case('file_path')})"
+        search_pattern = b"%" + registry_paths.path_to_db(search_substring) + b"%"
         cursor.execute(query, (search_pattern,))
         result = cursor.fetchone()
         return result[0] == 1
@@ -53,40 +54,56 @@ def search_file_path_substring_in_database(cnx, search_substring):
         cursor.close()
 
 def find_file_paths_by_substring(cnx, search_substring):
+    import mysql.connector
+
     cursor = cnx.cursor()
     try:
-        query = "SELECT file_path FROM files WHERE file_path LIKE %s"
-        search_pattern = "%" + search_substring + "%"
+        query = f"SELECT file_path FROM files WHERE {registry_paths.like_ignore_case('file_path')}"
+        search_pattern = b"%" + registry_paths.path_to_db(search_substring) + b"%"
         cursor.execute(query, (search_pattern,))
         results = cursor.fetchall()
-        return [result[0] for result in results] if results else []
+        return [registry_paths.path_from_db(result[0]) for result in results] if results else []
     except mysql.connector.Error as err:
         print(f"Error searching for file path substring: {err}")
         return []
     finally:
         cursor.close()
 
+def find_file_paths_in_snapshot(snapshot_path, search_substring):
+    import registry_snapshot
+
+    with registry_snapshot.RegistrySnapshot(snapshot_path) as snapshot:
+        return [entry[0] for entry in snapshot.search(search_substring)]
+
+
+def print_matches(search, matching_file_paths):
+    if matching_file_paths:
+        print(f"Found file paths containing '{search}':")
+        for path in matching_file_paths:
+            print(registry_paths.display_path(path))
+        print("Found matching file_path count :",len(matching_file_paths))
+    else:
+        print(f"No file paths containing '{search}' found in the database.")
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Scan a directory and add its files to a MySQL database. Optionally, search for a file path substring.')
     parser.add_argument('search', type=str, help='substring to search in file paths')
+    parser.add_argument('--snapshot', type=str, default=None,
+                        help='search this registry snapshot (see registry_snapshot.py) instead of the database')
     args = parser.parse_args()
 
-    cnx = get_database_connection()
-    if cnx and is_connection_valid(cnx):
-        if args.search:
-            # Perform the search operation
-            matching_file_paths = find_file_paths_by_substring(cnx, args.search)
-            if matching_file_paths:
-                print(f"Found file paths containing '{args.search}':")
-                for path in matching_file_paths:
-                    print(path)
-                print("Found matching file_path count :",len(matching_file_paths))
-            else:
-                print(f"No file paths containing '{args.search}' found in the database.")
-
-        cnx.close()
+    if args.snapshot:
+        print_matches(args.search, find_file_paths_in_snapshot(args.snapshot, args.search))
+    elif not DB_AVAILABLE:
+        print("mysql-connector-python is not installed; use --snapshot to search offline.")
     else:
-        print("Database connection failed or timed out.")
-
-
+        cnx = get_database_connection()
+        if cnx and is_connection_valid(cnx):
+            if args.search:
+                # Perform the search operation
+                print_matches(args.search, find_file_paths_by_substring(cnx, args.search))
 
+            cnx.close()
+        else:
+            print("Database connection failed or timed out.")
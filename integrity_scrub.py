@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Integrity Scrub
+---------------
+Background re-verification of stored MD5 checksums against the content on
+disk, to catch silent corruption. Reads are paced by token buckets for MB/s
+and IOPS and only happen inside the configured time windows, and the files
+verified longest ago (or never) are checked first, so a scrub can run
+continuously without competing with foreground users.
+
+Checksums come from file_metadata (last_verified is tracked per version) or
+from the user.md5_checksum xattr (last_verified kept in user.md5_verified).
+A file whose size and modification time still match its record but whose
+content does not is reported as a mismatch and recorded in file_history.
+An xattr checksum that differs from content modified after its last
+verification is rewritten. Without a verification stamp a difference cannot
+be told apart from corruption: it is reported as unverified, recorded as a
+verify_unconfirmed event and the xattr is left alone.
+"""
+
+import argparse
+import datetime
+import hashlib
+import heapq
+import os
+import platform
+import time
+
+import page_cache
+import registry_paths
+
+try:
+    import registry_database
+    DB_AVAILABLE = True
+except ImportError:
+    DB_AVAILABLE = False
+
+# Bytes read per request; each request costs one IOPS token
+READ_SIZE = 1024 * 1024
+
+# Files fetched from the database per batch
+DEFAULT_BATCH_SIZE = 500
+
+# Files verified more recently than this are not due yet
+DEFAULT_CYCLE_DAYS = 30
+
+# Seconds to sleep in continuous mode when nothing is due
+IDLE_SLEEP = 300
+
+XATTR_CHECKSUM = "user.md5_checksum"
+XATTR_VERIFIED = "user.md5_verified"
+
+
+class TokenBucket:
+    """Allow `rate` units per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount):
+        """Take amount tokens, sleeping until enough have accumulated."""
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Requests larger than the bucket go through once it is full
+            if self.tokens >= min(amount, self.capacity):
+                self.tokens -= amount
+                return
+            time.sleep((min(amount, self.capacity) - self.tokens) / self.rate)
+
+
+def parse_window(text):
+    """Parse 'HH:MM-HH:MM' into a (start, end) pair of datetime.time. Windows may cross midnight."""
+    start, end = text.split("-")
+    return (datetime.datetime.strptime(start.strip(), "%H:%M").time(),
+            datetime.datetime.strptime(end.strip(), "%H:%M").time())
+
+
+def in_window(windows, now=None):
+    if not windows:
+        return True
+    now = (now or datetime.datetime.now()).time()
+    for start, end in windows:
+        if start <= end:
+            if start <= now < end:
+                return True
+        elif now >= start or now < end:
+            return True
+    return False
+
+
+def seconds_until_window(windows, now=None):
+    """Seconds until the next window opens, 0 if one is open now."""
+    now = now or datetime.datetime.now()
+    if in_window(windows, now):
+        return 0
+    waits = []
+    for start, _ in windows:
+        opening = datetime.datetime.combine(now.date(), start)
+        if opening <= now:
+            opening += datetime.timedelta(days=1)
+        waits.append((opening - now).total_seconds())
+    return min(waits)
+
+
+class Throttle:
+    """Paces reads by MB/s and IOPS and holds them outside the time windows."""
+
+    def __init__(self, mb_per_sec=None, iops=None, windows=None):
+        self.bytes = TokenBucket(mb_per_sec * 1024 * 1024 if mb_per_sec else None)
+        self.ops = TokenBucket(iops)
+        self.windows = windows or []
+
+    def wait_for_window(self):
+        wait = seconds_until_window(self.windows)
+        if wait:
+            print(f"Outside the scrub window, sleeping {wait / 60:.0f} minutes")
+            time.sleep(wait)
+
+    def before_read(self):
+        """Wait for the window and an IOPS token before issuing a read request."""
+        if self.windows and not in_window(self.windows):
+            self.wait_for_window()
+        self.ops.consume(1)
+
+    def after_read(self, nbytes):
+        """Pay for the bytes a read returned."""
+        self.bytes.consume(nbytes)
+
+
+def hash_file(file_path, throttle):
+    """MD5 of a file read at the throttle's pace, dropped from the page cache as it goes."""
+    hash_md5 = hashlib.md5()
+    # Scrub reads would otherwise push foreground data out of the cache
+    with page_cache.BlockReader(file_path, "dontneed", block_size=READ_SIZE) as reader:
+        while True:
+            throttle.before_read()
+            chunk = reader.read()
+            if not chunk:
+                break
+            throttle.after_read(len(chunk))
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def _format_date(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if hasattr(value, 'strftime') else value
+
+
+def verify_file(file_path, md5_checksum, throttle, file_size=None, modification_date=None):
+    """
+    Re-hash a file and compare it with its stored checksum. Returns one of
+    'ok', 'mismatch', 'changed' (size or mtime differ from the record, so the
+    checksum is stale rather than wrong), 'missing' or 'error', and the digest.
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return 'missing', None
+    except OSError:
+        return 'error', None
+
+    mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))
+    if (file_size is not None and stat.st_size != file_size) or \
+            (modification_date is not None and mtime != _format_date(modification_date)):
+        return 'changed', None
+
+    try:
+        actual = hash_file(file_path, throttle)
+    except OSError as e:
+        print(f"Could not read {registry_paths.display_path(file_path)}: {e}")
+        return 'error', None
+    return ('ok' if actual == md5_checksum else 'mismatch'), actual
+
+
+def record_mismatch(cnx, host_id, file_path, expected, actual, event_type='verify_failed'):
+    """Add a verify_failed (or another event_type) event to file_history. Does not commit."""
+    db_path = registry_paths.path_to_db(file_path)
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT id FROM files WHERE host_id = %s AND file_path = %s", (host_id, db_path))
+        row = cursor.fetchone()
+        cursor.execute(
+            "INSERT INTO file_history (file_id, event_type, old_md5, new_md5, old_path) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            (row[0] if row else None, event_type, registry_database.md5_to_bin(expected),
+             registry_database.md5_to_bin(actual), db_path))
+    finally:
+        cursor.close()
+
+
+def _report(results, outcome, file_path, expected=None, actual=None):
+    results[outcome] = results.get(outcome, 0) + 1
+    if outcome == 'mismatch':
+        print(f"MISMATCH {registry_paths.display_path(file_path)}: stored {expected}, on disk {actual}")
+    elif outcome == 'unverified':
+        print(f"UNVERIFIED {registry_paths.display_path(file_path)}: stored {expected}, on disk {actual}, "
+              f"never verified, so modification and corruption cannot be told apart")
+
+
+def scrub_database(cnx, throttle, path_prefix=None, hostname=None, cycle_days=DEFAULT_CYCLE_DAYS,
+                   batch_size=DEFAULT_BATCH_SIZE, max_files=None):
+    """
+    Verify current file_metadata versions of this host that are due, least
+    recently verified first. Returns a dict of outcome counts.
+    """
+    results = {}
+    host_id = registry_database.get_host_id(cnx, hostname or platform.node(), create=False)
+    if host_id is None:
+        return results
+
+    query = ("SELECT id, file_path, md5_checksum, file_size, modification_date FROM file_metadata "
+             "WHERE host_id = %s AND valid_to_scan_id IS NULL "
+             "AND (last_verified IS NULL OR last_verified < %s)")
+    if path_prefix:
+        query += " AND file_path LIKE %s"
+    query += " ORDER BY last_verified LIMIT %s"
+
+    verified = 0
+    while max_files is None or verified < max_files:
+        due_before = datetime.datetime.now() - datetime.timedelta(days=cycle_days)
+        args = [host_id, due_before]
+        if path_prefix:
+            args.append(registry_paths.prefix_pattern(path_prefix))
+        limit = batch_size if max_files is None else min(batch_size, max_files - verified)
+        args.append(limit)
+
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(query, args)
+            batch = cursor.fetchall()
+        finally:
+            cursor.close()
+        if not batch:
+            break
+
+        checked = []
+        for version_id, file_path, md5_digest, file_size, modification_date in batch:
+            file_path = registry_paths.path_from_db(file_path)
+            expected = registry_database.bin_to_hex(md5_digest)
+            outcome, actual = verify_file(file_path, expected, throttle, file_size, modification_date)
+            _report(results, outcome, file_path, expected, actual)
+            if outcome == 'mismatch':
+                record_mismatch(cnx, host_id, file_path, expected, actual)
+            checked.append(version_id)
+
+        # Stamp every checked version, including stale ones, so the queue keeps moving
+        cursor = cnx.cursor()
+        try:
+            placeholders = ", ".join(["%s"] * len(checked))
+            cursor.execute(f"UPDATE file_metadata SET last_verified = NOW() WHERE id IN ({placeholders})", checked)
+            cnx.commit()
+        finally:
+            cursor.close()
+        verified += len(checked)
+
+    return results
+
+
+def _xattr_time(file_path):
+    try:
+        return float(os.getxattr(file_path, XATTR_VERIFIED))
+    except (OSError, ValueError):
+        return 0.0
+
+
+def scrub_xattr(directory_path, throttle, cycle_days=DEFAULT_CYCLE_DAYS, max_files=None, cnx=None):
+    """
+    Verify files under directory_path against their user.md5_checksum xattr,
+    least recently verified first. Mismatches and unverified differences go
+    to file_history when cnx is given. Returns a dict of outcome counts.
+    """
+    due_before = time.time() - cycle_days * 86400
+    candidates = []
+    for root, dirs, files in os.walk(directory_path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            try:
+                expected = os.getxattr(file_path, XATTR_CHECKSUM).decode('utf-8')
+            except OSError:
+                continue
+            verified_at = _xattr_time(file_path)
+            if verified_at < due_before:
+                candidates.append((verified_at, file_path, expected))
+    if max_files is not None:
+        candidates = heapq.nsmallest(max_files, candidates)
+    else:
+        candidates.sort()
+
+    host_id = None
+    if cnx:
+        host_id = registry_database.get_host_id(cnx, platform.node())
+
+    results = {}
+    for verified_at, file_path, expected in candidates:
+        try:
+            modified = os.stat(file_path).st_mtime
+        except OSError:
+            _report(results, 'missing', file_path)
+            continue
+        hashed_at = time.time()
+        outcome, actual = verify_file(file_path, expected, throttle)
+        # user.md5_verified records when the checksum last matched the content.
+        # Content modified after that is a legitimate change, content not
+        # modified since is corrupt, and without a stamp there is no telling
+        if outcome == 'mismatch' and not verified_at:
+            outcome = 'unverified'
+        elif outcome == 'mismatch' and modified > verified_at:
+            try:
+                os.setxattr(file_path, XATTR_CHECKSUM, actual.encode('utf-8'))
+                outcome = 'changed'
+            except OSError as e:
+                print(f"Could not update the checksum of {registry_paths.display_path(file_path)}: {e}")
+                outcome = 'error'
+        _report(results, outcome, file_path, expected, actual)
+        if outcome in ('mismatch', 'unverified') and cnx:
+            record_mismatch(cnx, host_id, file_path, expected, actual,
+                            'verify_failed' if outcome == 'mismatch' else 'verify_unconfirmed')
+            cnx.commit()
+        if outcome in ('ok', 'changed'):
+            try:
+                os.setxattr(file_path, XATTR_VERIFIED, str(hashed_at).encode('ascii'))
+            except OSError:
+                pass
+    return results
+
+
+def print_results(results):
+    total = sum(results.values())
+    print(f"Verified {total} files: " + ", ".join(f"{count} {outcome}" for outcome, count in sorted(results.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-verify stored MD5 checksums against disk content at a limited rate.')
+    parser.add_argument('path', type=str, nargs='?', default=None,
+                        help='directory to scrub (required for the xattr source)')
+    parser.add_argument('--source', choices=['database', 'xattr'], default='database',
+                        help='where the stored checksums come from (default: database)')
+    parser.add_argument('--mb-per-sec', type=float, default=50, help='read bandwidth limit in MB/s (default: 50, 0 for none)')
+    parser.add_argument('--iops', type=float, default=200, help='read requests per second limit (default: 200, 0 for none)')
+    parser.add_argument('--window', action='append', type=parse_window, default=[],
+                        help='only read during HH:MM-HH:MM local time; may be repeated')
+    parser.add_argument('--cycle-days', type=float, default=DEFAULT_CYCLE_DAYS,
+                        help=f're-verify files after this many days (default: {DEFAULT_CYCLE_DAYS})')
+    parser.add_argument('--max-files', type=int, default=None, help='stop after verifying this many files')
+    parser.add_argument('--host', type=str, default=None, help='host whose files to verify (database source, default: this host)')
+    parser.add_argument('--continuous', action='store_true', help='keep scrubbing as files become due')
+    args = parser.parse_args()
+
+    if args.source == 'xattr' and not args.path:
+        parser.error("the xattr source needs a path")
+
+    throttle = Throttle(args.mb_per_sec, args.iops, args.window)
+
+    cnx = None
+    if DB_AVAILABLE:
+        cnx = registry_database.get_database_connection()
+        if not (cnx and registry_database.is_connection_valid(cnx)):
+            cnx = None
+    if cnx is None:
+        if args.source == 'database':
+            print("Failed to connect to the database or connection timed out.")
+            exit(1)
+        print("No database connection: mismatches will only be printed.")
+
+    try:
+        while True:
+            throttle.wait_for_window()
+            if args.source == 'database':
+                results = scrub_database(cnx, throttle, args.path, args.host, args.cycle_days,
+                                         max_files=args.max_files)
+            else:
+                results = scrub_xattr(args.path, throttle, args.cycle_days, args.max_files, cnx)
+            print_results(results)
+            if not args.continuous:
+                break
+            if not results:
+                time.sleep(IDLE_SLEEP)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cnx:
+            cnx.close()
@@ -4,24 +4,27 @@ import socket
 import getpass
 from datetime import datetime
 
+import registry_paths
+
 try:
     import mysql.connector
     DB_AVAILABLE = True
 except ImportError:
     DB_AVAILABLE = False
 
-def log_scan(cnx, directory_path):
+def log_scan(cnx, directory_path, scan_type='full'):
     hostname = platform.node()
     ip_address = socket.gethostbyname(hostname)
+    os_version = platform.platform()
     user_name = getpass.getuser()
     date_time_issued = datetime.now()
 
     cursor = cnx.cursor()
     try:
         add_log = ("INSERT INTO scan_log "
-                   "(directory_path, host_name, host_ip, user_name, date_time_issued) "
-                   "VALUES (%s, %s, %s, %s, %s)")
-        data_log = (directory_path, hostname, ip_address, user_name, date_time_issued)
+                   "(directory_path, host_name, host_ip, os_version, user_name, date_time_issued, scan_type, scan_start_time) "
+                   "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
+        data_log = (registry_paths.path_to_db(directory_path), hostname, ip_address, os_version, user_name, date_time_issued, scan_type, date_time_issued)
         cursor.execute(add_log, data_log)
         cnx.commit()
         inserted_id = cursor.lastrowid  # get the auto-incremented ID
@@ -30,4 +33,38 @@ def log_scan(cnx, directory_path):
         print(f"Error logging scan: {err}")
         return None
     finally:
-        cursor.close()
\ No newline at end of file
+        cursor.close()
+
+def finish_scan(cnx, scan_log_id, status='completed', files_scanned=None, bytes_scanned=None):
+    """Record the end time, duration, final status and file/byte totals of a logged scan."""
+    scan_end_time = datetime.now()
+
+    cursor = cnx.cursor()
+    try:
+        update_log = ("UPDATE scan_log "
+                      "SET status = %s, scan_end_time = %s, "
+                      "scan_duration = TIMESTAMPDIFF(SECOND, scan_start_time, %s), "
+                      "files_scanned = COALESCE(%s, files_scanned), bytes_scanned = COALESCE(%s, bytes_scanned) "
+                      "WHERE id = %s")
+        cursor.execute(update_log, (status, scan_end_time, scan_end_time, files_scanned, bytes_scanned, scan_log_id))
+        cnx.commit()
+        return True
+    except mysql.connector.Error as err:
+        print(f"Error finishing scan log: {err}")
+        return False
+    finally:
+        cursor.close()
+
+def touch_scan(cnx, scan_log_id, files_scanned=0):
+    """
+    Record progress of a running scan: move scan_end_time to now and add
+    files_scanned to its count. Not committed, so it becomes visible together
+    with the changes it reports; readers such as the query service's cache
+    treat the touch as a change to the registry.
+    """
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("UPDATE scan_log SET scan_end_time = %s, files_scanned = COALESCE(files_scanned, 0) + %s "
+                       "WHERE id = %s", (datetime.now(), files_scanned, scan_log_id))
+    finally:
+        cursor.close()
@@ -13,8 +13,11 @@ import time
 import json
 import socket
 import platform
-from tqdm import tqdm
+import exclusion_rules
 import log_scan
+import page_cache
+import registry_paths
+import sanitizer_report
 
 # For xattr support
 try:
@@ -26,6 +29,9 @@ except ImportError:
 # For database support
 try:
     import mysql.connector
+    import content_chunks
+    import directory_sizes
+    import metadata_snapshots
     DB_AVAILABLE = True
 except ImportError:
     DB_AVAILABLE = False
@@ -35,9 +41,25 @@ file_count = 0
 folder_count = 0
 very_verbose = False
 
-# List of folder names to skip
-folders_to_skip = [".git", ".gitold", ".snapshots", ".snapshot", "SNAPSHOTS", "snapshot"]
-files_to_skip = ["._.DS_Store", ".DS_Store", ".localized", ".Spotlight-V100", ".Trashes", ".fseventsd", ".local", ".kde"]
+# Build content-defined chunk manifests while hashing (database storage only)
+chunk_files = False
+
+# How hashing reads interact with the page cache (see page_cache.MODES), and
+# a page_cache.CacheStats to collect residency statistics in, if any
+cache_mode = "normal"
+cache_stats = None
+
+# Threads listing directories (see parallel_walk); 1 walks in this thread
+walk_workers = 1
+
+# A metadata_extractors.ExtractionPool fed with every file's MD5, if any
+extraction = None
+
+# A scan_staging.StagingTable that versions are written to instead of file_metadata, if any
+staging = None
+
+# A digest_filter.KnownContent classifying files as new or already registered, if any
+known_content = None
 
 # Error logging
 errors = []
@@ -71,15 +93,23 @@ def is_connection_valid(cnx):
     except:
         return False
 
-def md5(fname):
-    """Calculate MD5 hash of a file, handling errors gracefully."""
+def md5(fname, chunker=None, chunks=None):
+    """
+    Calculate MD5 hash of a file, handling errors gracefully. With a chunker,
+    the content-defined chunks found in the same read pass are added to chunks.
+    Reads follow cache_mode.
+    """
     global errors, error_log_json, error_log_txt
     
     hash_md5 = hashlib.md5()
     try:
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+        with page_cache.BlockReader(fname, cache_mode, cache_stats) as reader:
+            for chunk in iter(reader.read, b""):
                 hash_md5.update(chunk)
+                if chunker:
+                    chunks.extend(chunker.update(chunk))
+        if chunker:
+            chunks.extend(chunker.finish())
         return hash_md5.hexdigest()
     except OSError as e:
         # Log error
@@ -91,7 +121,7 @@ def md5(fname):
         with open(error_log_json, 'w') as f:
             json.dump(errors, f)
         with open(error_log_txt, 'a') as f:
-            f.write(f'Error occurred at {time.ctime(time.time())} while processing {fname}. Error message: {str(e)}\n')
+            f.write(f'Error occurred at {time.ctime(time.time())} while processing {registry_paths.display_path(fname)}. Error message: {str(e)}\n')
         print(f"Exception occurred: {str(e)}")
         return ""
 
@@ -103,10 +133,12 @@ def store_md5_xattr(file_path, md5_checksum):
     try:
         byte_obj = bytes("user.md5_checksum", 'utf-8')
         os.setxattr(file_path, byte_obj, bytes(md5_checksum, 'utf-8'))
+        # When the checksum was taken; integrity_scrub trusts it only for content not modified since
+        os.setxattr(file_path, b"user.md5_verified", str(time.time()).encode('ascii'))
         return True
     except OSError as e:
         with open(error_log_txt, 'a') as f:
-            f.write(f'Error storing xattr at {time.ctime(time.time())} for {file_path}. Error: {str(e)}\n')
+            f.write(f'Error storing xattr at {time.ctime(time.time())} for {registry_paths.display_path(file_path)}. Error: {str(e)}\n')
         print(f"Could not store MD5 checksum in xattr: {str(e)}")
         return False
 
@@ -118,68 +150,53 @@ def check_existing_xattr(file_path):
     except:
         return None
 
-def store_md5_database(cnx, file_path, md5_checksum, scan_log_id):
-    """Store MD5 checksum in the database."""
+def store_md5_database(cnx, file_path, md5_checksum, scan_log_id, stat=None):
+    """
+    Store MD5 checksum in the database, writing a new version only if the file
+    changed. stat, if given, supplies the size and modification time.
+    """
     if not md5_checksum:
         return False
         
     try:
         # Get file metadata
-        file_size = os.path.getsize(file_path)
-        modification_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(file_path)))
-        scan_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
-        
-        # Calculate file path hash for uniqueness
-        file_path_hash = hashlib.md5(file_path.encode()).hexdigest()
+        stat = stat or os.stat(file_path)
+        file_size = stat.st_size
+        modification_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))
         
-        cursor = cnx.cursor()
-        
-        # Insert or update the MD5 metadata
-        query = """
-            INSERT INTO file_metadata
-            (file_path, md5_checksum, file_size, modification_date, scan_date, file_path_hash, scan_log_id)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-            md5_checksum = %s,
-            file_size = %s,
-            modification_date = %s,
-            scan_date = %s,
-            scan_log_id = %s
-        """
-        cursor.execute(query, (
-            file_path, md5_checksum, file_size, modification_date, scan_date, file_path_hash, scan_log_id,
-            md5_checksum, file_size, modification_date, scan_date, scan_log_id
-        ))
-        
-        cursor.close()
+        if staging:
+            staging.add(file_path, md5_checksum, file_size, modification_date)
+        else:
+            metadata_snapshots.store_version(cnx, file_path, md5_checksum, file_size, modification_date, scan_log_id)
         return True
     except Exception as e:
         with open(error_log_txt, 'a') as f:
-            f.write(f'Database error at {time.ctime(time.time())} for {file_path}. Error: {str(e)}\n')
+            f.write(f'Database error at {time.ctime(time.time())} for {registry_paths.display_path(file_path)}. Error: {str(e)}\n')
         print(f"Database error: {str(e)}")
         return False
 
-def check_existing_database(cnx, file_path):
+def check_existing_database(cnx, file_path, stat=None):
     """Check if metadata already exists in database."""
     cursor = cnx.cursor()
     try:
         # Get file path hash
-        file_path_hash = hashlib.md5(file_path.encode()).hexdigest()
+        file_path_hash = registry_paths.path_hash(file_path)
         
         # Check if file exists with up-to-date modification time
-        mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(file_path)))
+        modified = stat.st_mtime if stat else os.path.getmtime(file_path)
+        mtime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modified))
         
-        # Query by hash (faster)
+        # Query the current version by hash (faster)
         query = """
             SELECT md5_checksum 
             FROM file_metadata 
-            WHERE file_path_hash = %s AND modification_date = %s
+            WHERE file_path_hash = %s AND valid_to_scan_id IS NULL AND modification_date = %s
         """
         cursor.execute(query, (file_path_hash, mtime))
         result = cursor.fetchone()
         
         if result:
-            return result[0]
+            return bytes(result[0]).hex()
         return None
     except Exception as e:
         if very_verbose:
@@ -188,55 +205,88 @@ def check_existing_database(cnx, file_path):
     finally:
         cursor.close()
 
-def process_file(cnx, file_path, storage_mode, scan_idx):
-    """Process a single file - calculate and store MD5."""
+def classify_content(file_path, md5_checksum, stat=None):
+    """Check a file's content against the known-digest filter, if one is loaded."""
+    try:
+        result = known_content.check(file_path, md5_checksum, stat.st_size if stat else os.path.getsize(file_path))
+    except OSError:
+        return
+    if very_verbose:
+        print(f"[FILTER] {result}: {registry_paths.display_path(file_path)}")
+
+def process_file(cnx, file_path, storage_mode, scan_idx, stat=None):
+    """
+    Process a single file - calculate and store MD5. stat is the file's stat
+    result (or a parallel_walk.FileStat) if the walk already has it.
+    """
     global file_count
     
     # Check for existing MD5 checksum
     existing_md5 = None
     
+    chunking = chunk_files and storage_mode in ["database", "both"] and cnx
     if storage_mode == "database" and cnx:
-        existing_md5 = check_existing_database(cnx, file_path)
-        if existing_md5:
+        existing_md5 = check_existing_database(cnx, file_path, stat)
+        # Known files are still read once if their content has no chunk manifest yet
+        if existing_md5 and not (chunking and not content_chunks.manifest_exists(cnx, existing_md5)):
             if very_verbose:
-                print(f"[DB] MD5 already exists for {file_path}: {existing_md5}")
+                print(f"[DB] MD5 already exists for {registry_paths.display_path(file_path)}: {existing_md5}")
+            if extraction:
+                extraction.submit(file_path, existing_md5)
+            if known_content:
+                classify_content(file_path, existing_md5, stat)
             return "skipped"
     elif storage_mode == "xattr" and XATTR_AVAILABLE:
         existing_md5 = check_existing_xattr(file_path)
         if existing_md5:
             if very_verbose:
-                print(f"[XATTR] MD5 already exists for {file_path}: {existing_md5}")
+                print(f"[XATTR] MD5 already exists for {registry_paths.display_path(file_path)}: {existing_md5}")
+            if known_content:
+                classify_content(file_path, existing_md5, stat)
             return "skipped"
     
     # Calculate MD5 if needed
-    md5_checksum = md5(file_path)
+    chunks = []
+    md5_checksum = md5(file_path, content_chunks.Chunker() if chunking else None, chunks)
     if not md5_checksum:
         return "error"
+    if chunking:
+        content_chunks.store_manifest(cnx, md5_checksum, chunks)
+    if known_content:
+        classify_content(file_path, md5_checksum, stat)
     
     # Store the MD5 checksum
     success = False
     if storage_mode == "database" and cnx:
-        success = store_md5_database(cnx, file_path, md5_checksum, scan_idx)
+        success = store_md5_database(cnx, file_path, md5_checksum, scan_idx, stat)
         if success and very_verbose:
-            print(f"[DB] Stored MD5 for {file_path}: {md5_checksum}")
+            print(f"[DB] Stored MD5 for {registry_paths.display_path(file_path)}: {md5_checksum}")
+        if success and extraction:
+            extraction.submit(file_path, md5_checksum)
     elif storage_mode == "xattr" and XATTR_AVAILABLE:
         success = store_md5_xattr(file_path, md5_checksum)
         if success and very_verbose:
-            print(f"[XATTR] Stored MD5 for {file_path}: {md5_checksum}")
+            print(f"[XATTR] Stored MD5 for {registry_paths.display_path(file_path)}: {md5_checksum}")
     elif storage_mode == "both" and cnx and XATTR_AVAILABLE:
-        success_db = store_md5_database(cnx, file_path, md5_checksum, scan_idx)
+        success_db = store_md5_database(cnx, file_path, md5_checksum, scan_idx, stat)
         success_xattr = store_md5_xattr(file_path, md5_checksum)
         success = success_db or success_xattr
+        if success_db and extraction:
+            extraction.submit(file_path, md5_checksum)
         if very_verbose:
-            print(f"[BOTH] Stored MD5 for {file_path}: {md5_checksum} (DB: {success_db}, XATTR: {success_xattr})")
+            print(f"[BOTH] Stored MD5 for {registry_paths.display_path(file_path)}: {md5_checksum} (DB: {success_db}, XATTR: {success_xattr})")
     
     return "success" if success else "error"
 
-def scan_directory(cnx, folder_path, storage_mode, scan_idx):
-    """Scan a directory and process all files."""
+def scan_directory(cnx, folder_path, storage_mode, scan_idx, report=None, rules=None):
+    """
+    Scan a directory and process all files not excluded by rules (the configured
+    exclusion rules by default). Non-UTF-8 names are added to report if given.
+    Returns (files processed, bytes processed).
+    """
     global folder_count, file_count, very_verbose
     
-    print(f"Scanning directory: {folder_path}")
+    print(f"Scanning directory: {registry_paths.display_path(folder_path)}")
     print(f"Using storage mode: {storage_mode}")
     
     # Check for storage mode availability
@@ -248,7 +298,7 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
                 storage_mode = "xattr"
             else:
                 print("ERROR: Cannot proceed without database or xattr support.")
-                return
+                return 0, 0
     
     if storage_mode in ["xattr", "both"] and not XATTR_AVAILABLE:
         print("WARNING: xattr not available. Cannot use xattr storage.")
@@ -258,27 +308,37 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
                 storage_mode = "database"
             else:
                 print("ERROR: Cannot proceed without database or xattr support.")
-                return
+                return 0, 0
     
-    # Find all files to process
+    # Find all files to process, with the stat results of a parallel walk
     all_files = []
+    file_stats = []
     print("Building file list...")
     
-    for root, dirs, files in os.walk(folder_path):
-        # Skip excluded directories
-        dirs[:] = [d for d in dirs if d not in folders_to_skip]
+    rules = rules or exclusion_rules.load_rules()
+    if walk_workers == 1:
+        tree = ((root, dirs, [(filename, None) for filename in files])
+                for root, dirs, files in exclusion_rules.walk(folder_path, rules))
+    else:
+        import parallel_walk
+        tree = ((root, dirs, [(entry.name, parallel_walk.cached_stat(entry)) for entry in entries])
+                for root, dirs, entries in parallel_walk.walk_entries(folder_path, rules, walk_workers or None))
+    for root, dirs, files in tree:
         folder_count += len(dirs)
         
         # Process each file
-        for filename in files:
-            if filename in files_to_skip:
-                continue
+        for filename, stat in files:
             file_path = os.path.join(root, filename)
             all_files.append(file_path)
+            file_stats.append(stat)
+            if report and not registry_paths.is_utf8_path(filename):
+                report.add(root, filename)
     
     # Process files with progress bar
     print(f"Found {len(all_files)} files to process.")
     
+    # Imported here so tools that only use the hashing helpers start faster
+    from tqdm import tqdm
     pbar = tqdm(total=len(all_files), unit="file")
     
     # Initialize counters
@@ -286,6 +346,7 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
     skipped = 0
     success = 0
     errors = 0
+    processed_bytes = 0
     
     # Process each file
     commit_interval = 100  # How often to commit database changes
@@ -293,11 +354,21 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
     for i, file_path in enumerate(all_files):
         file_count += 1
         
+        # One stat per file, unless the walk already did it
+        stat = file_stats[i]
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                pass
+        
         # Process file
-        result = process_file(cnx, file_path, storage_mode, scan_idx)
+        result = process_file(cnx, file_path, storage_mode, scan_idx, stat)
         
         # Update counters
         processed += 1
+        if stat is not None:
+            processed_bytes += stat.st_size
         if result == "skipped":
             skipped += 1
         elif result == "success":
@@ -307,6 +378,7 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
         
         # Commit database changes periodically
         if storage_mode in ["database", "both"] and cnx and i % commit_interval == 0:
+            directory_sizes.flush(cnx)
             cnx.commit()
         
         # Update progress bar
@@ -315,9 +387,24 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
     
     # Final commit
     if storage_mode in ["database", "both"] and cnx:
+        directory_sizes.flush(cnx)
         cnx.commit()
     
     pbar.close()
+
+    # Apply the staged versions in set-based chunks
+    if staging:
+        staged, new, changed = staging.merge("metadata")
+        print(f"Merged {staged} staged files: {new} new, {changed} changed")
+
+    extracted = cached = None
+    if extraction:
+        extracted, cached = extraction.finish()
+
+    # End the current version of files that are no longer there
+    closed = 0
+    if storage_mode in ["database", "both"] and cnx and scan_idx:
+        closed = metadata_snapshots.close_missing_versions(cnx, folder_path, scan_idx, set(all_files))
     
     # Print summary
     print("\nScan Complete:")
@@ -325,8 +412,16 @@ def scan_directory(cnx, folder_path, storage_mode, scan_idx):
     print(f"Skipped (already processed): {skipped}")
     print(f"Successfully processed: {success}")
     print(f"Errors: {errors}")
+    print(f"No longer present: {closed}")
     print(f"Total folders: {folder_count}")
     print(f"Storage mode used: {storage_mode}")
+    if cache_stats is not None:
+        print(cache_stats.summary())
+    if extracted is not None:
+        print(f"Metadata extracted: {extracted} contents ({cached} already had current results)")
+    if known_content:
+        print(known_content.summary())
+    return processed, processed_bytes
 
 if __name__ == "__main__":
     # Parse command line arguments
@@ -335,10 +430,44 @@ if __name__ == "__main__":
     parser.add_argument("--storage", choices=["database", "xattr", "both"], default="database",
                       help="Where to store MD5 checksums: database, xattr, or both. Default: database")
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output.")
+    parser.add_argument("--exclusions", type=str, default=None,
+                      help=f"Exclusion rules file. Default: {exclusion_rules.RULES_FILE} or the legacy excluded_*.json lists")
+    parser.add_argument("--chunks", action="store_true",
+                      help="Also record content-defined chunks of each file for near-duplicate reports (database storage).")
+    parser.add_argument("--cache-mode", choices=page_cache.MODES, default="normal",
+                      help="Page cache use while hashing: normal, dontneed (drop what the scan read in, keep what was "
+                           "cached before) or direct (O_DIRECT). Default: normal")
+    parser.add_argument("--cache-stats", action="store_true",
+                      help="Report how much of the data read was in the page cache before and after hashing.")
+    parser.add_argument("--extract", type=str, default=None, metavar="EXTRACTORS",
+                      help="Run metadata extractors on the files' contents: 'all' or a comma-separated list "
+                           "(see metadata_extractors.py list). Database storage only.")
+    parser.add_argument("--extract-workers", type=int, default=None,
+                      help="Processes for metadata extraction. Default: one less than the CPU count")
+    parser.add_argument("--walk-threads", type=int, default=1,
+                      help="Threads listing directories in parallel, for high-latency file systems. 0 uses the "
+                           "per-mount setting in config/parallel_walk.json. Default: 1 (single-threaded walk)")
+    parser.add_argument("--staging", action="store_true",
+                      help="Write this scan's results to its own staging table and merge them into file_metadata "
+                           "at the end, so concurrent scanners do not contend (database storage).")
+    parser.add_argument("--known-filter", type=str, default=None,
+                      help="Digest filter from digest_filter.py export: classify files as new or already registered "
+                           "without a database query per file. Probable matches are confirmed in batches when a "
+                           "database connection is available.")
+    parser.add_argument("--new-files", type=str, default=None,
+                      help="With --known-filter, write the paths of files with new content to this file.")
+    parser.add_argument("--sanitizer-report", type=str, default=None,
+                      help="Write files whose names are not valid UTF-8 to this report file.")
     args = parser.parse_args()
     
     # Set global variables
     very_verbose = args.verbose
+    chunk_files = args.chunks
+    if chunk_files and DB_AVAILABLE and not content_chunks.NUMPY_AVAILABLE:
+        print("WARNING: numpy is not installed; --chunks runs in pure Python at a few MB/s per process.")
+    cache_mode = args.cache_mode
+    cache_stats = page_cache.CacheStats() if args.cache_stats else None
+    walk_workers = args.walk_threads
     storage_mode = args.storage
     
     # Sanitize path for log files
@@ -395,14 +524,58 @@ if __name__ == "__main__":
                 print("Cannot continue without database or xattr support.")
                 exit(1)
     
+    # Metadata extraction runs next to hashing and needs the database
+    if args.extract and cnx and storage_mode in ["database", "both"]:
+        import metadata_extractors
+        try:
+            extraction = metadata_extractors.ExtractionPool(
+                cnx, None if args.extract == "all" else args.extract.split(","),
+                args.extract_workers or metadata_extractors.DEFAULT_WORKERS)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            exit(1)
+    elif args.extract:
+        print("WARNING: Metadata extraction needs database storage; skipping it.")
+    
+    # Known content is confirmed against the registry when there is a connection
+    new_files = None
+    if args.known_filter:
+        import digest_filter
+        try:
+            known_filter = digest_filter.DigestFilter.load(args.known_filter)
+        except (OSError, ValueError) as e:
+            print(f"ERROR: Cannot load digest filter: {e}")
+            exit(1)
+        new_files = open(args.new_files, "w", encoding="utf-8") if args.new_files else None
+        known_content = digest_filter.KnownContent(known_filter, cnx if cnx and is_connection_valid(cnx) else None,
+                                                   new_files)
+    
+    scan_idx = None
+    scan_status = "failed"
+    files_scanned = bytes_scanned = None
+    report = sanitizer_report.SanitizerReportWriter(args.sanitizer_report) if args.sanitizer_report else None
     try:
         # Scan the directory
-        scan_idx = None
         if cnx:
             print("Scanning with database storage...")
             scan_idx = log_scan.log_scan(cnx, args.folder_path)
-        scan_directory(cnx, args.folder_path, storage_mode, scan_idx)
+        if args.staging and scan_idx and storage_mode in ["database", "both"]:
+            import scan_staging
+            staging = scan_staging.StagingTable(cnx, scan_idx, metadata_snapshots.scan_host_id(cnx, scan_idx))
+        rules = exclusion_rules.load_rules(args.exclusions)
+        files_scanned, bytes_scanned = scan_directory(cnx, args.folder_path, storage_mode, scan_idx, report, rules)
+        scan_status = "completed"
     finally:
+        if new_files:
+            new_files.close()
+        if report:
+            report.close()
+            print(f"Sanitizer report: {report.records} non-UTF-8 file names in {args.sanitizer_report}")
+
+        # Record the outcome of the scan
+        if cnx and scan_idx:
+            log_scan.finish_scan(cnx, scan_idx, scan_status, files_scanned, bytes_scanned)
+
         # Close database connection if open
         if cnx:
             cnx.close()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Metadata Extractors
+-------------------
+Pluggable content metadata (image dimensions and EXIF, media duration, text
+language, embeddings) computed in a process pool next to hashing.
+
+An extractor is a function of a file path returning a JSON-serializable dict,
+registered with @extractor(name, version, extensions). Results go into
+content_metadata keyed by the file's MD5 and the extractor name, so a content
+is analyzed once however many copies of it exist on however many hosts, and
+files whose MD5 already has a result from the current extractor version are
+never read again. Bump an extractor's version to have it re-run.
+
+Extractors that need optional packages (Pillow, langdetect,
+sentence-transformers) or tools (ffprobe) are skipped when those are missing;
+`python metadata_extractors.py list` shows what is available.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+
+import registry_paths
+
+try:
+    from PIL import Image, ExifTags
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    import langdetect
+    LANGDETECT_AVAILABLE = True
+except ImportError:
+    LANGDETECT_AVAILABLE = False
+
+try:
+    import importlib.util
+    EMBEDDINGS_AVAILABLE = importlib.util.find_spec("sentence_transformers") is not None
+except (ImportError, ValueError):
+    EMBEDDINGS_AVAILABLE = False
+
+FFPROBE = shutil.which("ffprobe")
+
+# Model used by the embedding extractor, loaded once per worker process
+EMBEDDING_MODEL = os.environ.get("FILE_REGISTRY_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+# Bytes of a text file read for language detection and embeddings
+TEXT_SAMPLE_SIZE = 64 * 1024
+
+# Files checked against content_metadata per query, and results per write
+BATCH_SIZE = 500
+
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".tif", ".tiff", ".bmp", ".webp"}
+MEDIA_EXTENSIONS = {".mp4", ".mov", ".mkv", ".avi", ".mxf", ".webm", ".mp3", ".wav", ".flac", ".aac", ".m4a", ".ogg"}
+TEXT_EXTENSIONS = {".txt", ".md", ".rst", ".csv", ".json", ".xml", ".html", ".htm", ".py", ".log"}
+
+# name -> (function, version, extensions or None for all files, available)
+EXTRACTORS = {}
+
+
+def extractor(name, version=1, extensions=None, available=True):
+    """Register a metadata extractor."""
+    def register(function):
+        EXTRACTORS[name] = (function, version, set(extensions) if extensions else None, available)
+        return function
+    return register
+
+
+def applies(name, file_path):
+    _, _, extensions, _ = EXTRACTORS[name]
+    return extensions is None or os.path.splitext(file_path)[1].lower() in extensions
+
+
+def available_extractors(names=None):
+    """The registered extractors whose dependencies are installed, optionally limited to names."""
+    selected = names or list(EXTRACTORS)
+    unknown = [name for name in selected if name not in EXTRACTORS]
+    if unknown:
+        raise ValueError(f"unknown extractors: {', '.join(unknown)}")
+    return [name for name in selected if EXTRACTORS[name][3]]
+
+
+# Extractors
+
+def _image_size_from_header(file_path):
+    """Width and height from PNG, GIF and JPEG headers, without an imaging library."""
+    with open(file_path, "rb") as f:
+        head = f.read(32)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+        if head.startswith(b"\xff\xd8"):
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length = struct.unpack(">H", f.read(2))[0]
+                # Start-of-frame markers carry the dimensions
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, os.SEEK_CUR)
+    return None
+
+
+EXIF_TAGS = ("Make", "Model", "DateTimeOriginal", "DateTime", "Orientation", "ExposureTime", "FNumber",
+             "ISOSpeedRatings", "FocalLength", "LensModel", "Software")
+
+
+@extractor("image", version=1, extensions=IMAGE_EXTENSIONS)
+def extract_image(file_path):
+    if not PIL_AVAILABLE:
+        size = _image_size_from_header(file_path)
+        return {"width": size[0], "height": size[1]} if size else None
+    with Image.open(file_path) as image:
+        result = {"width": image.width, "height": image.height, "mode": image.mode, "format": image.format}
+        exif = image.getexif()
+        if exif:
+            # Merge the Exif sub-IFD, where the camera settings live
+            tags = dict(exif)
+            tags.update(exif.get_ifd(0x8769))
+            named = {ExifTags.TAGS.get(tag, str(tag)): value for tag, value in tags.items()}
+            result["exif"] = {tag: str(named[tag]) for tag in EXIF_TAGS if tag in named}
+            result["gps"] = 0x8825 in exif
+    return result
+
+
+@extractor("media", version=1, extensions=MEDIA_EXTENSIONS, available=FFPROBE is not None)
+def extract_media(file_path):
+    output = subprocess.run(
+        [FFPROBE, "-v", "error", "-show_entries",
+         "format=duration,format_name,bit_rate:stream=codec_type,codec_name,width,height,sample_rate",
+         "-of", "json", file_path],
+        capture_output=True, timeout=120, check=True).stdout
+    probe = json.loads(output)
+    result = {"duration": float(probe.get("format", {}).get("duration", 0) or 0),
+              "format": probe.get("format", {}).get("format_name"),
+              "streams": probe.get("streams", [])}
+    return result
+
+
+def _text_sample(file_path):
+    with open(file_path, "rb") as f:
+        return f.read(TEXT_SAMPLE_SIZE).decode("utf-8", "replace")
+
+
+@extractor("language", version=1, extensions=TEXT_EXTENSIONS, available=LANGDETECT_AVAILABLE)
+def extract_language(file_path):
+    text = _text_sample(file_path)
+    if not text.strip():
+        return None
+    languages = langdetect.detect_langs(text)
+    return {"language": languages[0].lang, "probability": round(languages[0].prob, 3)} if languages else None
+
+
+_embedding_model = None
+
+
+@extractor("embedding", version=1, extensions=TEXT_EXTENSIONS, available=EMBEDDINGS_AVAILABLE)
+def extract_embedding(file_path):
+    global _embedding_model
+    text = _text_sample(file_path)
+    if not text.strip():
+        return None
+    if _embedding_model is None:
+        from sentence_transformers import SentenceTransformer
+        _embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+    vector = _embedding_model.encode(text)
+    return {"model": EMBEDDING_MODEL, "vector": [round(float(v), 6) for v in vector]}
+
+
+def run_extractors(file_path, names):
+    """
+    Worker entry point: ({name: (version, result)}, {name: error}) for the
+    given extractors. Errors are kept apart so they are never stored as a
+    result and the content is tried again on a later run.
+    """
+    results = {}
+    errors = {}
+    for name in names:
+        function, version, _, _ = EXTRACTORS[name]
+        try:
+            results[name] = (version, function(file_path))
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+    return results, errors
+
+
+# Pipeline
+
+class ExtractionPool:
+    """
+    Runs extractors on a process pool for files as they are hashed. submit()
+    queues a file with its MD5; contents that already have current results,
+    or were submitted earlier in this run, are skipped. Results are written to
+    content_metadata through cnx as they arrive (not committed); finish()
+    waits for the rest and commits.
+    """
+
+    def __init__(self, cnx, names=None, workers=DEFAULT_WORKERS):
+        self.cnx = cnx
+        self.names = available_extractors(names)
+        if not self.names:
+            print("No metadata extractor can run here; see `metadata_extractors.py list`.")
+        self.versions = {name: EXTRACTORS[name][1] for name in self.names}
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.max_in_flight = workers * 4
+        self.pending = []
+        self.in_flight = set()
+        self.seen = set()
+        self.results = []
+        self.submitted = 0
+        self.cached = 0
+        # Extractor runs that raised; nothing is stored, so they are retried next run
+        self.failed = 0
+
+    def submit(self, file_path, md5_checksum):
+        if not md5_checksum or md5_checksum in self.seen:
+            return
+        self.seen.add(md5_checksum)
+        names = [name for name in self.names if applies(name, file_path)]
+        if names:
+            self.pending.append((file_path, md5_checksum, names))
+        if len(self.pending) >= BATCH_SIZE:
+            self._dispatch()
+        self._collect(block=False)
+
+    def _current(self, digests):
+        """{md5 hex: extractor names with results of the current version}"""
+        done = {}
+        cursor = self.cnx.cursor()
+        try:
+            placeholders = ", ".join(["%s"] * len(digests))
+            cursor.execute(
+                f"SELECT md5_checksum, extractor, extractor_version FROM content_metadata "
+                f"WHERE md5_checksum IN ({placeholders})", [bytes.fromhex(d) for d in digests])
+            for md5_digest, name, version in cursor.fetchall():
+                if self.versions.get(name) == version:
+                    done.setdefault(bytes(md5_digest).hex(), set()).add(name)
+        finally:
+            cursor.close()
+        return done
+
+    def _dispatch(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        done = self._current([md5_checksum for _, md5_checksum, _ in pending])
+        for file_path, md5_checksum, names in pending:
+            names = [name for name in names if name not in done.get(md5_checksum, ())]
+            if not names:
+                self.cached += 1
+                continue
+            while len(self.in_flight) >= self.max_in_flight:
+                self._collect(block=True)
+            future = self.executor.submit(run_extractors, file_path, names)
+            future.md5_checksum = md5_checksum
+            future.file_path = file_path
+            self.in_flight.add(future)
+            self.submitted += 1
+
+    def _collect(self, block):
+        if not self.in_flight:
+            return
+        finished, _ = concurrent.futures.wait(
+            self.in_flight, timeout=None if block else 0,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            self.in_flight.discard(future)
+            try:
+                results, errors = future.result()
+            except Exception as e:
+                print(f"Metadata extraction failed for {future.md5_checksum}: {e}")
+                self.failed += 1
+                continue
+            for name, error in errors.items():
+                print(f"{name} extractor failed for {registry_paths.display_path(future.file_path)}: {error}")
+                self.failed += 1
+            for name, (version, result) in results.items():
+                self.results.append((bytes.fromhex(future.md5_checksum), name, version,
+                                     json.dumps(result, default=str)))
+        if len(self.results) >= BATCH_SIZE:
+            self._write()
+
+    def _write(self):
+        if not self.results:
+            return
+        cursor = self.cnx.cursor()
+        try:
+            cursor.executemany(
+                "INSERT INTO content_metadata (md5_checksum, extractor, extractor_version, metadata, extracted) "
+                "VALUES (%s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE "
+                "extractor_version = VALUES(extractor_version), metadata = VALUES(metadata), "
+                "extracted = VALUES(extracted)", self.results)
+        finally:
+            cursor.close()
+        self.results = []
+
+    def finish(self):
+        """Wait for outstanding work, write and commit the results, and stop the workers."""
+        self._dispatch()
+        while self.in_flight:
+            self._collect(block=True)
+        self._write()
+        self.cnx.commit()
+        self.executor.shutdown()
+        if self.failed:
+            print(f"{self.failed} metadata extractions failed and will be retried on the next run")
+        return self.submitted, self.cached
+
+
+def metadata_for(cnx, md5_checksum):
+    """{extractor: (version, metadata)} stored for a content."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT extractor, extractor_version, metadata FROM content_metadata "
+                       "WHERE md5_checksum = %s", (bytes.fromhex(md5_checksum),))
+        return {name: (version, json.loads(metadata) if metadata is not None else None)
+                for name, version, metadata in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def _file_md5(file_path):
+    import hashlib
+    import page_cache
+
+    hash_md5 = hashlib.md5()
+    with page_cache.BlockReader(file_path, "dontneed") as reader:
+        for block in iter(reader.read, b""):
+            hash_md5.update(block)
+    return hash_md5.hexdigest()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract content metadata into the registry, or show it.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='list the registered extractors and whether they can run here')
+
+    extract_parser = subparsers.add_parser('extract', help='hash the files under a directory and extract their metadata')
+    extract_parser.add_argument('directory_path', type=str, help='directory to process')
+    extract_parser.add_argument('--extractors', type=str, default=None,
+                                help='comma-separated extractors to run (default: all available)')
+    extract_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                                help=f'extraction processes (default: {DEFAULT_WORKERS})')
+    extract_parser.add_argument('--exclusions', type=str, default=None, help='exclusion rules file')
+
+    show_parser = subparsers.add_parser('show', help='show the stored metadata of a file or MD5')
+    show_parser.add_argument('target', type=str, help='a file to hash, or an MD5 in hex')
+
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for name, (_, version, extensions, available) in EXTRACTORS.items():
+            kinds = ", ".join(sorted(extensions)) if extensions else "all files"
+            print(f"{name:<10} v{version}  {'available' if available else 'missing dependency':<18}  {kinds}")
+        sys.exit(0)
+
+    import registry_database
+
+    cnx = registry_database.get_database_connection()
+    if not cnx or not registry_database.is_connection_valid(cnx):
+        print("Failed to connect to the database or connection timed out.")
+        sys.exit(1)
+
+    if args.command == 'show':
+        md5_checksum = args.target if not os.path.exists(args.target) else _file_md5(args.target)
+        for name, (version, metadata) in metadata_for(cnx, md5_checksum).items():
+            print(f"{name} v{version}: {json.dumps(metadata)}")
+    else:
+        import archive_scanner
+        import exclusion_rules
+
+        names = args.extractors.split(",") if args.extractors else None
+        pool = ExtractionPool(cnx, names, args.workers)
+        rules = exclusion_rules.load_rules(args.exclusions)
+        for root, dirs, files in exclusion_rules.walk(args.directory_path, rules):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if not any(applies(extractor_name, file_path) for extractor_name in pool.names):
+                    continue
+                try:
+                    # Files registered with their current modification time are not read again
+                    md5_checksum = archive_scanner.known_md5(cnx, file_path) or _file_md5(file_path)
+                    pool.submit(file_path, md5_checksum)
+                except OSError as e:
+                    print(f"Cannot read {registry_paths.display_path(file_path)}: {e}")
+        submitted, cached = pool.finish()
+        print(f"Extracted metadata for {submitted} contents, {cached} already had current results")
+    cnx.close()
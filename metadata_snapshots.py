@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Metadata Snapshots
+------------------
+Delta storage for file_metadata. A row is written only when a file's digest,
+size or modification time differs from its current version. Each row is valid
+from the scan that wrote it (scan_log_id) up to, but not including, the scan
+that replaced or lost it (valid_to_scan_id, NULL while current), so the state
+of any subtree can be read as of any scan. Compaction folds old history away.
+"""
+
+import argparse
+import platform
+import time
+
+import directory_sizes
+import registry_database
+import registry_paths
+
+# Rows per bulk UPDATE/DELETE statement
+BATCH_SIZE = 1000
+
+# hosts.id of each scan_log id, looked up once per scan
+_scan_hosts = {}
+
+
+def scan_host_id(cnx, scan_log_id):
+    """Return the hosts id of the host a scan was logged from; versions are tracked per host."""
+    if scan_log_id not in _scan_hosts:
+        hostname = None
+        if scan_log_id is not None:
+            cursor = cnx.cursor()
+            try:
+                cursor.execute("SELECT host_name FROM scan_log WHERE id = %s", (scan_log_id,))
+                result = cursor.fetchone()
+            finally:
+                cursor.close()
+            hostname = result[0] if result else None
+        _scan_hosts[scan_log_id] = registry_database.get_host_id(cnx, hostname or platform.node())
+    return _scan_hosts[scan_log_id]
+
+
+def _format_date(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if hasattr(value, 'strftime') else value
+
+
+def store_version(cnx, file_path, md5_checksum, file_size, modification_date, scan_log_id):
+    """
+    Record the state of a file as seen by a scan. Started and ended versions
+    are recorded for directory_sizes.flush().
+
+    Returns "unchanged" when the current version already matches, "updated" when
+    the current version belonged to this same scan and was rewritten in place,
+    and "new" when a new version was started. Does not commit.
+    """
+    path_hash = registry_paths.path_hash(file_path)
+    host_id = scan_host_id(cnx, scan_log_id)
+    md5_digest = registry_database.md5_to_bin(md5_checksum)
+    scan_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT id, md5_checksum, file_size, modification_date, scan_log_id FROM file_metadata "
+            "WHERE host_id = %s AND file_path_hash = %s AND valid_to_scan_id IS NULL",
+            (host_id, path_hash))
+        current = cursor.fetchone()
+
+        if current is not None:
+            version_id, old_md5, old_size, old_date, version_scan_id = current
+            if (old_md5 == md5_digest and old_size == file_size
+                    and _format_date(old_date) == modification_date):
+                return "unchanged"
+
+            if scan_log_id is None or version_scan_id == scan_log_id:
+                cursor.execute(
+                    "UPDATE file_metadata SET md5_checksum = %s, file_size = %s, "
+                    "modification_date = %s, scan_date = %s, last_verified = %s WHERE id = %s",
+                    (md5_digest, file_size, modification_date, scan_date, scan_date, version_id))
+                directory_sizes.record(host_id, file_path, bytes(old_md5), old_size, -1)
+                directory_sizes.record(host_id, file_path, md5_digest, file_size, 1)
+                return "updated"
+
+            cursor.execute("UPDATE file_metadata SET valid_to_scan_id = %s WHERE id = %s",
+                           (scan_log_id, version_id))
+            directory_sizes.record(host_id, file_path, bytes(old_md5), old_size, -1)
+
+        cursor.execute(
+            "INSERT INTO file_metadata "
+            "(file_path, md5_checksum, file_size, modification_date, scan_date, file_path_hash, "
+            "scan_log_id, host_id, last_verified) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (registry_paths.path_to_db(file_path), md5_digest, file_size, modification_date, scan_date,
+             path_hash, scan_log_id, host_id, scan_date))
+        directory_sizes.record(host_id, file_path, md5_digest, file_size, 1)
+        return "new"
+    finally:
+        cursor.close()
+
+
+def end_versions(cnx, scan_log_id, file_paths=(), directories=()):
+    """
+    End the current versions of file_paths and of every file below
+    directories, which scan_log_id found removed. A version started by the
+    same scan is deleted instead, so the path can get a new version in that
+    scan again. Returns the number of versions ended. Does not commit.
+    """
+    host_id = scan_host_id(cnx, scan_log_id)
+    columns = "id, file_path, md5_checksum, file_size, scan_log_id"
+    versions = {}
+    cursor = cnx.cursor()
+    try:
+        file_paths = list(file_paths)
+        for i in range(0, len(file_paths), BATCH_SIZE):
+            batch = [registry_paths.path_hash(p) for p in file_paths[i:i + BATCH_SIZE]]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(
+                f"SELECT {columns} FROM file_metadata WHERE host_id = %s AND valid_to_scan_id IS NULL "
+                f"AND file_path_hash IN ({placeholders})", (host_id, *batch))
+            versions.update((row[0], row) for row in cursor.fetchall())
+        for directory in directories:
+            cursor.execute(
+                f"SELECT {columns} FROM file_metadata WHERE host_id = %s AND valid_to_scan_id IS NULL "
+                f"AND file_path LIKE %s", (host_id, registry_paths.prefix_pattern(directory)))
+            versions.update((row[0], row) for row in cursor.fetchall())
+
+        ended = []
+        dropped = []
+        for version_id, file_path, md5_digest, file_size, version_scan_id in versions.values():
+            directory_sizes.record(host_id, registry_paths.path_from_db(file_path), bytes(md5_digest), file_size, -1)
+            if scan_log_id is not None and version_scan_id == scan_log_id:
+                dropped.append(version_id)
+            else:
+                ended.append(version_id)
+        for i in range(0, len(ended), BATCH_SIZE):
+            batch = ended[i:i + BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"UPDATE file_metadata SET valid_to_scan_id = %s WHERE id IN ({placeholders})",
+                           (scan_log_id, *batch))
+        for i in range(0, len(dropped), BATCH_SIZE):
+            batch = dropped[i:i + BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"DELETE FROM file_metadata WHERE id IN ({placeholders})", batch)
+    finally:
+        cursor.close()
+    return len(versions)
+
+
+def close_missing_versions(cnx, directory_path, scan_log_id, seen_paths):
+    """
+    End the current version of every file under directory_path that the scan
+    did not see. seen_paths must support `in` for file paths. Returns the number
+    of versions closed.
+    """
+    host_id = scan_host_id(cnx, scan_log_id)
+    pattern = registry_paths.prefix_pattern(directory_path)
+
+    missing = []
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT id, file_path, md5_checksum, file_size FROM file_metadata "
+            "WHERE host_id = %s AND valid_to_scan_id IS NULL AND file_path LIKE %s "
+            "AND (scan_log_id IS NULL OR scan_log_id < %s)",
+            (host_id, pattern, scan_log_id))
+        for version_id, file_path, md5_digest, file_size in cursor:
+            file_path = registry_paths.path_from_db(file_path)
+            if file_path not in seen_paths:
+                missing.append(version_id)
+                directory_sizes.record(host_id, file_path, bytes(md5_digest), file_size, -1)
+    finally:
+        cursor.close()
+
+    cursor = cnx.cursor()
+    try:
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(
+                f"UPDATE file_metadata SET valid_to_scan_id = %s WHERE id IN ({placeholders})",
+                (scan_log_id, *batch))
+        directory_sizes.flush(cnx)
+        cnx.commit()
+    finally:
+        cursor.close()
+    return len(missing)
+
+
+def state_as_of(cnx, path_prefix, scan_id, hostname=None):
+    """
+    Yield (file_path, md5_checksum, file_size, modification_date, scan_log_id)
+    for every file under path_prefix as it was at scan scan_id, with the
+    checksum as hex.
+    """
+    query = ("SELECT fm.file_path, fm.md5_checksum, fm.file_size, fm.modification_date, fm.scan_log_id "
+             "FROM file_metadata fm "
+             "WHERE fm.file_path LIKE %s AND fm.scan_log_id <= %s "
+             "AND (fm.valid_to_scan_id IS NULL OR fm.valid_to_scan_id > %s)")
+    args = [registry_paths.escape_like(registry_paths.path_to_db(path_prefix)) + b'%', scan_id, scan_id]
+    if hostname:
+        query += " AND fm.host_id = (SELECT id FROM hosts WHERE hostname = %s)"
+        args.append(hostname)
+    query += " ORDER BY fm.file_path"
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        for file_path, md5_digest, file_size, modification_date, version_scan_id in cursor:
+            yield (registry_paths.path_from_db(file_path), registry_database.bin_to_hex(md5_digest), file_size,
+                   modification_date, version_scan_id)
+    finally:
+        cursor.close()
+
+
+def _fill_host_ids(cnx):
+    """Give rows written before versioning the host of their scan."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "INSERT IGNORE INTO hosts (hostname, ip_address, os_version) "
+            "SELECT DISTINCT s.host_name, s.host_ip, s.os_version FROM scan_log s "
+            "JOIN file_metadata fm ON fm.scan_log_id = s.id "
+            "WHERE fm.host_id IS NULL AND s.host_name IS NOT NULL")
+        cursor.execute(
+            "UPDATE file_metadata fm JOIN scan_log s ON fm.scan_log_id = s.id "
+            "JOIN hosts h ON h.hostname = s.host_name "
+            "SET fm.host_id = h.id WHERE fm.host_id IS NULL")
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def compact_history(cnx, horizon_scan_id, dry_run=False):
+    """
+    Fold file_metadata history.
+
+    Consecutive versions of a file with identical content are merged into one,
+    open versions that were followed by a newer one (full copies written before
+    delta storage) are closed, and versions that ended at or before
+    horizon_scan_id are dropped. States as of horizon_scan_id or later are
+    unaffected. Returns (merged, dropped).
+    """
+    if not dry_run:
+        _fill_host_ids(cnx)
+
+    # Updates and deletes go through a second connection while the first streams
+    writer = registry_database.get_database_connection()
+    write_cursor = writer.cursor()
+    updates = []
+    deletes = []
+    merged = 0
+    dropped = 0
+
+    def flush():
+        if dry_run:
+            updates.clear()
+            deletes.clear()
+            return
+        if updates:
+            write_cursor.executemany(
+                "UPDATE file_metadata SET valid_to_scan_id = %s WHERE id = %s", updates)
+            updates.clear()
+        for i in range(0, len(deletes), BATCH_SIZE):
+            batch = deletes[i:i + BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            write_cursor.execute(f"DELETE FROM file_metadata WHERE id IN ({placeholders})", batch)
+        deletes.clear()
+        writer.commit()
+
+    def finish(version):
+        nonlocal dropped
+        version_id, valid_to, original_valid_to = version[0], version[2], version[3]
+        if valid_to is not None and valid_to <= horizon_scan_id:
+            deletes.append(version_id)
+            dropped += 1
+        elif valid_to != original_valid_to:
+            updates.append((valid_to, version_id))
+
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT id, file_path_hash, host_id, scan_log_id, valid_to_scan_id, "
+            "md5_checksum, file_size, modification_date "
+            "FROM file_metadata WHERE scan_log_id IS NOT NULL "
+            "ORDER BY file_path_hash, scan_log_id")
+
+        current_hash = None
+        # host_id -> [id, content, valid_to, original valid_to]
+        latest = {}
+        for version_id, path_hash, host_id, scan_id, valid_to, md5_checksum, file_size, modification_date in cursor:
+            if path_hash != current_hash:
+                for version in latest.values():
+                    finish(version)
+                latest = {}
+                current_hash = path_hash
+                if len(updates) + len(deletes) >= BATCH_SIZE:
+                    flush()
+
+            content = (md5_checksum, file_size, _format_date(modification_date))
+            previous = latest.get(host_id)
+            if previous is not None:
+                if previous[1] == content and (previous[2] is None or previous[2] >= scan_id):
+                    # Same content continues: extend the earlier version
+                    previous[2] = valid_to
+                    deletes.append(version_id)
+                    merged += 1
+                    continue
+                if previous[2] is None or previous[2] > scan_id:
+                    previous[2] = scan_id
+                finish(previous)
+            latest[host_id] = [version_id, content, valid_to, valid_to]
+
+        for version in latest.values():
+            finish(version)
+        flush()
+    finally:
+        cursor.close()
+        write_cursor.close()
+        writer.close()
+
+    return merged, dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query and compact versioned file metadata.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    as_of_parser = subparsers.add_parser('as-of', help='list the files under a path as of a scan')
+    as_of_parser.add_argument('path_prefix', type=str, help='path prefix to list')
+    as_of_parser.add_argument('scan_id', type=int, help='scan_log id to read the state at')
+    as_of_parser.add_argument('--host', type=str, default=None, help='only list files of this host')
+
+    compact_parser = subparsers.add_parser('compact', help='fold metadata history')
+    compact_parser.add_argument('--before', type=int, required=True,
+                                help='drop versions that ended at or before this scan_log id')
+    compact_parser.add_argument('--dry-run', action='store_true', help='report without changing anything')
+
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        if args.command == 'as-of':
+            count = 0
+            for file_path, md5_checksum, file_size, modification_date, scan_id in state_as_of(
+                    cnx, args.path_prefix, args.scan_id, args.host):
+                print(f"{md5_checksum}  {file_size:>14}  {modification_date}  {registry_paths.display_path(file_path)}")
+                count += 1
+            print(f"{count} files under {registry_paths.display_path(args.path_prefix)} as of scan {args.scan_id}")
+        else:
+            merged, dropped = compact_history(cnx, args.before, args.dry_run)
+            print(f"Merged {merged} unchanged versions, dropped {dropped} versions ending at or before scan {args.before}")
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
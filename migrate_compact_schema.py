@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Compact Schema Migration
+------------------------
+Moves an existing registry to the compact row format: MD5 digests and path
+hashes stored as BINARY(16) instead of hex VARCHAR(32), and the hostname,
+ip_address and os_version strings of every files row replaced by a hosts
+dictionary id.
+
+The migration runs online in three phases:
+    prepare   add the new columns (in-place DDL) and triggers that fill them
+              for rows written by scanners that are still running
+    backfill  fill the new columns for existing rows in small primary-key
+              chunks, one commit per chunk
+    switch    drop the triggers and old columns and rename the new ones;
+              stop scanners first and deploy the matching code afterwards
+
+A separate binary-paths phase converts the path columns to VARBINARY so names
+that are not valid UTF-8 are stored as their raw bytes. The stored UTF-8 text
+is kept byte for byte. It rebuilds each table, so run it with scanners stopped.
+"""
+
+import argparse
+import time
+
+import registry_database
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# table -> (new column, definition, expression computing it from the old columns)
+NEW_COLUMNS = {
+    "files": [
+        ("host_id", "INT", None),
+        ("md5_bin", "BINARY(16)", "UNHEX(md5_checksum)"),
+    ],
+    "file_metadata": [
+        ("host_id", "INT", None),
+        ("md5_bin", "BINARY(16)", "UNHEX(md5_checksum)"),
+        ("path_hash_bin", "BINARY(16)", "UNHEX(file_path_hash)"),
+    ],
+    "file_history": [
+        ("old_md5_bin", "BINARY(16)", "UNHEX(old_md5)"),
+        ("new_md5_bin", "BINARY(16)", "UNHEX(new_md5)"),
+    ],
+}
+
+# table -> old columns removed at switch, and new columns renamed over them
+DROPPED_COLUMNS = {
+    "files": ["hostname", "ip_address", "os_version", "md5_checksum"],
+    "file_metadata": ["hostname", "md5_checksum", "file_path_hash"],
+    "file_history": ["old_md5", "new_md5"],
+}
+RENAMED_COLUMNS = {
+    "files": [("md5_bin", "md5_checksum BINARY(16)")],
+    "file_metadata": [("md5_bin", "md5_checksum BINARY(16) NOT NULL"),
+                      ("path_hash_bin", "file_path_hash BINARY(16) NOT NULL")],
+    "file_history": [("old_md5_bin", "old_md5 BINARY(16)"), ("new_md5_bin", "new_md5 BINARY(16)")],
+}
+FINAL_INDEXES = {
+    "files": ["INDEX idx_files_host_path (host_id, file_path)",
+              "INDEX idx_files_md5 (md5_checksum)"],
+    "file_metadata": ["UNIQUE INDEX idx_metadata_path_scan (file_path_hash, scan_log_id)",
+                      "INDEX idx_metadata_current (host_id, file_path_hash, valid_to_scan_id)"],
+    "file_history": [],
+}
+
+# table -> path columns converted to raw bytes by the binary-paths phase
+PATH_COLUMNS = {
+    "files": ["file_path"],
+    "duplicates": ["file_path"],
+    "scan_log": ["directory_path"],
+    "file_metadata": ["file_path"],
+    "file_history": ["old_path", "new_path"],
+    "scan_work_units": ["directory_path"],
+}
+
+TRIGGERS = {
+    "files_compact_insert": ("BEFORE INSERT", "files"),
+    "files_compact_update": ("BEFORE UPDATE", "files"),
+    "file_metadata_compact_insert": ("BEFORE INSERT", "file_metadata"),
+    "file_metadata_compact_update": ("BEFORE UPDATE", "file_metadata"),
+    "file_history_compact_insert": ("BEFORE INSERT", "file_history"),
+}
+
+TRIGGER_BODIES = {
+    "files": """
+        BEGIN
+            SET NEW.md5_bin = UNHEX(NEW.md5_checksum);
+            IF NEW.hostname IS NOT NULL THEN
+                INSERT IGNORE INTO hosts (hostname, ip_address, os_version)
+                VALUES (NEW.hostname, NEW.ip_address, NEW.os_version);
+                SET NEW.host_id = (SELECT id FROM hosts WHERE hostname = NEW.hostname);
+            END IF;
+        END""",
+    "file_metadata": """
+        BEGIN
+            SET NEW.md5_bin = UNHEX(NEW.md5_checksum);
+            SET NEW.path_hash_bin = UNHEX(NEW.file_path_hash);
+            SET NEW.host_id = (SELECT h.id FROM scan_log s JOIN hosts h ON h.hostname = s.host_name
+                               WHERE s.id = NEW.scan_log_id);
+        END""",
+    "file_history": """
+        BEGIN
+            SET NEW.old_md5_bin = UNHEX(NEW.old_md5);
+            SET NEW.new_md5_bin = UNHEX(NEW.new_md5);
+        END""",
+}
+
+
+def _columns(cursor, table):
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s", (table,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _indexes_using(cursor, table, columns):
+    """Names of the indexes of table that include any of columns."""
+    placeholders = ", ".join(["%s"] * len(columns))
+    cursor.execute(
+        f"SELECT DISTINCT index_name FROM information_schema.statistics "
+        f"WHERE table_schema = DATABASE() AND table_name = %s AND column_name IN ({placeholders}) "
+        f"AND index_name != 'PRIMARY'",
+        (table, *columns))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def prepare(cnx):
+    """Create the hosts table, add the new columns and install the sync triggers."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS hosts ("
+            "id INT AUTO_INCREMENT PRIMARY KEY, "
+            "hostname VARCHAR(255) NOT NULL, "
+            "ip_address VARCHAR(255), "
+            "os_version VARCHAR(255), "
+            "UNIQUE INDEX idx_hosts_hostname (hostname))")
+
+        for table, columns in NEW_COLUMNS.items():
+            existing = _columns(cursor, table)
+            additions = [f"ADD COLUMN {name} {definition}"
+                         for name, definition, _ in columns if name not in existing]
+            if additions:
+                print(f"Adding columns to {table}")
+                cursor.execute(f"ALTER TABLE {table} {', '.join(additions)}, ALGORITHM=INPLACE, LOCK=NONE")
+
+        for trigger, (timing, table) in TRIGGERS.items():
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            cursor.execute(f"CREATE TRIGGER {trigger} {timing} ON {table} FOR EACH ROW {TRIGGER_BODIES[table]}")
+            print(f"Installed trigger {trigger}")
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def _id_range(cursor, table):
+    cursor.execute(f"SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {table}")
+    return cursor.fetchone()
+
+
+def backfill(cnx, chunk_size=DEFAULT_CHUNK_SIZE, pause=0.0):
+    """Fill the new columns of existing rows, one primary-key chunk per transaction."""
+    cursor = cnx.cursor()
+    try:
+        low, high = _id_range(cursor, "files")
+        print(f"Backfilling files ids {low}..{high}")
+        for start in range(low, high + 1, chunk_size):
+            end = start + chunk_size - 1
+            cursor.execute(
+                "INSERT IGNORE INTO hosts (hostname, ip_address, os_version) "
+                "SELECT DISTINCT hostname, ip_address, os_version FROM files "
+                "WHERE id BETWEEN %s AND %s AND hostname IS NOT NULL",
+                (start, end))
+            cursor.execute(
+                "UPDATE files f LEFT JOIN hosts h ON h.hostname = f.hostname "
+                "SET f.host_id = h.id, f.md5_bin = UNHEX(f.md5_checksum) "
+                "WHERE f.id BETWEEN %s AND %s",
+                (start, end))
+            cnx.commit()
+            print(f"files: {end - low + 1} / {high - low + 1}", end='\r')
+            if pause:
+                time.sleep(pause)
+        print()
+
+        cursor.execute(
+            "INSERT IGNORE INTO hosts (hostname, ip_address, os_version) "
+            "SELECT DISTINCT host_name, host_ip, os_version FROM scan_log WHERE host_name IS NOT NULL")
+        cnx.commit()
+
+        low, high = _id_range(cursor, "file_metadata")
+        print(f"Backfilling file_metadata ids {low}..{high}")
+        for start in range(low, high + 1, chunk_size):
+            end = start + chunk_size - 1
+            cursor.execute(
+                "UPDATE file_metadata fm "
+                "LEFT JOIN scan_log s ON s.id = fm.scan_log_id "
+                "LEFT JOIN hosts h ON h.hostname = s.host_name "
+                "SET fm.host_id = h.id, fm.md5_bin = UNHEX(fm.md5_checksum), "
+                "fm.path_hash_bin = UNHEX(fm.file_path_hash) "
+                "WHERE fm.id BETWEEN %s AND %s",
+                (start, end))
+            cnx.commit()
+            print(f"file_metadata: {end - low + 1} / {high - low + 1}", end='\r')
+            if pause:
+                time.sleep(pause)
+        print()
+
+        low, high = _id_range(cursor, "file_history")
+        print(f"Backfilling file_history ids {low}..{high}")
+        for start in range(low, high + 1, chunk_size):
+            end = start + chunk_size - 1
+            cursor.execute(
+                "UPDATE file_history SET old_md5_bin = UNHEX(old_md5), new_md5_bin = UNHEX(new_md5) "
+                "WHERE id BETWEEN %s AND %s",
+                (start, end))
+            cnx.commit()
+            if pause:
+                time.sleep(pause)
+    finally:
+        cursor.close()
+
+
+def switch(cnx):
+    """Replace the old columns with the compact ones. Run with scanners stopped."""
+    cursor = cnx.cursor()
+    try:
+        for trigger in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+        for table, dropped in DROPPED_COLUMNS.items():
+            existing = _columns(cursor, table)
+            dropped = [c for c in dropped if c in existing]
+            drops = [f"DROP INDEX `{index}`" for index in _indexes_using(cursor, table, dropped)]
+            drops += [f"DROP COLUMN {column}" for column in dropped]
+            if drops:
+                print(f"Dropping old columns of {table}")
+                cursor.execute(f"ALTER TABLE {table} {', '.join(drops)}")
+
+            renames = [f"CHANGE COLUMN {old} {definition}" for old, definition in RENAMED_COLUMNS[table]
+                       if old in existing]
+            renames += [f"ADD {index}" for index in FINAL_INDEXES[table]]
+            if renames:
+                print(f"Switching {table} to the compact columns")
+                cursor.execute(f"ALTER TABLE {table} {', '.join(renames)}")
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def convert_paths(cnx):
+    """Convert the path columns to VARBINARY(1024). Run with scanners stopped."""
+    cursor = cnx.cursor()
+    try:
+        for table, columns in PATH_COLUMNS.items():
+            cursor.execute(
+                "SELECT column_name, data_type, is_nullable FROM information_schema.columns "
+                "WHERE table_schema = DATABASE() AND table_name = %s", (table,))
+            types = {name: (data_type, nullable) for name, data_type, nullable in cursor.fetchall()}
+            changes = [f"MODIFY COLUMN {column} VARBINARY(1024)" + ("" if types[column][1] == "YES" else " NOT NULL")
+                       for column in columns if column in types and types[column][0] != "varbinary"]
+            if changes:
+                print(f"Converting path columns of {table}")
+                cursor.execute(f"ALTER TABLE {table} {', '.join(changes)}")
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def print_progress(cnx):
+    """Show how many rows still lack their compact columns."""
+    cursor = cnx.cursor()
+    try:
+        for table, columns in NEW_COLUMNS.items():
+            existing = _columns(cursor, table)
+            for name, _, expression in columns:
+                if name not in existing:
+                    print(f"{table}.{name}: not added yet")
+                    continue
+                source = f" AND {expression} IS NOT NULL" if expression else ""
+                cursor.execute(f"SELECT COUNT(*) FROM {table} WHERE {name} IS NULL{source}")
+                print(f"{table}.{name}: {cursor.fetchone()[0]} rows left to fill")
+    finally:
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate the registry to BINARY(16) digests and a hosts dictionary.')
+    parser.add_argument('phase', choices=['prepare', 'backfill', 'switch', 'binary-paths', 'progress'], help='migration phase to run')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f'rows updated per transaction during backfill (default: {DEFAULT_CHUNK_SIZE})')
+    parser.add_argument('--pause', type=float, default=0.0, help='seconds to sleep between backfill chunks')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        if args.phase == 'prepare':
+            prepare(cnx)
+        elif args.phase == 'backfill':
+            backfill(cnx, args.chunk_size, args.pause)
+        elif args.phase == 'switch':
+            answer = input("Scanners must be stopped before switching. Continue? (y/n): ").lower()
+            if answer == 'y':
+                switch(cnx)
+                print("Switch complete. Deploy the compact-format code before restarting scanners.")
+        elif args.phase == 'binary-paths':
+            answer = input("Scanners must be stopped before converting paths. Continue? (y/n): ").lower()
+            if answer == 'y':
+                convert_paths(cnx)
+                print("Path columns now store raw bytes.")
+        else:
+            print_progress(cnx)
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
@@ -0,0 +1,239 @@
+"""
+Page Cache
+----------
+File reading for the hashing paths that does not flush the page cache the
+file servers depend on.
+
+    normal    plain buffered reads; whatever is read stays cached
+    dontneed  posix_fadvise(SEQUENTIAL) for deeper readahead, WILLNEED on the
+              next block, and DONTNEED on every block once it is consumed.
+              Pages that were already cached before the file was opened are
+              left alone, so hot data read by other users is not evicted.
+    direct    O_DIRECT reads into a page-aligned buffer, bypassing the cache
+              entirely; falls back to dontneed where the file system refuses it
+
+Residency is measured with mincore(2) on a mapping of the file, which also
+gives the before/after statistics in CacheStats. Linux only; elsewhere every
+mode reads normally and no statistics are collected.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+
+MODES = ("normal", "dontneed", "direct")
+
+# Bytes per read request
+BLOCK_SIZE = 1024 * 1024
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# Bytes of the file mapped per mincore call
+MINCORE_WINDOW = 1024 * 1024 * 1024
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+
+FADVISE_AVAILABLE = hasattr(os, "posix_fadvise")
+DIRECT_AVAILABLE = hasattr(os, "O_DIRECT")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    MINCORE_AVAILABLE = True
+except (OSError, AttributeError, TypeError):
+    MINCORE_AVAILABLE = False
+
+_MAP_FAILED = ctypes.c_void_p(-1).value
+
+# mincore sets the low bit of each vector byte for a resident page
+_LOW_BIT = bytes(b & 1 for b in range(256))
+
+
+def resident_runs(fd, size):
+    """
+    Return the cached byte ranges of an open file as sorted (start, end)
+    pairs, or None when residency cannot be measured.
+    """
+    if not MINCORE_AVAILABLE:
+        return None
+    runs = []
+    vector = ctypes.create_string_buffer(MINCORE_WINDOW // PAGE_SIZE)
+    for window_start in range(0, size, MINCORE_WINDOW):
+        length = min(MINCORE_WINDOW, size - window_start)
+        address = _libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, window_start)
+        if address in (None, _MAP_FAILED):
+            return None
+        try:
+            if _libc.mincore(address, length, vector) != 0:
+                return None
+        finally:
+            _libc.munmap(address, length)
+
+        pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+        flags = vector.raw[:pages].translate(_LOW_BIT)
+        page = flags.find(b"\x01")
+        while page != -1:
+            end = flags.find(b"\x00", page)
+            end = pages if end == -1 else end
+            start_byte = window_start + page * PAGE_SIZE
+            end_byte = min(size, window_start + end * PAGE_SIZE)
+            if runs and runs[-1][1] == start_byte:
+                runs[-1] = (runs[-1][0], end_byte)
+            else:
+                runs.append((start_byte, end_byte))
+            page = flags.find(b"\x01", end)
+    return runs
+
+
+def _run_bytes(runs):
+    return sum(end - start for start, end in runs)
+
+
+class CacheStats:
+    """Totals of what a scan read and how much of it was cached before and after."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes_read = 0
+        self.measured_bytes = 0
+        self.cached_before = 0
+        self.cached_after = 0
+
+    def add(self, bytes_read, cached_before=None, cached_after=None):
+        self.files += 1
+        self.bytes_read += bytes_read
+        if cached_before is not None and cached_after is not None:
+            self.measured_bytes += bytes_read
+            self.cached_before += cached_before
+            self.cached_after += cached_after
+
+    def summary(self):
+        if not self.measured_bytes:
+            return f"Page cache: {self.files} files, {self.bytes_read / 1e9:.2f} GB read, residency not measured"
+        return (f"Page cache: {self.bytes_read / 1e9:.2f} GB read from {self.files} files, "
+                f"{self.cached_before / 1e9:.2f} GB cached before, {self.cached_after / 1e9:.2f} GB after "
+                f"({(self.cached_after - self.cached_before) / 1e9:+.2f} GB)")
+
+
+class BlockReader:
+    """
+    Read a file in blocks with one of the MODES. read() returns the next block
+    or an empty bytes at the end; in direct mode the block is a view of a
+    reused buffer, valid until the next read(). Use as a context manager.
+    """
+
+    def __init__(self, path, mode="normal", stats=None, block_size=BLOCK_SIZE):
+        if mode not in MODES:
+            raise ValueError(f"unknown cache mode: {mode}")
+        self.path = path
+        self.stats = stats
+        self.block_size = block_size
+        self.offset = 0
+        self.buffer = None
+        self.keep = []
+        self.keep_index = 0
+
+        if mode == "direct" and not DIRECT_AVAILABLE:
+            mode = "dontneed"
+        if mode != "normal" and not FADVISE_AVAILABLE:
+            mode = "normal"
+        self.mode = mode
+
+        self.fd = self._open()
+        try:
+            self.size = os.fstat(self.fd).st_size
+            measure = stats is not None or self.mode == "dontneed"
+            self.before = resident_runs(self.fd, self.size) if measure else None
+            if self.mode == "dontneed":
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                # Only pages this reader brought in are dropped again
+                self.keep = self.before or []
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def _open(self):
+        if self.mode == "direct":
+            try:
+                fd = os.open(self.path, os.O_RDONLY | os.O_DIRECT)
+                self.buffer = mmap.mmap(-1, self.block_size)
+                return fd
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.mode = "dontneed"
+        return os.open(self.path, os.O_RDONLY)
+
+    def _fall_back_from_direct(self):
+        # Some file systems accept O_DIRECT at open and reject the reads
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.buffer = None
+        self.mode = "dontneed"
+        os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.keep = self.before or []
+
+    def _drop(self, start, end):
+        """DONTNEED [start, end) except the ranges that were cached before."""
+        keep = self.keep
+        while self.keep_index < len(keep) and keep[self.keep_index][1] <= start:
+            self.keep_index += 1
+        index = self.keep_index
+        while start < end:
+            if index < len(keep) and keep[index][0] < end:
+                keep_start, keep_end = keep[index]
+                if keep_start > start:
+                    os.posix_fadvise(self.fd, start, keep_start - start, os.POSIX_FADV_DONTNEED)
+                start = max(start, keep_end)
+                index += 1
+            else:
+                os.posix_fadvise(self.fd, start, end - start, os.POSIX_FADV_DONTNEED)
+                break
+
+    def read(self):
+        if self.mode == "direct":
+            try:
+                count = os.readv(self.fd, [self.buffer])
+            except OSError as e:
+                if e.errno != errno.EINVAL or self.offset:
+                    raise
+                self._fall_back_from_direct()
+                return self.read()
+            self.offset += count
+            return memoryview(self.buffer)[:count] if count else b""
+
+        data = os.read(self.fd, self.block_size)
+        if self.mode == "dontneed" and data:
+            start = self.offset
+            os.posix_fadvise(self.fd, start + len(data), self.block_size, os.POSIX_FADV_WILLNEED)
+            self._drop(start, start + len(data))
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            if self.stats is not None:
+                after = resident_runs(self.fd, self.size)
+                if self.before is not None and after is not None:
+                    self.stats.add(self.offset, _run_bytes(self.before), _run_bytes(after))
+                else:
+                    self.stats.add(self.offset)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            # Blocks handed out may still reference the buffer; it is freed with them
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
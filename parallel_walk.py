@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Parallel Walk
+-------------
+Multi-threaded directory traversal for file systems where every listing is a
+network round trip (NFS, SMB). os.walk lists one directory at a time; here a
+pool of threads lists directories with os.scandir concurrently, so the walk
+rate grows with the number of workers until the server, not the latency, is
+the limit.
+
+Each worker keeps its own deque of directories to list. It takes work from
+its own end, depth first, and an idle worker steals the oldest directory of
+another, which is usually the root of a large untouched subtree. Exclusion
+rules are applied as in exclusion_rules.walk: excluded directories are never
+listed and symlinked directories are listed but not followed. Directories
+come out in completion order, not in tree order.
+
+The number of workers can be set per mount point in config/parallel_walk.json:
+
+    {
+        "default_workers": 8,
+        "mounts": {"/mnt/projects": 32, "/": 2}
+    }
+"""
+
+import argparse
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import exclusion_rules
+
+WALK_CONFIG_FILE = "config/parallel_walk.json"
+
+DEFAULT_WORKERS = 8
+
+# Listed directories waiting for the consumer; workers block when it is full
+RESULT_QUEUE_SIZE = 1024
+
+_DONE = object()
+
+# Size and modification time of a listed file, the part of its stat the scanners use
+FileStat = collections.namedtuple("FileStat", ["st_size", "st_mtime"])
+
+
+def mount_point(path):
+    """The mount point path is on."""
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def workers_for(path, config_path=WALK_CONFIG_FILE):
+    """Workers configured for the mount point of path, or the default."""
+    if not os.path.exists(config_path):
+        return DEFAULT_WORKERS
+    with open(config_path) as f:
+        config = json.load(f)
+    mounts = {os.path.realpath(mount): workers for mount, workers in config.get("mounts", {}).items()}
+    return int(mounts.get(mount_point(path), config.get("default_workers", DEFAULT_WORKERS)))
+
+
+class _Walker:
+    def __init__(self, top, rules, workers, root, stat):
+        self.top = top
+        self.rules = rules
+        self.root = root or top
+        self.stat = stat
+        self.deques = [collections.deque() for _ in range(workers)]
+        self.condition = threading.Condition()
+        # Directories queued or being listed
+        self.pending = 1
+        self.stopped = False
+        self.results = queue.Queue(RESULT_QUEUE_SIZE)
+        self.deques[0].append(top)
+
+    def _take(self, index):
+        """Next directory for worker index, or None when the walk is over. Called with the lock held."""
+        while not self.stopped:
+            own = self.deques[index]
+            if own:
+                return own.pop()
+            for offset in range(1, len(self.deques)):
+                victim = self.deques[(index + offset) % len(self.deques)]
+                if victim:
+                    return victim.popleft()
+            if not self.pending:
+                return None
+            self.condition.wait()
+        return None
+
+    def _list(self, dirpath):
+        rel_dir = exclusion_rules.relative_path(dirpath, self.root)
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        dirnames = []
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not self.rules.excludes_dir(rel_dir + entry.name, entry.name):
+                            dirnames.append(entry.name)
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                    elif not self.rules.excludes_file(rel_dir + entry.name, entry.name, entry.stat):
+                        if self.stat:
+                            # DirEntry caches the result, so consumers get it for free
+                            try:
+                                entry.stat()
+                            except OSError:
+                                pass
+                        files.append(entry)
+        except OSError:
+            return None, subdirs
+        return (dirpath, dirnames, files), subdirs
+
+    def _work(self, index):
+        try:
+            while True:
+                with self.condition:
+                    dirpath = self._take(index)
+                    if dirpath is None:
+                        self.condition.notify_all()
+                        return
+                result, subdirs = self._list(dirpath)
+                with self.condition:
+                    self.deques[index].extend(reversed(subdirs))
+                    self.pending += len(subdirs) - 1
+                    if subdirs or not self.pending:
+                        self.condition.notify_all()
+                if result is not None:
+                    self.results.put(result)
+        finally:
+            self.results.put(_DONE)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+def walk_entries(top, rules=None, workers=None, root=None, stat=True):
+    """
+    Walk top with a pool of threads. Yields (dirpath, dirnames, file entries)
+    per directory, where the entries are os.DirEntry objects of the files not
+    excluded by rules; with stat their stat() result is already cached.
+    Paths are matched relative to root, which defaults to top. workers
+    defaults to the configured value for the mount of top.
+    """
+    rules = rules or exclusion_rules.load_rules()
+    workers = max(1, workers or workers_for(top))
+    walker = _Walker(top, rules, workers, root, stat)
+    threads = [threading.Thread(target=walker._work, args=(i,), daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    running = workers
+    try:
+        while running:
+            result = walker.results.get()
+            if result is _DONE:
+                running -= 1
+            else:
+                yield result
+    finally:
+        # The consumer stopped early: release workers blocked on a full queue
+        walker.stop()
+        while running:
+            if walker.results.get() is _DONE:
+                running -= 1
+
+
+def cached_stat(entry):
+    """FileStat of an entry from walk_entries, from its cached stat() result; None if it failed."""
+    try:
+        st = entry.stat()
+    except OSError:
+        return None
+    return FileStat(st.st_size, st.st_mtime)
+
+
+def walk(top, rules=None, workers=None, root=None):
+    """
+    Drop-in for exclusion_rules.walk yielding (dirpath, dirnames, filenames),
+    except that pruning dirnames has no effect: subdirectories are queued as
+    soon as a directory is listed.
+    """
+    for dirpath, dirnames, entries in walk_entries(top, rules, workers, root, stat=False):
+        yield dirpath, dirnames, [entry.name for entry in entries]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk a directory tree with a thread pool and report the walk rate.')
+    parser.add_argument('directory_path', type=str, help='directory to walk')
+    parser.add_argument('--workers', type=int, default=None,
+                        help=f'threads (default: from {WALK_CONFIG_FILE} for the mount, else {DEFAULT_WORKERS})')
+    parser.add_argument('--exclusions', type=str, default=None, help='exclusion rules file')
+    parser.add_argument('--compare', action='store_true', help='also time the single-threaded walk')
+    args = parser.parse_args()
+
+    rules = exclusion_rules.load_rules(args.exclusions)
+    workers = args.workers or workers_for(args.directory_path)
+
+    start = time.perf_counter()
+    directories = files = 0
+    for _, _, entries in walk_entries(args.directory_path, rules, workers):
+        directories += 1
+        files += len(entries)
+    elapsed = time.perf_counter() - start
+    print(f"{workers} workers: {directories} directories, {files} files in {elapsed:.2f} s "
+          f"({directories / max(elapsed, 1e-9):.0f} directories/s)")
+
+    if args.compare:
+        start = time.perf_counter()
+        directories = files = 0
+        for _, _, filenames in exclusion_rules.walk(args.directory_path, rules):
+            directories += 1
+            files += len(filenames)
+        elapsed = time.perf_counter() - start
+        print(f"1 thread (exclusion_rules.walk): {directories} directories, {files} files in {elapsed:.2f} s "
+              f"({directories / max(elapsed, 1e-9):.0f} directories/s)")
@@ -1,12 +1,17 @@
-
-
 import mysql.connector
+import mysql.connector.pooling
 import json
 
-def get_database_connection():
+CREDENTIALS_FILE = 'config/credentials.json'
+
+def load_credentials():
     # Load the credentials from the JSON file
-    with open('config/credentials.json') as f:
-        credentials = json.load(f)
+    with open(CREDENTIALS_FILE) as f:
+        return json.load(f)
+
+def get_database_connection(**options):
+    """Connect with the configured credentials; options are passed to mysql.connector.connect."""
+    credentials = load_credentials()
 
     # Connect to the MySQL database
     try:
@@ -14,13 +19,32 @@ def get_database_connection():
             user=credentials['user'],
             password=credentials['password'],
             host=credentials['host'],
-            database=credentials['database']
+            database=credentials['database'],
+            **options
         )
         return cnx
     except mysql.connector.Error as err:
         print(f"Error connecting to the database: {err}")
         return None
 
+def get_connection_pool(pool_size=4, pool_name="file_registry"):
+    """Create a pool of database connections for long-running services."""
+    credentials = load_credentials()
+
+    try:
+        return mysql.connector.pooling.MySQLConnectionPool(
+            pool_name=pool_name,
+            pool_size=pool_size,
+            pool_reset_session=True,
+            user=credentials['user'],
+            password=credentials['password'],
+            host=credentials['host'],
+            database=credentials['database']
+        )
+    except mysql.connector.Error as err:
+        print(f"Error creating the database connection pool: {err}")
+        return None
+
 def is_connection_valid(cnx):
     try:
         # Check if connection is still alive
@@ -28,3 +52,52 @@ def is_connection_valid(cnx):
     except:
         # If an error occurs, assume the connection is not valid
         return False
+
+
+
+def md5_to_bin(md5_hex):
+    """Convert a hex MD5 digest to the BINARY(16) form stored in the database."""
+    return bytes.fromhex(md5_hex) if md5_hex else None
+
+
+def bin_to_hex(digest):
+    """Convert a BINARY(16) digest read from the database back to hex."""
+    return bytes(digest).hex() if digest is not None else None
+
+
+# hostname -> hosts.id, filled as hosts are looked up or registered
+_host_ids = {}
+
+
+def get_host_id(cnx, hostname, ip_address=None, os_version=None, create=True):
+    """
+    Return the hosts dictionary id of hostname.
+
+    With create, the host is registered (and its address and OS refreshed) if
+    needed; otherwise None is returned for unknown hosts.
+    """
+    if hostname in _host_ids:
+        return _host_ids[hostname]
+
+    cursor = cnx.cursor()
+    try:
+        if create:
+            cursor.execute(
+                "INSERT INTO hosts (hostname, ip_address, os_version) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), "
+                "ip_address = COALESCE(VALUES(ip_address), ip_address), "
+                "os_version = COALESCE(VALUES(os_version), os_version)",
+                (hostname, ip_address, os_version))
+            cnx.commit()
+            host_id = cursor.lastrowid
+        else:
+            cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (hostname,))
+            result = cursor.fetchone()
+            if result is None:
+                return None
+            host_id = result[0]
+    finally:
+        cursor.close()
+
+    _host_ids[hostname] = host_id
+    return host_id
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Registry Export
+---------------
+Stream registry tables out to files and back in, with flat memory however
+many rows there are.
+
+export reads hosts, files, file_metadata or scan_log on an unbuffered cursor
+in chunks of CHUNK_SIZE rows, with the host, subtree and scan filters applied
+in the query, and writes them as NDJSON or, when pyarrow is installed, as
+Parquet or Arrow IPC record batches:
+
+    python registry_export.py export files files.parquet --host fileserver1 --under /data/projects
+    python registry_export.py export file_metadata delta.ndjson --after-scan 1200
+
+In NDJSON, digests are hex, dates are "YYYY-MM-DD HH:MM:SS", and paths are
+strings. A path that is not valid UTF-8 is written base64-encoded under
+<column>_b64. The first line names the table and its columns. Parquet and
+Arrow keep digests and paths as binary and record the table name in the
+schema metadata.
+
+import converts a file to tab-separated chunks in a temporary directory and
+loads each with LOAD DATA LOCAL INFILE, the server's bulk-load path:
+
+    python registry_export.py import files.parquet --credentials config/target_credentials.json
+
+With LOCAL the server turns duplicate-key errors into skipped rows, so unless
+duplicates are to be ignored each chunk is loaded into a key-less temporary
+table first and moved with INSERT (or REPLACE) ... SELECT, which fails on the
+first duplicate as a plain INSERT would.
+
+LOAD DATA bypasses the incremental updates of the content_groups and
+directory_sizes aggregates, so importing files or file_metadata rebuilds the
+aggregate derived from it afterwards.
+"""
+
+import argparse
+import base64
+import datetime
+import importlib
+import json
+import os
+import sys
+import tempfile
+
+import mysql.connector
+
+import registry_database
+import registry_paths
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Rows per fetch, record batch and LOAD DATA file
+CHUNK_SIZE = 50000
+
+FORMATS = ("ndjson", "parquet", "arrow")
+
+# Column kinds: int, str, datetime, digest (BINARY, hex in text formats), path (VARBINARY file path)
+TABLES = {
+    "hosts": [("id", "int"), ("hostname", "str"), ("ip_address", "str"), ("os_version", "str")],
+    "files": [("id", "int"), ("host_id", "int"), ("file_path", "path"), ("md5_checksum", "digest"),
+              ("file_size", "int"), ("modification_date", "datetime"), ("duplicate_id", "int"),
+              ("first_seen", "datetime"), ("last_seen", "datetime"), ("status", "str"), ("missed_scans", "int")],
+    "file_metadata": [("id", "int"), ("scan_log_id", "int"), ("file_path", "path"), ("md5_checksum", "digest"),
+                      ("file_size", "int"), ("modification_date", "datetime"), ("scan_date", "datetime"),
+                      ("file_path_hash", "digest"), ("host_id", "int"), ("valid_to_scan_id", "int"),
+                      ("last_verified", "datetime")],
+    "scan_log": [("id", "int"), ("directory_path", "path"), ("host_name", "str"), ("host_ip", "str"),
+                 ("os_version", "str"), ("user_name", "str"), ("date_time_issued", "datetime"),
+                 ("scan_type", "str"), ("status", "str"), ("scan_duration", "int"),
+                 ("scan_start_time", "datetime"), ("scan_end_time", "datetime"), ("files_scanned", "int"),
+                 ("bytes_scanned", "int")],
+}
+
+# Filterable columns of each table: host id column, host name column, path column, scan id column
+FILTER_COLUMNS = {
+    "hosts": {"host_id": "id", "host_name": "hostname"},
+    "files": {"host_id": "host_id", "path": "file_path"},
+    "file_metadata": {"host_id": "host_id", "path": "file_path", "scan": "scan_log_id"},
+    "scan_log": {"host_name": "host_name", "path": "directory_path", "scan": "id"},
+}
+
+# Aggregates maintained incrementally from a table, which LOAD DATA bypasses: module and the
+# command that rebuilds it
+AGGREGATES = {
+    "files": ("content_groups", "python content_groups.py --rebuild"),
+    "file_metadata": ("directory_sizes", "python directory_sizes.py rebuild"),
+}
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def build_query(cnx, table, host=None, under=None, scan=None, after_scan=None):
+    """SELECT for a table with the filters as WHERE conditions, ordered by id. Returns (query, args)."""
+    columns = FILTER_COLUMNS[table]
+    conditions = []
+    args = []
+    if host:
+        if "host_name" in columns:
+            conditions.append(f"{columns['host_name']} = %s")
+            args.append(host)
+        else:
+            host_id = registry_database.get_host_id(cnx, host, create=False)
+            if host_id is None:
+                raise ValueError(f"Host {host} is not in the registry.")
+            conditions.append(f"{columns['host_id']} = %s")
+            args.append(host_id)
+    if under:
+        if "path" not in columns:
+            raise ValueError(f"{table} has no path to filter on")
+        conditions.append(f"{columns['path']} LIKE %s")
+        args.append(registry_paths.prefix_pattern(under))
+    for value, operator in ((scan, "="), (after_scan, ">")):
+        if value is None:
+            continue
+        if "scan" not in columns:
+            raise ValueError(f"{table} has no scan id to filter on")
+        conditions.append(f"{columns['scan']} {operator} %s")
+        args.append(value)
+
+    query = f"SELECT {', '.join(name for name, _ in TABLES[table])} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY id", args
+
+
+def stream_chunks(cnx, query, args, chunk_size=CHUNK_SIZE):
+    """Yield lists of up to chunk_size rows from an unbuffered cursor."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def _json_record(columns, row):
+    record = {}
+    for (name, kind), value in zip(columns, row):
+        if value is None:
+            record[name] = None
+        elif kind == "digest":
+            record[name] = bytes(value).hex()
+        elif kind == "path":
+            value = bytes(value)
+            if registry_paths.is_utf8_path(value):
+                record[name] = value.decode("utf-8")
+            else:
+                record[name + "_b64"] = base64.b64encode(value).decode("ascii")
+        elif kind == "datetime":
+            record[name] = value.strftime(DATE_FORMAT) if hasattr(value, "strftime") else str(value)
+        elif isinstance(value, (bytes, bytearray)):
+            record[name] = bytes(value).decode("utf-8", "replace")
+        else:
+            record[name] = value
+    return record
+
+
+def _arrow_schema(table):
+    types = {"int": pyarrow.int64(), "str": pyarrow.string(), "datetime": pyarrow.timestamp("s"),
+             "digest": pyarrow.binary(), "path": pyarrow.binary()}
+    return pyarrow.schema([(name, types[kind]) for name, kind in TABLES[table]],
+                          metadata={"file_registry_table": table})
+
+
+def _arrow_batch(schema, columns, rows):
+    arrays = []
+    for index, (name, kind) in enumerate(columns):
+        values = [row[index] for row in rows]
+        if kind in ("digest", "path"):
+            values = [bytes(v) if v is not None else None for v in values]
+        elif kind == "str":
+            values = [bytes(v).decode("utf-8", "replace") if isinstance(v, (bytes, bytearray)) else v
+                      for v in values]
+        arrays.append(pyarrow.array(values, type=schema.field(name).type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_table(cnx, table, output_path, output_format="ndjson", host=None, under=None, scan=None,
+                 after_scan=None, chunk_size=CHUNK_SIZE):
+    """Write a table, filtered, to output_path. Returns the number of rows."""
+    if output_format != "ndjson" and not PYARROW_AVAILABLE:
+        raise ValueError(f"{output_format} output needs pyarrow (pip install pyarrow)")
+    query, args = build_query(cnx, table, host, under, scan, after_scan)
+    columns = TABLES[table]
+    count = 0
+
+    if output_format == "ndjson":
+        with open(output_path, "w", encoding="utf-8") as out:
+            out.write(json.dumps({"table": table, "columns": [name for name, _ in columns]}) + "\n")
+            for rows in stream_chunks(cnx, query, args, chunk_size):
+                out.writelines(json.dumps(_json_record(columns, row)) + "\n" for row in rows)
+                count += len(rows)
+        return count
+
+    schema = _arrow_schema(table)
+    if output_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(output_path, schema)
+    else:
+        writer = pyarrow.ipc.new_file(output_path, schema)
+    try:
+        for rows in stream_chunks(cnx, query, args, chunk_size):
+            batch = _arrow_batch(schema, columns, rows)
+            if output_format == "parquet":
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def _format_of(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".parquet":
+        return "parquet"
+    if extension in (".arrow", ".feather", ".ipc"):
+        return "arrow"
+    return "ndjson"
+
+
+def read_records(input_path, input_format=None, chunk_size=CHUNK_SIZE):
+    """
+    Return (table, columns, chunks) for an export file; chunks yields lists of
+    dicts with digests as bytes or hex, paths as bytes and dates as strings or
+    datetimes.
+    """
+    input_format = input_format or _format_of(input_path)
+    if input_format == "ndjson":
+        f = open(input_path, encoding="utf-8")
+        header = json.loads(f.readline())
+
+        def chunks():
+            with f:
+                chunk = []
+                for line in f:
+                    record = json.loads(line)
+                    for key in [key for key in record if key.endswith("_b64")]:
+                        record[key[:-4]] = base64.b64decode(record.pop(key))
+                    chunk.append(record)
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+                if chunk:
+                    yield chunk
+        return header["table"], header["columns"], chunks()
+
+    if not PYARROW_AVAILABLE:
+        raise ValueError(f"{input_format} input needs pyarrow (pip install pyarrow)")
+    if input_format == "parquet":
+        source = pyarrow.parquet.ParquetFile(input_path)
+        schema = source.schema_arrow
+        batches = source.iter_batches(batch_size=chunk_size)
+    else:
+        reader = pyarrow.ipc.open_file(input_path)
+        schema = reader.schema
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    table = (schema.metadata or {}).get(b"file_registry_table", b"").decode() or None
+    return table, schema.names, (batch.to_pylist() for batch in batches)
+
+
+def _tsv_field(kind, value):
+    """One field for LOAD DATA with its default escaping; binary values are hex and UNHEXed on load."""
+    if value is None:
+        return "\\N"
+    if kind == "digest":
+        return value if isinstance(value, str) else bytes(value).hex()
+    if kind == "path":
+        return (value.encode("utf-8", "surrogateescape") if isinstance(value, str) else bytes(value)).hex()
+    if kind == "datetime" and isinstance(value, datetime.datetime):
+        return value.strftime(DATE_FORMAT)
+    value = str(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+            .replace("\r", "\\r").replace("\0", "\\0"))
+
+
+def rebuild_aggregates(cnx, table):
+    """Rebuild the aggregate maintained from table, if any. Returns its name or None."""
+    if table not in AGGREGATES:
+        return None
+    module, _ = AGGREGATES[table]
+    importlib.import_module(module).rebuild(cnx)
+    return module
+
+
+def import_table(cnx, input_path, table=None, input_format=None, on_duplicate="error", chunk_size=CHUNK_SIZE):
+    """
+    Bulk-load an export file into its table (or table) with LOAD DATA LOCAL
+    INFILE, one temporary file of chunk_size rows at a time, each committed.
+    on_duplicate is "error", "ignore" or "replace"; a duplicate in error mode
+    raises ValueError, with the chunks before it loaded. The connection must
+    allow local infile. Aggregates are not updated; see rebuild_aggregates.
+    Returns (table, rows loaded, duplicate rows skipped).
+    """
+    file_table, file_columns, chunks = read_records(input_path, input_format, chunk_size)
+    table = table or file_table
+    if table not in TABLES:
+        raise ValueError(f"unknown table {table}; pass --table")
+    columns = [(name, kind) for name, kind in TABLES[table] if name in file_columns]
+
+    targets = [f"@{name}" if kind in ("digest", "path") else name for name, kind in columns]
+    unhex = [f"{name} = UNHEX(@{name})" for name, kind in columns if kind in ("digest", "path")]
+    if on_duplicate not in ("error", "ignore", "replace"):
+        raise ValueError(f"unknown duplicate handling {on_duplicate}")
+    names = ", ".join(name for name, _ in columns)
+    # Skipping duplicates is what LOCAL does anyway; the other modes go through staging
+    staging = None if on_duplicate == "ignore" else "registry_import_staging"
+    statement = (f"LOAD DATA LOCAL INFILE %s {'IGNORE' if staging is None else ''} INTO TABLE {staging or table} "
+                 f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({', '.join(targets)})")
+    if unhex:
+        statement += " SET " + ", ".join(unhex)
+    move = (f"{'REPLACE' if on_duplicate == 'replace' else 'INSERT'} INTO {table} ({names}) "
+            f"SELECT {names} FROM {staging}")
+
+    loaded = skipped = 0
+    cursor = cnx.cursor()
+    with tempfile.TemporaryDirectory(prefix="registry-import-") as directory:
+        chunk_path = os.path.join(directory, "chunk.tsv")
+        try:
+            if staging:
+                # Same columns without keys, so nothing in the file is dropped on the way
+                cursor.execute(f"CREATE TEMPORARY TABLE {staging} SELECT {names} FROM {table} LIMIT 0")
+            for records in chunks:
+                with open(chunk_path, "w", encoding="utf-8", newline="\n") as out:
+                    for record in records:
+                        out.write("\t".join(_tsv_field(kind, record.get(name)) for name, kind in columns) + "\n")
+                cursor.execute(statement, (chunk_path,))
+                if staging is None:
+                    loaded += cursor.rowcount
+                    skipped += len(records) - cursor.rowcount
+                    cnx.commit()
+                    continue
+                staged = cursor.rowcount
+                try:
+                    cursor.execute(move)
+                except mysql.connector.IntegrityError as e:
+                    cnx.rollback()
+                    raise ValueError(f"{e.msg}; {loaded} rows of earlier chunks were loaded. "
+                                     f"Use --on-duplicate ignore or replace") from e
+                cnx.commit()
+                # REPLACE reports a replaced row twice; every staged row was stored
+                loaded += staged if on_duplicate == "replace" else cursor.rowcount
+                cursor.execute(f"TRUNCATE TABLE {staging}")
+        finally:
+            if staging:
+                cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging}")
+            cursor.close()
+    return table, loaded, skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream registry tables to NDJSON, Parquet or Arrow files and bulk-load them back.')
+    parser.add_argument('--credentials', type=str, default=None,
+                        help=f'database credentials file (default: {registry_database.CREDENTIALS_FILE})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='write a table to a file')
+    export_parser.add_argument('table', choices=list(TABLES), help='table to export')
+    export_parser.add_argument('output', type=str, help='file to write')
+    export_parser.add_argument('--format', choices=FORMATS, default=None,
+                               help='output format (default: from the file extension, else ndjson)')
+    export_parser.add_argument('--host', type=str, default=None, help='only rows of this host')
+    export_parser.add_argument('--under', type=str, default=None, help='only paths below this directory')
+    export_parser.add_argument('--scan', type=int, default=None, help='only rows written by this scan_log id')
+    export_parser.add_argument('--after-scan', type=int, default=None,
+                               help='only rows of scans after this scan_log id (incremental export)')
+
+    import_parser = subparsers.add_parser('import', help='bulk-load a file written by export')
+    import_parser.add_argument('input', type=str, help='file to load')
+    import_parser.add_argument('--table', choices=list(TABLES), default=None,
+                               help='target table (default: the table recorded in the file)')
+    import_parser.add_argument('--format', choices=FORMATS, default=None,
+                               help='input format (default: from the file extension, else ndjson)')
+    import_parser.add_argument('--on-duplicate', choices=['error', 'ignore', 'replace'], default='error',
+                               help='rows whose key already exists: fail, skip or replace them (default: error)')
+    import_parser.add_argument('--no-rebuild', action='store_true',
+                               help='do not rebuild content_groups / directory_sizes afterwards '
+                                    '(when importing several files; rebuild after the last)')
+
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                               help=f'rows per fetch, batch or load file (default: {CHUNK_SIZE})')
+    args = parser.parse_args()
+
+    if args.credentials:
+        registry_database.CREDENTIALS_FILE = args.credentials
+
+    # LOAD DATA LOCAL has to be enabled on the client side
+    cnx = registry_database.get_database_connection(allow_local_infile=args.command == 'import')
+    if not cnx or not registry_database.is_connection_valid(cnx):
+        print("Failed to connect to the database or connection timed out.")
+        sys.exit(1)
+    try:
+        if args.command == 'export':
+            count = export_table(cnx, args.table, args.output, args.format or _format_of(args.output),
+                                 args.host, args.under, args.scan, args.after_scan, args.chunk_size)
+            print(f"Exported {count} {args.table} rows to {args.output}")
+        else:
+            table, count, skipped = import_table(cnx, args.input, args.table, args.format, args.on_duplicate,
+                                                 args.chunk_size)
+            print(f"Imported {count} rows from {args.input}" + (f", {skipped} duplicates skipped" if skipped else ""))
+            if table in AGGREGATES and args.no_rebuild:
+                aggregate, command = AGGREGATES[table]
+                print(f"{aggregate} is now out of date; run `{command}` after the last import")
+            elif table in AGGREGATES:
+                print(f"Rebuilding {AGGREGATES[table][0]} ...")
+                rebuild_aggregates(cnx, table)
+    except ValueError as e:
+        print(e)
+        sys.exit(2)
+    finally:
+        cnx.close()
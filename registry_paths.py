@@ -0,0 +1,76 @@
+"""
+Registry Paths
+--------------
+Lossless handling of file paths that are not valid UTF-8.
+
+Paths stay as the str values os.walk and os.scandir return, where undecodable
+bytes are carried as surrogate escapes, from the walk through hashing. They are
+stored in VARBINARY columns as the exact bytes the filesystem uses, and are only
+decoded for humans when printed or written to a log.
+"""
+
+import hashlib
+import os
+
+
+def path_to_db(path):
+    """Return the exact filesystem bytes of path, as stored in the database."""
+    return os.fsencode(path)
+
+
+def path_from_db(value):
+    """Turn a stored path back into a str that can be opened again."""
+    if value is None or isinstance(value, str):
+        return value
+    return os.fsdecode(bytes(value))
+
+
+def display_path(path):
+    """Readable form of a path for printing; undecodable bytes are shown as \\xNN."""
+    if isinstance(path, str):
+        if path.isascii():
+            return path
+        path = os.fsencode(path)
+    return bytes(path).decode('utf-8', 'backslashreplace')
+
+
+def is_utf8_path(path):
+    """True if path decodes as UTF-8 without surrogate escapes."""
+    if isinstance(path, str):
+        if path.isascii():
+            return True
+        try:
+            path.encode('utf-8')
+            return True
+        except UnicodeEncodeError:
+            return False
+    try:
+        bytes(path).decode('utf-8')
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def path_hash(path):
+    """MD5 of the path bytes as the BINARY(16) value stored in file_path_hash."""
+    return hashlib.md5(os.fsencode(path)).digest()
+
+
+def escape_like(value):
+    """Escape LIKE wildcards in stored path bytes so they match literally."""
+    return value.replace(b'\\', b'\\\\').replace(b'%', b'\\%').replace(b'_', b'\\_')
+
+
+def like_ignore_case(column):
+    """
+    SQL condition matching a VARBINARY path column against a LIKE pattern
+    without regard to case, as the VARCHAR columns did before paths were
+    stored as bytes. It cannot use an index, so prefix matches stay on the
+    raw bytes.
+    """
+    return f"LOWER(CONVERT({column} USING utf8mb4)) LIKE LOWER(CONVERT(%s USING utf8mb4))"
+
+
+def prefix_pattern(directory_path):
+    """LIKE pattern matching every stored path below directory_path."""
+    return escape_like(path_to_db(os.path.join(directory_path, ''))) + b'%'
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Registry Query Service
+----------------------
+Long-running local HTTP service answering registry searches as JSON.
+Connections come from a pool, pages of results are kept in an LRU cache that
+is dropped whenever scan_log shows a scan starting, finishing or reporting
+progress, and identical concurrent requests share a single database query.
+
+Endpoints (all GET, paginated with ?limit=N&after=<id>):
+    /path?q=<substring>    or /path?prefix=<path prefix>
+    /hash?md5=<hex digest>
+    /size?min=<bytes>&max=<bytes>
+Optional filters: host=<hostname>, status=<status>.
+Paths that are not valid UTF-8 come back with their undecodable bytes as
+\\udcXX escapes (Python's surrogateescape), so they can be opened again.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import registry_database
+import registry_paths
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_ENTRIES = 10000
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# Seconds between checks of scan_log for a new scan
+GENERATION_CHECK_INTERVAL = 5
+
+# Changes whenever a scan is logged, finishes, or a running scan commits
+# changes (the watcher and coordinator touch their row with log_scan.touch_scan)
+GENERATION_QUERY = ("SELECT MAX(id), MAX(scan_end_time), SUM(status = 'in-progress'), "
+                    "COALESCE(SUM(files_scanned), 0) FROM scan_log")
+
+RESULT_COLUMNS = ("id", "hostname", "file_path", "md5_checksum", "file_size",
+                  "modification_date", "last_seen", "status")
+
+SELECT_COLUMNS = ("f.id", "h.hostname", "f.file_path", "f.md5_checksum", "f.file_size",
+                  "f.modification_date", "f.last_seen", "f.status")
+
+
+class QueryError(Exception):
+    """A request that cannot be answered, reported to the client as HTTP 400."""
+
+
+class ResultCache:
+    """LRU cache of result pages, invalidated when scan_log changes."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def set_generation(self, generation):
+        """Clear the cache if generation differs from the one it was filled under."""
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+
+def result_row(row):
+    """Turn a database row into a JSON-ready dict with a hex digest."""
+    result = dict(zip(RESULT_COLUMNS, row))
+    result["md5_checksum"] = registry_database.bin_to_hex(result["md5_checksum"])
+    result["file_path"] = registry_paths.path_from_db(result["file_path"])
+    for column in ("modification_date", "last_seen"):
+        if result[column] is not None:
+            result[column] = result[column].isoformat(sep=" ")
+    return result
+
+
+class QueryService:
+    """Runs registry queries through a connection pool, cache and single-flight guard."""
+
+    def __init__(self, pool_size=4, cache_entries=DEFAULT_CACHE_ENTRIES):
+        self.pool = registry_database.get_connection_pool(pool_size, pool_name="query_service")
+        if self.pool is None:
+            raise RuntimeError("could not create the database connection pool")
+        self.db_slots = threading.BoundedSemaphore(pool_size)
+        self.cache = ResultCache(cache_entries)
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.last_generation_check = 0
+        self.generation_lock = threading.Lock()
+
+    def refresh_generation(self):
+        """Invalidate the cache when a scan has been logged, finished or made progress."""
+        with self.generation_lock:
+            if time.time() - self.last_generation_check < GENERATION_CHECK_INTERVAL:
+                return
+            self.last_generation_check = time.time()
+        with self.db_slots:
+            cnx = self.pool.get_connection()
+            try:
+                cursor = cnx.cursor()
+                cursor.execute(GENERATION_QUERY)
+                generation = tuple(cursor.fetchone())
+                cursor.close()
+            finally:
+                cnx.close()
+        self.cache.set_generation(generation)
+
+    def build_query(self, endpoint, params):
+        """Translate an endpoint and its parameters into (sql, args, limit)."""
+        conditions = []
+        args = []
+
+        if endpoint == "/path":
+            if "prefix" in params:
+                conditions.append("f.file_path LIKE %s")
+                args.append(registry_paths.escape_like(registry_paths.path_to_db(params["prefix"])) + b"%")
+            elif "q" in params:
+                conditions.append(registry_paths.like_ignore_case("f.file_path"))
+                args.append(b"%" + registry_paths.escape_like(registry_paths.path_to_db(params["q"])) + b"%")
+            else:
+                raise QueryError("/path needs q or prefix")
+        elif endpoint == "/hash":
+            if "md5" not in params:
+                raise QueryError("/hash needs md5")
+            conditions.append("f.md5_checksum = %s")
+            try:
+                args.append(registry_database.md5_to_bin(params["md5"]))
+            except ValueError:
+                raise QueryError("md5 must be a hex digest")
+        elif endpoint == "/size":
+            if "min" not in params and "max" not in params:
+                raise QueryError("/size needs min and/or max")
+            try:
+                if "min" in params:
+                    conditions.append("f.file_size >= %s")
+                    args.append(int(params["min"]))
+                if "max" in params:
+                    conditions.append("f.file_size <= %s")
+                    args.append(int(params["max"]))
+            except ValueError:
+                raise QueryError("min and max must be integers")
+        else:
+            raise QueryError(f"unknown endpoint {endpoint}")
+
+        if "host" in params:
+            conditions.append("h.hostname = %s")
+            args.append(params["host"])
+        if "status" in params:
+            conditions.append("f.status = %s")
+            args.append(params["status"])
+
+        try:
+            limit = min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            after = int(params.get("after", 0))
+        except ValueError:
+            raise QueryError("limit and after must be integers")
+        conditions.append("f.id > %s")
+        args.append(after)
+
+        sql = (f"SELECT {', '.join(SELECT_COLUMNS)} FROM files f "
+               f"LEFT JOIN hosts h ON h.id = f.host_id "
+               f"WHERE {' AND '.join(conditions)} ORDER BY f.id LIMIT %s")
+        args.append(limit)
+        return sql, tuple(args), limit
+
+    def stream_rows(self, sql, args):
+        """Yield result rows as dicts straight from the database cursor."""
+        with self.db_slots:
+            cnx = self.pool.get_connection()
+            try:
+                cursor = cnx.cursor()
+                cursor.execute(sql, args)
+                while True:
+                    rows = cursor.fetchmany(500)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield result_row(row)
+                cursor.close()
+            finally:
+                cnx.close()
+
+    def query(self, endpoint, params):
+        """
+        Return an iterable of result rows for a request.
+
+        The first request for a key runs the query and streams it while filling
+        the cache; concurrent requests for the same key wait and reuse it.
+        """
+        self.refresh_generation()
+        sql, args, limit = self.build_query(endpoint, params)
+        key = (sql, args)
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        with self.in_flight_lock:
+            event = self.in_flight.get(key)
+            leader = event is None
+            if leader:
+                event = threading.Event()
+                self.in_flight[key] = event
+
+        if not leader:
+            event.wait()
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            return list(self.stream_rows(sql, args))
+
+        return self._lead(key, sql, args, event)
+
+    def _lead(self, key, sql, args, event):
+        rows = []
+        try:
+            for row in self.stream_rows(sql, args):
+                rows.append(row)
+                yield row
+            self.cache.put(key, rows)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.pop(key, None)
+            event.set()
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def send_json_error(self, code, message):
+        body = json.dumps({"error": message}).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        # Undecodable bytes in the query map to the same surrogate escapes as on disk
+        params = {k: v[-1] for k, v in parse_qs(url.query, errors="surrogateescape").items()}
+
+        if url.path == "/stats":
+            cache = self.service.cache
+            body = json.dumps({"cache_entries": len(cache.entries), "hits": cache.hits,
+                               "misses": cache.misses, "scan_generation": cache.generation}, default=str)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+            return
+
+        try:
+            rows = self.service.query(url.path, params)
+            # Pull the first row before sending headers so query errors become HTTP errors
+            rows = iter(rows)
+            first = next(rows, None)
+        except QueryError as e:
+            self.send_json_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_json_error(500, f"database error: {e}")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        self.write_chunk('{"results": [')
+        count = 0
+        last_id = None
+        buffer = []
+        row = first
+        while row is not None:
+            buffer.append(("," if count else "") + json.dumps(row, default=str))
+            count += 1
+            last_id = row["id"]
+            if len(buffer) >= 200:
+                self.write_chunk("".join(buffer))
+                buffer = []
+            row = next(rows, None)
+        self.write_chunk("".join(buffer))
+
+        limit = min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        next_after = last_id if count == limit else None
+        self.write_chunk(f'], "count": {count}, "next_after": {json.dumps(next_after)}}}')
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve registry searches over local HTTP with pooled connections and a result cache.')
+    parser.add_argument('--bind', type=str, default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--pool-size', type=int, default=4, help='database connections to keep open (default: 4)')
+    parser.add_argument('--cache-entries', type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help=f'result pages kept in the LRU cache (default: {DEFAULT_CACHE_ENTRIES})')
+    args = parser.parse_args()
+
+    QueryRequestHandler.service = QueryService(args.pool_size, args.cache_entries)
+    server = ThreadingHTTPServer((args.bind, args.port), QueryRequestHandler)
+    print(f"Registry query service listening on http://{args.bind}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
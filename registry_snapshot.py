@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Registry Snapshot
+-----------------
+Read-only offline copy of the registry for hosts that need "is this file
+already archived?" answers without reaching the database server.
+
+export writes one file that is memory-mapped by readers and searched in place:
+
+    header     magic, version, row count and section offsets
+    rows       fixed-size records sorted by path hash: path hash, MD5, size,
+               modification time, host id and the location of the path
+    digests    (MD5, row number) pairs sorted by MD5
+    paths      the raw path bytes, in row order
+    folded     the same paths lowercased, at the same relative offsets
+    hosts      JSON map of host id to hostname
+
+Digest and path lookups are binary searches over the mapped arrays, and
+substring searches run over the folded section, ignoring case like the
+database search, so opening a snapshot costs the same however many files it
+holds. Version 1 snapshots have no folded section and search case-sensitively. Exports are written to a temporary file and
+renamed, so readers never see a partial snapshot.
+"""
+
+import argparse
+import calendar
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import registry_paths
+
+MAGIC = b"FRSNAP01"
+VERSION = 2
+
+# magic, version, row count, rows offset, digests offset, paths offset, paths length, hosts offset, hosts length,
+# folded paths offset
+HEADER = struct.Struct("<8sIIQQQQQQQ")
+
+# Version 1 snapshots have no folded paths
+HEADER_V1 = struct.Struct("<8sIIQQQQQQ")
+# path hash, md5, size, modification time, host id, path length, path offset
+ROW = struct.Struct("<16s16sqqIIQ")
+# md5, row number
+DIGEST = struct.Struct("<16sI")
+
+FETCH_SIZE = 5000
+
+SOURCES = {
+    # The files registry, ordered by the same hash registry_paths.path_hash computes
+    "files": ("SELECT UNHEX(MD5(file_path)) AS path_hash, file_path, md5_checksum, file_size, "
+              "modification_date, host_id FROM files WHERE status = 'active' AND md5_checksum IS NOT NULL"),
+    # Current file_metadata versions
+    "metadata": ("SELECT file_path_hash AS path_hash, file_path, md5_checksum, file_size, "
+                 "modification_date, host_id FROM file_metadata WHERE valid_to_scan_id IS NULL"),
+}
+
+
+def _timestamp(value):
+    if value is None:
+        return 0
+    if hasattr(value, "timetuple"):
+        return calendar.timegm(value.timetuple())
+    return int(value)
+
+
+def fold_case(value):
+    """
+    Lowercase path bytes for case-insensitive search. The result has the same
+    length, so folded paths line up with the raw ones; where lowercasing the
+    UTF-8 text would change its length only ASCII letters are folded.
+    """
+    try:
+        folded = value.decode("utf-8").lower().encode("utf-8")
+        if len(folded) == len(value):
+            return folded
+    except UnicodeDecodeError:
+        pass
+    return value.lower()
+
+
+def _hosts(cnx):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT id, hostname FROM hosts")
+        return {str(host_id): hostname for host_id, hostname in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+
+def export_snapshot(cnx, output_path, source="files", host_id=None):
+    """Write a snapshot of the registry to output_path. Returns the number of rows."""
+    query = SOURCES[source]
+    args = []
+    if host_id is not None:
+        query += " AND host_id = %s"
+        args.append(host_id)
+    query += " ORDER BY path_hash"
+
+    directory = os.path.dirname(os.path.abspath(output_path))
+    out = tempfile.NamedTemporaryFile(dir=directory, prefix=".snapshot-", delete=False)
+    paths = tempfile.TemporaryFile(dir=directory)
+    folded = tempfile.TemporaryFile(dir=directory)
+    try:
+        out.write(b"\0" * HEADER.size)
+        digests = []
+        count = 0
+        paths_length = 0
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                for path_hash, file_path, md5_digest, file_size, modification_date, file_host_id in rows:
+                    file_path = bytes(file_path)
+                    md5_digest = bytes(md5_digest)
+                    out.write(ROW.pack(bytes(path_hash), md5_digest, file_size or 0,
+                                       _timestamp(modification_date), file_host_id or 0,
+                                       len(file_path), paths_length))
+                    paths.write(file_path)
+                    folded.write(fold_case(file_path))
+                    paths_length += len(file_path)
+                    digests.append(md5_digest + count.to_bytes(4, "little"))
+                    count += 1
+        finally:
+            cursor.close()
+
+        # The packed entries sort by digest
+        digests.sort()
+        digests_offset = out.tell()
+        for entry in digests:
+            out.write(entry)
+        del digests
+
+        paths_offset = out.tell()
+        paths.seek(0)
+        shutil.copyfileobj(paths, out, 1024 * 1024)
+
+        folded_offset = out.tell()
+        folded.seek(0)
+        shutil.copyfileobj(folded, out, 1024 * 1024)
+
+        hosts = json.dumps(_hosts(cnx)).encode()
+        hosts_offset = out.tell()
+        out.write(hosts)
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, VERSION, count, HEADER.size, digests_offset,
+                              paths_offset, paths_length, hosts_offset, len(hosts), folded_offset))
+        out.close()
+        os.replace(out.name, output_path)
+    except BaseException:
+        out.close()
+        os.unlink(out.name)
+        raise
+    finally:
+        paths.close()
+        folded.close()
+    return count
+
+
+class RegistrySnapshot:
+    """
+    Memory-mapped snapshot reader. Lookups return (path, md5 hex, size,
+    modification time, hostname) tuples; the modification time is the stored
+    DATETIME as seconds since the epoch, read as UTC.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self.rows_offset, self.digests_offset, self.paths_offset,
+         self.paths_length, hosts_offset, hosts_length) = HEADER_V1.unpack_from(self.map, 0)
+        if magic != MAGIC or version not in (1, VERSION):
+            self.close()
+            raise ValueError(f"{path} is not a registry snapshot")
+        self.folded_offset = HEADER.unpack_from(self.map, 0)[9] if version > 1 else None
+        self.hosts = json.loads(self.map[hosts_offset:hosts_offset + hosts_length])
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _row(self, index):
+        _, md5_digest, file_size, mtime, host_id, path_length, path_offset = ROW.unpack_from(
+            self.map, self.rows_offset + index * ROW.size)
+        start = self.paths_offset + path_offset
+        path = registry_paths.path_from_db(self.map[start:start + path_length])
+        return path, md5_digest.hex(), file_size, mtime, self.hosts.get(str(host_id))
+
+    def _lower_bound(self, key, offset, size, count):
+        # First entry whose leading 16 bytes are >= key
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = offset + middle * size
+            if self.map[position:position + 16] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def by_md5(self, md5_checksum):
+        """Yield the files with this MD5 (hex)."""
+        key = bytes.fromhex(md5_checksum)
+        index = self._lower_bound(key, self.digests_offset, DIGEST.size, self.count)
+        while index < self.count:
+            digest, row = DIGEST.unpack_from(self.map, self.digests_offset + index * DIGEST.size)
+            if digest != key:
+                break
+            yield self._row(row)
+            index += 1
+
+    def by_path(self, file_path):
+        """Yield the entries for this exact path, one per host that has it."""
+        key = registry_paths.path_hash(file_path)
+        index = self._lower_bound(key, self.rows_offset, ROW.size, self.count)
+        while index < self.count:
+            position = self.rows_offset + index * ROW.size
+            if self.map[position:position + 16] != key:
+                break
+            row = self._row(index)
+            if row[0] == file_path:
+                yield row
+            index += 1
+
+    def _row_at_path_offset(self, path_offset):
+        # Paths are stored in row order, so the last row starting at or before path_offset holds it
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = ROW.unpack_from(self.map, self.rows_offset + middle * ROW.size)[6]
+            if start <= path_offset:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    def search(self, substring, limit=None, case_sensitive=False):
+        """
+        Yield entries whose path contains substring, in snapshot order. Case is
+        ignored unless case_sensitive, or the snapshot predates folded paths.
+        """
+        needle = registry_paths.path_to_db(substring)
+        if not needle or not self.count:
+            return
+        offset = self.paths_offset
+        if not case_sensitive and self.folded_offset is not None:
+            offset = self.folded_offset
+            needle = fold_case(needle)
+        end = offset + self.paths_length
+        position = offset
+        found = 0
+        while True:
+            position = self.map.find(needle, position, end)
+            if position == -1:
+                return
+            index = self._row_at_path_offset(position - offset)
+            _, _, _, _, _, path_length, path_offset = ROW.unpack_from(self.map, self.rows_offset + index * ROW.size)
+            path_end = offset + path_offset + path_length
+            # Paths are stored back to back, so a match may run into the next one
+            if position + len(needle) > path_end:
+                position += 1
+                continue
+            yield self._row(index)
+            found += 1
+            if limit is not None and found >= limit:
+                return
+            # Continue after this path so a row is reported once
+            position = path_end
+
+
+def file_md5(file_path):
+    hash_md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hash_md5.update(block)
+    return hash_md5.hexdigest()
+
+
+def print_entry(entry):
+    path, md5_checksum, file_size, _, hostname = entry
+    print(f"{md5_checksum}  {file_size:>14}  {hostname or '-'}:{registry_paths.display_path(path)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the registry to a memory-mapped snapshot or look files up in one.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='write a snapshot from the database')
+    export_parser.add_argument('snapshot', type=str, help='snapshot file to write')
+    export_parser.add_argument('--source', choices=sorted(SOURCES), default='files',
+                               help='files registry or current file_metadata versions (default: files)')
+    export_parser.add_argument('--host', type=str, default=None, help='only files of this host')
+
+    lookup_parser = subparsers.add_parser('lookup', help='look files up in a snapshot')
+    lookup_parser.add_argument('snapshot', type=str, help='snapshot file to read')
+    group = lookup_parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--md5', type=str, help='files with this MD5')
+    group.add_argument('--file', type=str, help='hash a local file and list its archived copies')
+    group.add_argument('--path', type=str, help='entries for this exact path')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        import registry_database
+
+        cnx = registry_database.get_database_connection()
+        if cnx and registry_database.is_connection_valid(cnx):
+            host_id = registry_database.get_host_id(cnx, args.host, create=False) if args.host else None
+            if args.host and host_id is None:
+                print(f"Host {args.host} is not in the registry.")
+            else:
+                count = export_snapshot(cnx, args.snapshot, args.source, host_id)
+                print(f"Wrote {count} files to {args.snapshot}")
+            cnx.close()
+        else:
+            print("Failed to connect to the database or connection timed out.")
+    else:
+        with RegistrySnapshot(args.snapshot) as snapshot:
+            if args.path:
+                entries = list(snapshot.by_path(args.path))
+            else:
+                md5_checksum = args.md5 or file_md5(args.file)
+                entries = list(snapshot.by_md5(md5_checksum))
+            for entry in entries:
+                print_entry(entry)
+            print(f"{len(entries)} matching entries in {len(snapshot)} files")
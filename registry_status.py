@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Registry Status Tracking
+------------------------
+Keeps files.last_seen and files.status in step with what scans observe.
+A scan stamps last_seen for every path it sees under its root, then a single
+reconciliation pass over that root moves unseen rows to 'missing' (and to
+'likely_deleted' after several missed scans), reactivates rows that came back
+and totals the space that is still live.
+"""
+
+import argparse
+import platform
+
+import content_groups
+import registry_database
+import registry_paths
+
+# Number of consecutive missed scans before a file is considered likely deleted
+DEFAULT_LIKELY_DELETED_AFTER = 3
+
+# Rows per bulk UPDATE statement
+BATCH_SIZE = 1000
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def mark_files_seen(cnx, hostname, file_paths, seen_time):
+    """Bulk-stamp last_seen for the given paths of this host."""
+    host_id = registry_database.get_host_id(cnx, hostname, create=False)
+    if host_id is None:
+        return
+    cursor = cnx.cursor()
+    try:
+        for batch in _chunks([registry_paths.path_to_db(p) for p in file_paths]):
+            placeholders = ", ".join(["%s"] * len(batch))
+            query = (f"UPDATE files SET last_seen = %s "
+                     f"WHERE host_id = %s AND file_path IN ({placeholders})")
+            cursor.execute(query, (seen_time, host_id, *batch))
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+# Rows under a scanned root; the LIKE prefix is served by idx_files_host_path
+_UNDER_ROOT = "host_id = %s AND file_path LIKE %s"
+_SEEN = "last_seen >= %s"
+_UNSEEN = "(last_seen IS NULL OR last_seen < %s)"
+
+
+def _group_changes(cursor, host_id, condition, args, copies):
+    """content_groups changes for the rows matching condition, grouped by content."""
+    cursor.execute(f"SELECT md5_checksum, file_size, COUNT(*) FROM files WHERE {condition} "
+                   f"GROUP BY md5_checksum, file_size", args)
+    return [(host_id, md5_digest, file_size, copies * count) for md5_digest, file_size, count in cursor.fetchall()]
+
+
+def reconcile_scan(cnx, hostname, directory_path, scan_start,
+                   likely_deleted_after=DEFAULT_LIKELY_DELETED_AFTER):
+    """
+    Update statuses under directory_path after a scan that started at scan_start.
+
+    Rows stamped before scan_start were not observed by the scan. Each
+    transition is one set-based statement over the root; history rows and
+    content_groups changes are derived from the same conditions before the
+    update. Returns a space summary, excluding deleted data.
+    """
+    summary = {
+        'active_files': 0, 'active_bytes': 0,
+        'missing_files': 0, 'missing_bytes': 0,
+        'newly_missing': 0, 'likely_deleted': 0, 'reactivated': 0,
+    }
+
+    host_id = registry_database.get_host_id(cnx, hostname, create=False)
+    if host_id is None:
+        return summary
+
+    root = (host_id, registry_paths.prefix_pattern(directory_path))
+    reactivated = f"{_UNDER_ROOT} AND {_SEEN} AND status IN ('missing', 'likely_deleted')"
+    unseen = f"{_UNDER_ROOT} AND {_UNSEEN} AND status IN ('active', 'missing')"
+    # Status an unseen row moves to, from its missed_scans before the update
+    next_status = "IF(missed_scans + 1 >= %s, 'likely_deleted', 'missing')"
+
+    cursor = cnx.cursor()
+    try:
+        group_changes = _group_changes(cursor, host_id, reactivated, (*root, scan_start), 1)
+        group_changes += _group_changes(cursor, host_id, f"{unseen} AND status = 'active'", (*root, scan_start), -1)
+
+        # The summary in the same aggregate pass: seen rows end up active,
+        # unseen active/missing ones missing or likely deleted
+        seen = f"({_SEEN})"
+        stays_missing = f"({_UNSEEN} AND status <> 'likely_deleted' AND missed_scans + 1 < %s)"
+        cursor.execute(
+            f"SELECT COALESCE(SUM({seen}), 0), COALESCE(SUM(IF({seen}, file_size, 0)), 0), "
+            f"COALESCE(SUM({stays_missing}), 0), COALESCE(SUM(IF({stays_missing}, file_size, 0)), 0), "
+            f"COALESCE(SUM({stays_missing} AND status = 'active'), 0), "
+            f"COALESCE(SUM({_UNSEEN} AND status <> 'likely_deleted' AND missed_scans + 1 >= %s), 0) "
+            f"FROM files WHERE {_UNDER_ROOT} AND status IN ('active', 'missing', 'likely_deleted')",
+            (scan_start, scan_start,
+             scan_start, likely_deleted_after, scan_start, likely_deleted_after,
+             scan_start, likely_deleted_after,
+             scan_start, likely_deleted_after, *root))
+        (active_files, active_bytes, missing_files, missing_bytes,
+         newly_missing, likely_deleted) = cursor.fetchone()
+        summary.update(active_files=int(active_files), active_bytes=int(active_bytes),
+                       missing_files=int(missing_files), missing_bytes=int(missing_bytes),
+                       newly_missing=int(newly_missing), likely_deleted=int(likely_deleted))
+
+        cursor.execute(
+            f"INSERT INTO file_history (file_id, event_type, old_status, new_status) "
+            f"SELECT id, 'status_change', status, 'active' FROM files WHERE {reactivated}",
+            (*root, scan_start))
+        cursor.execute(
+            f"INSERT INTO file_history (file_id, event_type, old_status, new_status) "
+            f"SELECT id, 'status_change', status, {next_status} FROM files "
+            f"WHERE {unseen} AND status <> {next_status}",
+            (likely_deleted_after, *root, scan_start, likely_deleted_after))
+
+        cursor.execute(f"UPDATE files SET status = 'active', missed_scans = 0 WHERE {reactivated}",
+                       (*root, scan_start))
+        summary['reactivated'] = cursor.rowcount
+        # status is assigned first so it sees missed_scans before the increment
+        cursor.execute(f"UPDATE files SET status = {next_status}, missed_scans = missed_scans + 1 WHERE {unseen}",
+                       (likely_deleted_after, *root, scan_start))
+
+        content_groups.apply_changes(cnx, group_changes)
+        cnx.commit()
+    finally:
+        cursor.close()
+
+    return summary
+
+
+def get_space_usage(cnx, hostname, directory_path):
+    """Return (file_count, total_bytes) of active files under directory_path."""
+    host_id = registry_database.get_host_id(cnx, hostname, create=False)
+    if host_id is None:
+        return 0, 0
+    cursor = cnx.cursor()
+    try:
+        query = ("SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM files "
+                 "WHERE host_id = %s AND status = 'active' AND file_path LIKE %s")
+        cursor.execute(query, (host_id, registry_paths.prefix_pattern(directory_path)))
+        count, total = cursor.fetchone()
+        return count, int(total)
+    finally:
+        cursor.close()
+
+
+def print_summary(summary):
+    """Print a reconciliation summary."""
+    print(f"Active files: {summary['active_files']} ({summary['active_bytes'] / 1e9:.2f} GB)")
+    print(f"Missing files: {summary['missing_files']} ({summary['missing_bytes'] / 1e9:.2f} GB), "
+          f"{summary['newly_missing']} newly missing")
+    print(f"Marked likely deleted: {summary['likely_deleted']}")
+    print(f"Reactivated: {summary['reactivated']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report active space used under a directory in the registry.')
+    parser.add_argument('directory_path', type=str, help='the directory to report on')
+    parser.add_argument('--host', type=str, default=platform.node(), help='hostname to report on (default: this host)')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        count, total = get_space_usage(cnx, args.host, args.directory_path)
+        print(f"{registry_paths.display_path(args.directory_path)} on {args.host}: {count} active files, {total / 1e9:.2f} GB")
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
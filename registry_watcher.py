@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""
+Registry Watcher
+----------------
+Linux daemon that keeps the registry current between full scans. It watches
+the configured roots with inotify, coalesces bursts of events, hashes only
+the files that changed through md5_metadata_scanner and applies the results
+to files, file_metadata and file_history in batches. When the kernel event
+queue overflows, events were lost, so the roots are rescanned for files
+modified since the last flush and reconciled against the registry for files
+deleted in the meantime.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import select
+import socket
+import struct
+import time
+from datetime import datetime
+
+import content_groups
+import directory_sizes
+import exclusion_rules
+import log_scan
+import md5_metadata_scanner
+import metadata_snapshots
+import registry_database
+import registry_paths
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds without new events before pending changes are flushed
+DEFAULT_SETTLE_SECONDS = 2.0
+
+# Longest time a change may stay pending during a continuous burst
+DEFAULT_MAX_DELAY = 30.0
+
+# Pending paths that force a flush regardless of timing
+DEFAULT_BATCH_SIZE = 5000
+
+# Slack subtracted from the last flush time when rescanning after an overflow
+OVERFLOW_SLACK_SECONDS = 5
+
+# Kinds of pending change
+CHANGED = "changed"
+DELETED = "deleted"
+DELETED_TREE = "deleted_tree"
+
+
+class Inotify:
+    """Minimal ctypes binding for the inotify system calls."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """Yield (wd, mask, cookie, name) for every event currently queued."""
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RegistryWatcher:
+    """Turns inotify events under a set of roots into batched registry updates."""
+
+    def __init__(self, cnx, roots, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 max_delay=DEFAULT_MAX_DELAY, batch_size=DEFAULT_BATCH_SIZE, verbose=False, rules=None):
+        self.cnx = cnx
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.rules = rules or exclusion_rules.load_rules()
+        self.settle_seconds = settle_seconds
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.verbose = verbose
+
+        self.hostname = platform.node()
+        self.ip_address = socket.gethostbyname(self.hostname)
+        self.os_version = platform.platform()
+        self.host_id = None
+
+        self.inotify = Inotify()
+        self.watches = {}
+        self.pending = {}
+        self.first_pending = None
+        self.last_event = None
+        self.last_flush = time.time()
+        self.scan_log_id = None
+
+    # Watch management
+
+    def root_of(self, path):
+        """The watched root containing path; exclusion rules are relative to it."""
+        matches = [root for root in self.roots if path == root or path.startswith(os.path.join(root, ''))]
+        return max(matches, key=len) if matches else path
+
+    def watch_tree(self, top):
+        """Add watches for top and every directory below it. Returns the files found."""
+        files = []
+        for root, dirs, filenames in exclusion_rules.walk(top, self.rules, self.root_of(top)):
+            try:
+                wd = self.inotify.add_watch(root)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    print("ERROR: inotify watch limit reached; raise fs.inotify.max_user_watches")
+                    return files
+                print(f"Could not watch {registry_paths.display_path(root)}: {e}")
+                continue
+            self.watches[wd] = root
+            files.extend(os.path.join(root, f) for f in filenames)
+        return files
+
+    def queue(self, path, kind):
+        now = time.time()
+        self.pending[path] = kind
+        self.last_event = now
+        if self.first_pending is None:
+            self.first_pending = now
+
+    # Event handling
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            print("inotify queue overflow, rescanning for missed changes")
+            self.rescan_since(self.last_flush - OVERFLOW_SLACK_SECONDS)
+            return
+
+        directory = self.watches.get(wd)
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if directory is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            return
+
+        path = os.path.join(directory, name) if name else directory
+
+        if mask & IN_ISDIR:
+            if self.rules.excludes(path, self.root_of(path), is_dir=True):
+                return
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may already exist in a directory moved or copied in
+                for file_path in self.watch_tree(path):
+                    self.queue(file_path, CHANGED)
+            elif mask & IN_MOVED_FROM:
+                self.queue(path, DELETED_TREE)
+            return
+
+        if self.rules.excludes(path, self.root_of(path), is_dir=False):
+            return
+        if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.queue(path, CHANGED)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.queue(path, DELETED)
+
+    def rescan_since(self, since):
+        """
+        Queue every file under the roots modified after since, re-adding
+        watches, and every registered file under them that no longer exists.
+        """
+        for root in self.roots:
+            found = set(self.watch_tree(root))
+            for file_path in found:
+                try:
+                    if os.stat(file_path).st_mtime >= since:
+                        self.queue(file_path, CHANGED)
+                except OSError:
+                    self.queue(file_path, DELETED)
+            # Deletions lost with the overflowed events
+            for file_path in self.registered_files(root):
+                if file_path not in found and not os.path.lexists(file_path):
+                    self.queue(file_path, DELETED)
+
+    def registered_files(self, directory):
+        """Paths of this host's files under directory that the registry does not consider deleted."""
+        cursor = self.cnx.cursor()
+        try:
+            cursor.execute(
+                "SELECT file_path FROM files WHERE host_id = %s AND file_path LIKE %s AND status != 'deleted'",
+                (self.host_id, registry_paths.prefix_pattern(directory)))
+            return [registry_paths.path_from_db(row[0]) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def should_flush(self):
+        if not self.pending:
+            return False
+        now = time.time()
+        return (len(self.pending) >= self.batch_size
+                or now - self.last_event >= self.settle_seconds
+                or now - self.first_pending >= self.max_delay)
+
+    # Registry updates
+
+    def flush(self):
+        """Hash changed files and apply all pending changes in one transaction."""
+        pending = self.pending
+        self.pending = {}
+        self.first_pending = None
+        self.last_flush = time.time()
+
+        changed = []
+        deleted = []
+        deleted_trees = []
+        for path, kind in pending.items():
+            if kind == DELETED_TREE:
+                deleted_trees.append(path)
+            elif kind == DELETED or not os.path.isfile(path):
+                deleted.append(path)
+            else:
+                changed.append(path)
+
+        try:
+            # Removed files lose their current versions before changed files
+            # get new ones, so a directory replaced in place keeps the new ones
+            metadata_snapshots.end_versions(self.cnx, self.scan_log_id, deleted, deleted_trees)
+            hashed = []
+            vanished = []
+            for file_path in changed:
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    vanished.append(file_path)
+                    continue
+                md5_checksum = md5_metadata_scanner.md5(file_path)
+                if not md5_checksum:
+                    continue
+                if md5_metadata_scanner.store_md5_database(self.cnx, file_path, md5_checksum, self.scan_log_id, stat):
+                    modification_date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))
+                    hashed.append((file_path, md5_checksum, stat.st_size, modification_date))
+            metadata_snapshots.end_versions(self.cnx, self.scan_log_id, vanished)
+            deleted.extend(vanished)
+
+            self.record_changes(hashed, deleted, deleted_trees)
+            directory_sizes.flush(self.cnx)
+            if self.scan_log_id:
+                log_scan.touch_scan(self.cnx, self.scan_log_id, len(hashed) + len(deleted) + len(deleted_trees))
+            self.cnx.commit()
+        except Exception as e:
+            self.cnx.rollback()
+            directory_sizes.discard()
+            print(f"Database error while applying changes: {e}")
+            return
+
+        print(f"[{datetime.now():%H:%M:%S}] applied {len(hashed)} changed, "
+              f"{len(deleted)} deleted, {len(deleted_trees)} removed directories")
+
+    def lookup_files(self, cursor, paths):
+        """Map file_path -> (id, md5 digest, status, size) for this host's registered paths."""
+        existing = {}
+        for i in range(0, len(paths), 1000):
+            batch = [registry_paths.path_to_db(p) for p in paths[i:i + 1000]]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(
+                f"SELECT id, file_path, md5_checksum, status, file_size FROM files "
+                f"WHERE host_id = %s AND file_path IN ({placeholders})",
+                (self.host_id, *batch))
+            for file_id, file_path, md5_checksum, status, file_size in cursor.fetchall():
+                existing[registry_paths.path_from_db(file_path)] = (file_id, md5_checksum, status, file_size)
+        return existing
+
+    def record_changes(self, hashed, deleted, deleted_trees):
+        """Write batched files / file_history updates for one flush."""
+        now = datetime.now()
+        cursor = self.cnx.cursor()
+        try:
+            # Active copies gained and lost, for the content_groups aggregate
+            group_changes = []
+
+            # Removed trees go first: a directory replaced within one batch
+            # (mv proj proj.bak; mv proj.new proj) has its new files queued
+            # as changes, which then bring their rows back below
+            for directory in deleted_trees:
+                pattern = registry_paths.prefix_pattern(directory)
+                cursor.execute(
+                    "SELECT md5_checksum, file_size, COUNT(*) FROM files "
+                    "WHERE host_id = %s AND file_path LIKE %s AND status = 'active' "
+                    "GROUP BY md5_checksum, file_size",
+                    (self.host_id, pattern))
+                group_changes.extend((self.host_id, md5_checksum, file_size, -count)
+                                     for md5_checksum, file_size, count in cursor.fetchall())
+                cursor.execute(
+                    "INSERT INTO file_history (file_id, event_type, old_md5, old_path, old_status, new_status) "
+                    "SELECT id, 'deleted', md5_checksum, file_path, status, 'deleted' FROM files "
+                    "WHERE host_id = %s AND file_path LIKE %s AND status != 'deleted'",
+                    (self.host_id, pattern))
+                cursor.execute(
+                    "UPDATE files SET status = 'deleted' "
+                    "WHERE host_id = %s AND file_path LIKE %s AND status != 'deleted'",
+                    (self.host_id, pattern))
+
+            existing = self.lookup_files(cursor, [h[0] for h in hashed] + deleted)
+
+            inserts = []
+            updates = []
+            history = []
+            for file_path, md5_checksum, file_size, modification_date in hashed:
+                md5_digest = registry_database.md5_to_bin(md5_checksum)
+                row = existing.get(file_path)
+                if row is None:
+                    inserts.append((self.host_id, registry_paths.path_to_db(file_path), md5_digest,
+                                    file_size, modification_date, now))
+                    group_changes.append((self.host_id, md5_digest, file_size, 1))
+                    continue
+                file_id, old_md5, old_status, old_size = row
+                if old_status == 'active':
+                    group_changes.append((self.host_id, old_md5, old_size, -1))
+                group_changes.append((self.host_id, md5_digest, file_size, 1))
+                updates.append((md5_digest, file_size, modification_date, now, file_id))
+                if old_md5 != md5_digest:
+                    history.append((file_id, 'modified', old_md5, md5_digest, None, None))
+                if old_status != 'active':
+                    history.append((file_id, 'status_change', None, None, old_status, 'active'))
+
+            deleted_ids = []
+            for file_path in deleted:
+                row = existing.get(file_path)
+                if row is not None and row[2] != 'deleted':
+                    deleted_ids.append(row[0])
+                    history.append((row[0], 'deleted', row[1], None, row[2], 'deleted'))
+                    if row[2] == 'active':
+                        group_changes.append((self.host_id, row[1], row[3], -1))
+
+            if inserts:
+                cursor.executemany(
+                    "INSERT INTO files (host_id, file_path, md5_checksum, "
+                    "file_size, modification_date, last_seen) VALUES (%s, %s, %s, %s, %s, %s)",
+                    inserts)
+                created = self.lookup_files(cursor, [h[0] for h in hashed if h[0] not in existing])
+                for file_id, md5_checksum, _, _ in created.values():
+                    history.append((file_id, 'created', None, md5_checksum, None, 'active'))
+            if updates:
+                cursor.executemany(
+                    "UPDATE files SET md5_checksum = %s, file_size = %s, modification_date = %s, "
+                    "last_seen = %s, status = 'active', missed_scans = 0 WHERE id = %s",
+                    updates)
+            for i in range(0, len(deleted_ids), 1000):
+                batch = deleted_ids[i:i + 1000]
+                placeholders = ", ".join(["%s"] * len(batch))
+                cursor.execute(f"UPDATE files SET status = 'deleted' WHERE id IN ({placeholders})", batch)
+            if history:
+                cursor.executemany(
+                    "INSERT INTO file_history (file_id, event_type, old_md5, new_md5, old_status, new_status) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    history)
+            content_groups.apply_changes(self.cnx, group_changes)
+        finally:
+            cursor.close()
+
+    # Main loop
+
+    def run(self):
+        self.host_id = registry_database.get_host_id(self.cnx, self.hostname, self.ip_address, self.os_version)
+        self.scan_log_id = log_scan.log_scan(self.cnx, ", ".join(self.roots), scan_type='watch')
+        for root in self.roots:
+            self.watch_tree(root)
+        roots = ', '.join(registry_paths.display_path(root) for root in self.roots)
+        print(f"Watching {len(self.watches)} directories under {roots}")
+
+        poller = select.poll()
+        poller.register(self.inotify.fd, select.POLLIN)
+        status = 'failed'
+        try:
+            while True:
+                if poller.poll(int(self.settle_seconds * 1000 / 2)):
+                    for wd, mask, cookie, name in self.inotify.read_events():
+                        self.handle_event(wd, mask, name)
+                if self.should_flush():
+                    self.flush()
+                if self.verbose and self.pending:
+                    print(f"{len(self.pending)} changes pending", end='\r')
+        except KeyboardInterrupt:
+            if self.pending:
+                self.flush()
+            status = 'completed'
+        finally:
+            self.inotify.close()
+            if self.scan_log_id:
+                log_scan.finish_scan(self.cnx, self.scan_log_id, status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch directories with inotify and keep the registry up to date.')
+    parser.add_argument('roots', nargs='+', type=str, help='directories to watch')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help=f'seconds of quiet before pending changes are applied (default: {DEFAULT_SETTLE_SECONDS})')
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY,
+                        help=f'longest a change may wait during a burst of events (default: {DEFAULT_MAX_DELAY})')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f'pending changes that force a flush (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--exclusions', type=str, default=None,
+                        help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE})')
+    parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose output.")
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        watcher = RegistryWatcher(cnx, args.roots, args.settle, args.max_delay, args.batch_size, args.verbose,
+                                  exclusion_rules.load_rules(args.exclusions))
+        watcher.run()
+        cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
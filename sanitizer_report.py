@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Sanitizer Report
+----------------
+Streaming record file of files whose names are not valid UTF-8.
+
+The report is newline-delimited JSON, one record per file, written as a scan
+walks the tree. Names keep their undecodable bytes as \\udcXX escapes, so the
+original bytes can be recovered with os.fsencode. When the report is closed a
+small index is written next to it (<report>.idx) holding the byte offset of
+every page of records and the runs of records belonging to each directory, so
+readers can seek straight to a page or a directory instead of loading the
+whole file.
+"""
+
+import json
+import os
+import platform
+import time
+import unicodedata
+
+import registry_paths
+
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+
+# Records between page offsets stored in the index
+PAGE_SIZE = 1000
+
+# Rows per executemany when importing into the database
+IMPORT_BATCH_SIZE = 1000
+
+
+def ascii_equivalent(name):
+    """Closest ASCII spelling of a file name; undecodable bytes stay as \\xNN."""
+    text = unicodedata.normalize('NFKD', registry_paths.display_path(name))
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+def index_path(report_path):
+    return report_path + INDEX_SUFFIX
+
+
+class SanitizerReportWriter:
+    """Append records to a report as they are found; call close() to write the index."""
+
+    def __init__(self, report_path):
+        self.report_path = report_path
+        self.file = open(report_path, 'wb')
+        self.records = 0
+        self.pages = []
+        # directory -> [[offset, count], ...], one run per contiguous block of records
+        self.directories = {}
+        self.current_directory = None
+
+    def add(self, directory_path, file_name):
+        """Record a file whose name is not valid UTF-8."""
+        offset = self.file.tell()
+        if self.records % PAGE_SIZE == 0:
+            self.pages.append(offset)
+        if directory_path != self.current_directory:
+            self.directories.setdefault(directory_path, []).append([offset, 0])
+            self.current_directory = directory_path
+        self.directories[directory_path][-1][1] += 1
+
+        record = {
+            "file_name": file_name,
+            "ascii_name": ascii_equivalent(file_name),
+            "directory_path": directory_path,
+        }
+        self.file.write(json.dumps(record).encode('ascii') + b'\n')
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+        index = {
+            "version": INDEX_VERSION,
+            "records": self.records,
+            "page_size": PAGE_SIZE,
+            "pages": self.pages,
+            "directories": self.directories,
+            "host": platform.node(),
+            "created": time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(index_path(self.report_path), 'w') as f:
+            json.dump(index, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_report(report_path, directory_path):
+    """Walk directory_path and write a report of every non-UTF-8 file name. Returns the record count."""
+    with SanitizerReportWriter(report_path) as writer:
+        for root, dirs, files in os.walk(directory_path):
+            for file_name in files:
+                if not registry_paths.is_utf8_path(file_name):
+                    writer.add(root, file_name)
+        return writer.records
+
+
+def load_index(report_path):
+    """Return the report's index, or None if it has none (e.g. the scan was interrupted)."""
+    try:
+        with open(index_path(report_path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _read_run(file, offset, count):
+    file.seek(offset)
+    for _ in range(count):
+        line = file.readline()
+        if not line:
+            return
+        yield json.loads(line)
+
+
+def _directory_matches(directory, directory_prefix, recursive):
+    if directory == directory_prefix:
+        return True
+    return recursive and directory.startswith(os.path.join(directory_prefix, ''))
+
+
+def read_records(report_path, directory=None, recursive=False, offset=0, limit=None):
+    """
+    Yield report records in file order, optionally only those of directory
+    (and its subdirectories when recursive), skipping the first offset matches
+    and stopping after limit. Uses the index to seek when there is one.
+    """
+    index = load_index(report_path)
+    remaining = limit
+
+    with open(report_path, 'rb') as file:
+        if index is None:
+            # No index: stream the whole file
+            runs = [(0, None)]
+        elif directory is None:
+            page = offset // index["page_size"]
+            if page >= len(index["pages"]):
+                return
+            runs = [(index["pages"][page], None)]
+            offset -= page * index["page_size"]
+        else:
+            runs = sorted(run for path, path_runs in index["directories"].items()
+                          if _directory_matches(path, directory, recursive)
+                          for run in path_runs)
+            # Skip whole runs before reading any records
+            while runs and offset >= runs[0][1]:
+                offset -= runs[0][1]
+                runs.pop(0)
+
+        for run_offset, count in runs:
+            if count is None:
+                file.seek(run_offset)
+                records = (json.loads(line) for line in file)
+            else:
+                records = _read_run(file, run_offset, count)
+            for record in records:
+                if index is None and directory is not None and not _directory_matches(
+                        record["directory_path"], directory, recursive):
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                if remaining is not None:
+                    if remaining <= 0:
+                        return
+                    remaining -= 1
+                yield record
+
+
+def import_report(cnx, report_path, hostname=None):
+    """Bulk-load a report into the non_utf8_files table. Returns the number of rows added."""
+    import registry_database
+
+    index = load_index(report_path)
+    hostname = hostname or (index or {}).get("host") or platform.node()
+    host_id = registry_database.get_host_id(cnx, hostname)
+    report_date = (index or {}).get("created") or time.strftime('%Y-%m-%d %H:%M:%S')
+
+    query = ("INSERT INTO non_utf8_files (host_id, directory_path, file_name, ascii_name, report_date) "
+             "VALUES (%s, %s, %s, %s, %s)")
+    cursor = cnx.cursor()
+    try:
+        batch = []
+        imported = 0
+        for record in read_records(report_path):
+            batch.append((host_id, registry_paths.path_to_db(record["directory_path"]),
+                          registry_paths.path_to_db(record["file_name"]), record["ascii_name"], report_date))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                cursor.executemany(query, batch)
+                cnx.commit()
+                imported += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(query, batch)
+            cnx.commit()
+            imported += len(batch)
+        return imported
+    finally:
+        cursor.close()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Distributed Scan Coordinator
+----------------------------
+Splits a scan root into subtree work units stored in the scan_work_units table.
+Workers on any host (or several local processes) lease units with a timeout,
+hash their files through md5_metadata_scanner and report completion into
+scan_log. A worker that finds its unit too large hands the directories it has
+not reached yet back to the queue so idle workers can pick them up.
+"""
+
+import argparse
+import multiprocessing
+import os
+import platform
+import time
+
+import directory_sizes
+import exclusion_rules
+import log_scan
+import md5_metadata_scanner
+import page_cache
+import registry_database
+import registry_paths
+
+# Seconds a lease stays valid without a heartbeat
+DEFAULT_LEASE_SECONDS = 300
+
+# Files a worker processes in one unit before giving away unvisited subdirectories
+DEFAULT_SPLIT_THRESHOLD = 20000
+
+# Leases granted to the same unit before it is marked failed
+MAX_ATTEMPTS = 3
+
+# Seconds an idle worker waits before polling the queue again
+POLL_INTERVAL = 5
+
+
+def worker_name():
+    """Identify this worker as host:pid in lease_owner."""
+    return f"{platform.node()}:{os.getpid()}"
+
+
+def add_work_units(cnx, job_id, directories, include_subdirs=True, parent_unit_id=None):
+    """Queue a batch of directories as pending work units."""
+    if not directories:
+        return
+    cursor = cnx.cursor()
+    try:
+        query = ("INSERT INTO scan_work_units "
+                 "(job_id, directory_path, include_subdirs, parent_unit_id) "
+                 "VALUES (%s, %s, %s, %s)")
+        cursor.executemany(query, [(job_id, registry_paths.path_to_db(d), 1 if include_subdirs else 0, parent_unit_id)
+                                   for d in directories])
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def _list_directory(directory_path, rules, root):
+    """Return (files, subdirectories) of a directory, honouring the exclusion rules relative to root."""
+    files = []
+    subdirs = []
+    rel_dir = exclusion_rules.relative_path(directory_path, root)
+    rel_dir = "" if rel_dir == "." else rel_dir + "/"
+    try:
+        with os.scandir(directory_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not rules.excludes_dir(rel_dir + entry.name, entry.name):
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if not rules.excludes_file(rel_dir + entry.name, entry.name, entry.stat):
+                            files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print(f"Could not list {registry_paths.display_path(directory_path)}: {e}")
+    return files, subdirs
+
+
+def job_root(cnx, job_id):
+    """Return the root directory a job was submitted for."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT directory_path FROM scan_log WHERE id = %s", (job_id,))
+        row = cursor.fetchone()
+        return registry_paths.path_from_db(row[0]) if row else None
+    finally:
+        cursor.close()
+
+
+def create_job(cnx, root_path, split_depth=1, rules=None):
+    """
+    Register a distributed scan of root_path and queue its initial work units.
+
+    Directories above split_depth become non-recursive units covering their own
+    files; directories at split_depth become recursive units. Returns the
+    scan_log id of the job.
+    """
+    rules = rules or exclusion_rules.load_rules()
+    job_id = log_scan.log_scan(cnx, root_path, scan_type='distributed')
+    if job_id is None:
+        return None
+
+    frontier = [root_path]
+    for _ in range(split_depth):
+        add_work_units(cnx, job_id, frontier, include_subdirs=False)
+        next_frontier = []
+        for directory_path in frontier:
+            _, subdirs = _list_directory(directory_path, rules, root_path)
+            next_frontier.extend(subdirs)
+        frontier = next_frontier
+    add_work_units(cnx, job_id, frontier, include_subdirs=True)
+
+    return job_id
+
+
+def lease_unit(cnx, job_id, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Lease the next pending or expired unit of a job.
+
+    Leases are taken with a conditional UPDATE so that concurrent workers never
+    hold the same unit. Returns (unit_id, directory_path, include_subdirs) or None.
+    """
+    cursor = cnx.cursor()
+    try:
+        # Units leased too many times are given up on
+        cursor.execute(
+            "UPDATE scan_work_units SET status = 'failed' "
+            "WHERE job_id = %s AND status = 'leased' AND lease_expires < NOW() AND attempts >= %s",
+            (job_id, MAX_ATTEMPTS))
+        cnx.commit()
+
+        cursor.execute(
+            "SELECT id FROM scan_work_units "
+            "WHERE job_id = %s AND (status = 'pending' OR (status = 'leased' AND lease_expires < NOW())) "
+            "ORDER BY id LIMIT 16",
+            (job_id,))
+        candidates = [row[0] for row in cursor.fetchall()]
+
+        for unit_id in candidates:
+            cursor.execute(
+                "UPDATE scan_work_units "
+                "SET status = 'leased', lease_owner = %s, "
+                "lease_expires = NOW() + INTERVAL %s SECOND, attempts = attempts + 1 "
+                "WHERE id = %s AND (status = 'pending' OR (status = 'leased' AND lease_expires < NOW()))",
+                (owner, lease_seconds, unit_id))
+            cnx.commit()
+            if cursor.rowcount == 1:
+                cursor.execute(
+                    "SELECT id, directory_path, include_subdirs FROM scan_work_units WHERE id = %s",
+                    (unit_id,))
+                unit_id, directory_path, include_subdirs = cursor.fetchone()
+                return unit_id, registry_paths.path_from_db(directory_path), include_subdirs
+        return None
+    finally:
+        cursor.close()
+
+
+def renew_lease(cnx, unit_id, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """Extend a lease. Returns False if another worker has taken the unit over."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "UPDATE scan_work_units SET lease_expires = NOW() + INTERVAL %s SECOND "
+            "WHERE id = %s AND lease_owner = %s AND status = 'leased'",
+            (lease_seconds, unit_id, owner))
+        cnx.commit()
+        return cursor.rowcount == 1
+    finally:
+        cursor.close()
+
+
+def complete_unit(cnx, unit_id, owner, unit_scan_id, files_processed, status='done'):
+    """Mark a unit finished and record its outcome in scan_log."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "UPDATE scan_work_units "
+            "SET status = %s, scan_log_id = %s, files_processed = %s, completed = NOW() "
+            "WHERE id = %s AND lease_owner = %s",
+            (status, unit_scan_id, files_processed, unit_id, owner))
+        cnx.commit()
+    finally:
+        cursor.close()
+    if unit_scan_id:
+        log_scan.finish_scan(cnx, unit_scan_id, 'completed' if status == 'done' else 'failed', files_processed)
+
+
+def release_unit(cnx, unit_id, owner):
+    """Return a unit to the queue after a failure, or fail it once out of attempts."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "UPDATE scan_work_units "
+            "SET status = IF(attempts >= %s, 'failed', 'pending'), lease_expires = NULL "
+            "WHERE id = %s AND lease_owner = %s",
+            (MAX_ATTEMPTS, unit_id, owner))
+        cnx.commit()
+    finally:
+        cursor.close()
+
+
+def finish_job_if_done(cnx, job_id):
+    """Close the job's scan_log entry once no unit is pending or leased."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT "
+            "SUM(status IN ('pending', 'leased')), SUM(status = 'failed'), SUM(files_processed) "
+            "FROM scan_work_units WHERE job_id = %s",
+            (job_id,))
+        open_units, failed_units, files_processed = cursor.fetchone()
+        cursor.execute("SELECT status FROM scan_log WHERE id = %s", (job_id,))
+        job = cursor.fetchone()
+    finally:
+        cursor.close()
+    if open_units:
+        return False
+    if job is None or job[0] != 'in-progress':
+        return True
+    log_scan.finish_scan(cnx, job_id, 'failed' if failed_units else 'completed', int(files_processed or 0))
+    return True
+
+
+def process_unit(cnx, job_id, unit, owner, storage_mode="database",
+                 lease_seconds=DEFAULT_LEASE_SECONDS, split_threshold=DEFAULT_SPLIT_THRESHOLD,
+                 rules=None, root=None, unit_scan_id=None):
+    """
+    Hash every file of a leased unit.
+
+    The unit is walked with an explicit stack. Once split_threshold files have
+    been processed, directories still on the stack are queued as new units.
+    File metadata is stored under the job's scan_log id so the whole job forms
+    one scan. Exclusion rules are matched relative to the job root. Each
+    commit touches the unit's own scan_log row, unit_scan_id. Returns
+    (files_processed, lease_held).
+    """
+    unit_id, directory_path, include_subdirs = unit
+    rules = rules or exclusion_rules.load_rules()
+    root = root or directory_path
+    stack = [directory_path]
+    files_processed = 0
+    files_reported = 0
+    last_renewal = time.time()
+
+    def commit_progress():
+        nonlocal files_reported
+        directory_sizes.flush(cnx)
+        if unit_scan_id:
+            log_scan.touch_scan(cnx, unit_scan_id, files_processed - files_reported)
+            files_reported = files_processed
+
+    while stack:
+        current = stack.pop()
+        files, subdirs = _list_directory(current, rules, root)
+        if include_subdirs:
+            stack.extend(subdirs)
+
+        for file_path in files:
+            md5_metadata_scanner.process_file(cnx, file_path, storage_mode, job_id)
+            files_processed += 1
+
+            # Heartbeat, committing finished work with it
+            if time.time() - last_renewal > lease_seconds / 3:
+                commit_progress()
+                if not renew_lease(cnx, unit_id, owner, lease_seconds):
+                    print(f"Lost lease on unit {unit_id} ({registry_paths.display_path(directory_path)})")
+                    return files_processed, False
+                last_renewal = time.time()
+
+        # Hand the rest of an oversized unit back to the queue
+        if files_processed >= split_threshold and stack:
+            print(f"Splitting unit {unit_id}: queueing {len(stack)} subdirectories")
+            commit_progress()
+            add_work_units(cnx, job_id, stack, include_subdirs=True, parent_unit_id=unit_id)
+            stack = []
+
+    commit_progress()
+    cnx.commit()
+    return files_processed, True
+
+
+def run_worker(job_id, storage_mode="database", lease_seconds=DEFAULT_LEASE_SECONDS,
+               split_threshold=DEFAULT_SPLIT_THRESHOLD, exit_when_idle=True, exclusions=None, chunks=False,
+               cache_mode="normal"):
+    """Lease and process units of a job until the queue is drained."""
+    # Chunk manifests are built inside the workers' hashing pass
+    md5_metadata_scanner.chunk_files = chunks
+    if chunks and not md5_metadata_scanner.content_chunks.NUMPY_AVAILABLE:
+        print("WARNING: numpy is not installed; --chunks runs in pure Python at a few MB/s per process.")
+    md5_metadata_scanner.cache_mode = cache_mode
+    cnx = registry_database.get_database_connection()
+    if not cnx or not registry_database.is_connection_valid(cnx):
+        print("Failed to connect to the database or connection timed out.")
+        return
+
+    rules = exclusion_rules.load_rules(exclusions)
+    root = job_root(cnx, job_id)
+
+    owner = worker_name()
+    units_done = 0
+    try:
+        while True:
+            unit = lease_unit(cnx, job_id, owner, lease_seconds)
+            if unit is None:
+                if finish_job_if_done(cnx, job_id) or exit_when_idle:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            unit_id, directory_path, include_subdirs = unit
+            unit_scan_id = log_scan.log_scan(cnx, directory_path, scan_type='distributed-unit')
+            try:
+                files_processed, lease_held = process_unit(
+                    cnx, job_id, unit, owner, storage_mode, lease_seconds, split_threshold, rules, root,
+                    unit_scan_id)
+            except Exception as e:
+                print(f"Unit {unit_id} ({registry_paths.display_path(directory_path)}) failed: {e}")
+                cnx.rollback()
+                directory_sizes.discard()
+                release_unit(cnx, unit_id, owner)
+                if unit_scan_id:
+                    log_scan.finish_scan(cnx, unit_scan_id, 'failed')
+                continue
+
+            if lease_held:
+                complete_unit(cnx, unit_id, owner, unit_scan_id, files_processed)
+                units_done += 1
+                print(f"[{owner}] unit {unit_id} done: {registry_paths.display_path(directory_path)} ({files_processed} files)")
+            elif unit_scan_id:
+                log_scan.finish_scan(cnx, unit_scan_id, 'abandoned')
+
+        finish_job_if_done(cnx, job_id)
+    finally:
+        cnx.close()
+    print(f"[{owner}] finished {units_done} units")
+
+
+def print_job_status(cnx, job_id):
+    """Print unit counts per status for a job."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT status, COUNT(*), COALESCE(SUM(files_processed), 0) FROM scan_work_units "
+            "WHERE job_id = %s GROUP BY status",
+            (job_id,))
+        for status, count, files in cursor.fetchall():
+            print(f"{status}: {count} units, {files} files")
+    finally:
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coordinate a scan split into leased work units across hosts and processes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = subparsers.add_parser('submit', help='split a root into work units and queue them')
+    submit_parser.add_argument('root_path', type=str, help='the directory to scan')
+    submit_parser.add_argument('--split-depth', type=int, default=1, help='directory depth of the initial units (default: 1)')
+    submit_parser.add_argument('--exclusions', type=str, default=None,
+                               help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE})')
+
+    work_parser = subparsers.add_parser('work', help='lease and process units of a job')
+    work_parser.add_argument('job_id', type=int, help='the scan_log id printed by submit')
+    work_parser.add_argument('--processes', type=int, default=1, help='number of local worker processes (default: 1)')
+    work_parser.add_argument('--storage', choices=["database", "both"], default="database",
+                             help='where to store MD5 checksums (default: database)')
+    work_parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                             help=f'lease timeout in seconds (default: {DEFAULT_LEASE_SECONDS})')
+    work_parser.add_argument('--split-threshold', type=int, default=DEFAULT_SPLIT_THRESHOLD,
+                             help=f'files per unit before splitting it (default: {DEFAULT_SPLIT_THRESHOLD})')
+    work_parser.add_argument('--wait', action='store_true',
+                             help='keep polling until the whole job is finished instead of exiting when idle')
+    work_parser.add_argument('--chunks', action='store_true',
+                             help='also record content-defined chunk manifests while hashing')
+    work_parser.add_argument('--exclusions', type=str, default=None,
+                             help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE})')
+    work_parser.add_argument('--cache-mode', choices=page_cache.MODES, default='normal',
+                             help='page cache use while hashing (default: normal)')
+
+    status_parser = subparsers.add_parser('status', help='show the progress of a job')
+    status_parser.add_argument('job_id', type=int, help='the scan_log id printed by submit')
+
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        worker_args = (args.job_id, args.storage, args.lease_seconds, args.split_threshold, not args.wait,
+                       args.exclusions, args.chunks, args.cache_mode)
+        if args.processes <= 1:
+            run_worker(*worker_args)
+        else:
+            workers = [multiprocessing.Process(target=run_worker, args=worker_args)
+                       for _ in range(args.processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    else:
+        cnx = registry_database.get_database_connection()
+        if cnx and registry_database.is_connection_valid(cnx):
+            if args.command == 'submit':
+                job_id = create_job(cnx, args.root_path, args.split_depth, exclusion_rules.load_rules(args.exclusions))
+                print(f"Queued job {job_id} for {registry_paths.display_path(args.root_path)}")
+            else:
+                print_job_status(cnx, args.job_id)
+            cnx.close()
+        else:
+            print("Failed to connect to the database or connection timed out.")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Scan Staging
+------------
+Contention-free ingest for concurrent scanners. Instead of inserting and
+upserting row by row into the shared tables, a scan appends its rows to its
+own staging table, scan_staging_<scan_log id>, which has no secondary
+indexes and no other writers. When the walk is done the staging table gets
+one index on the path hash, built in a single sort, and is merged into
+file_metadata or files with set-based statements over chunks of consecutive
+path hashes. Each chunk is a short transaction that touches the shared
+indexes in key order, so several scanners merging at once rarely wait on
+each other.
+
+A scan that dies before merging leaves its staging table behind; list shows
+them and merge applies one later.
+"""
+
+import argparse
+
+import content_groups
+import directory_sizes
+import registry_database
+import registry_paths
+
+TABLE_PREFIX = "scan_staging_"
+
+# Rows per multi-row INSERT into a staging table
+INSERT_BATCH_SIZE = 5000
+
+# Staged rows per merge transaction
+MERGE_CHUNK_SIZE = 5000
+
+TARGETS = ("metadata", "files")
+
+
+def table_name(scan_log_id):
+    return f"{TABLE_PREFIX}{int(scan_log_id)}"
+
+
+class StagingTable:
+    """
+    Append-only staging table of one scan. add() buffers rows and writes them
+    in multi-row inserts; merge() flushes, applies the rows to the target
+    table and drops the staging table. One row per path.
+    """
+
+    def __init__(self, cnx, scan_log_id, host_id):
+        self.cnx = cnx
+        self.scan_log_id = scan_log_id
+        self.host_id = host_id
+        self.table = table_name(scan_log_id)
+        self.rows = []
+        self.staged = 0
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                f"seq BIGINT AUTO_INCREMENT PRIMARY KEY, "
+                f"host_id INT NOT NULL, "
+                f"file_path VARBINARY(1024) NOT NULL, "
+                f"file_path_hash BINARY(16) NOT NULL, "
+                f"md5_checksum BINARY(16) NOT NULL, "
+                f"file_size BIGINT, "
+                f"modification_date DATETIME, "
+                f"last_seen DATETIME)")
+            cnx.commit()
+        finally:
+            cursor.close()
+
+    def add(self, file_path, md5_checksum, file_size, modification_date, last_seen=None):
+        self.rows.append((self.host_id, registry_paths.path_to_db(file_path), registry_paths.path_hash(file_path),
+                          registry_database.md5_to_bin(md5_checksum), file_size, modification_date, last_seen))
+        if len(self.rows) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows. Commits; nothing else writes to the staging table."""
+        if not self.rows:
+            return
+        cursor = self.cnx.cursor()
+        try:
+            cursor.executemany(
+                f"INSERT INTO {self.table} (host_id, file_path, file_path_hash, md5_checksum, file_size, "
+                f"modification_date, last_seen) VALUES (%s, %s, %s, %s, %s, %s, %s)", self.rows)
+            self.cnx.commit()
+        finally:
+            cursor.close()
+        self.staged += len(self.rows)
+        self.rows = []
+
+    def merge(self, target, chunk_size=MERGE_CHUNK_SIZE):
+        self.flush()
+        return merge(self.cnx, self.scan_log_id, target, chunk_size)
+
+
+def _chunks(cursor, table, chunk_size):
+    """
+    Yield SQL conditions on s.file_path_hash, with their arguments, that split
+    the staging table into chunks of about chunk_size rows in hash order.
+    """
+    lower = None
+    while True:
+        if lower is None:
+            cursor.execute(f"SELECT file_path_hash FROM {table} ORDER BY file_path_hash LIMIT 1 OFFSET %s",
+                           (chunk_size - 1,))
+        else:
+            cursor.execute(f"SELECT file_path_hash FROM {table} WHERE file_path_hash > %s "
+                           f"ORDER BY file_path_hash LIMIT 1 OFFSET %s", (lower, chunk_size - 1))
+        row = cursor.fetchone()
+        upper = bytes(row[0]) if row else None
+        if lower is None and upper is None:
+            yield "TRUE", ()
+        elif lower is None:
+            yield "s.file_path_hash <= %s", (upper,)
+        elif upper is None:
+            yield "s.file_path_hash > %s", (lower,)
+        else:
+            yield "s.file_path_hash > %s AND s.file_path_hash <= %s", (lower, upper)
+        if upper is None:
+            return
+        lower = upper
+
+
+# Staged rows joined to the current version of the same file
+_CURRENT = ("LEFT JOIN file_metadata m ON m.host_id = s.host_id AND m.file_path_hash = s.file_path_hash "
+            "AND m.valid_to_scan_id IS NULL")
+_SAME = ("m.md5_checksum = s.md5_checksum AND m.file_size <=> s.file_size "
+         "AND m.modification_date <=> s.modification_date")
+
+
+def _merge_metadata_chunk(cursor, table, scan_log_id, condition, args):
+    """Apply one chunk to file_metadata like metadata_snapshots.store_version. Returns (new, changed)."""
+    # Version changes for directory_sizes, read before they are written
+    cursor.execute(
+        f"SELECT s.host_id, s.file_path, s.md5_checksum, s.file_size, m.md5_checksum, m.file_size "
+        f"FROM {table} s {_CURRENT} WHERE {condition} AND (m.id IS NULL OR NOT ({_SAME}))", args)
+    new = changed = 0
+    for host_id, file_path, md5_digest, file_size, old_md5, old_size in cursor.fetchall():
+        file_path = registry_paths.path_from_db(file_path)
+        if old_md5 is not None:
+            directory_sizes.record(host_id, file_path, bytes(old_md5), old_size, -1)
+            changed += 1
+        else:
+            new += 1
+        directory_sizes.record(host_id, file_path, bytes(md5_digest), file_size, 1)
+
+    # Versions this scan already wrote are rewritten in place, older ones are ended
+    cursor.execute(
+        f"UPDATE file_metadata m JOIN {table} s ON m.host_id = s.host_id AND m.file_path_hash = s.file_path_hash "
+        f"SET m.md5_checksum = s.md5_checksum, m.file_size = s.file_size, "
+        f"m.modification_date = s.modification_date, m.scan_date = NOW(), m.last_verified = NOW() "
+        f"WHERE {condition} AND m.valid_to_scan_id IS NULL AND m.scan_log_id = %s AND NOT ({_SAME})",
+        (*args, scan_log_id))
+    cursor.execute(
+        f"UPDATE file_metadata m JOIN {table} s ON m.host_id = s.host_id AND m.file_path_hash = s.file_path_hash "
+        f"SET m.valid_to_scan_id = %s "
+        f"WHERE {condition} AND m.valid_to_scan_id IS NULL AND NOT (m.scan_log_id <=> %s) AND NOT ({_SAME})",
+        (scan_log_id, *args, scan_log_id))
+    cursor.execute(
+        f"INSERT INTO file_metadata (file_path, md5_checksum, file_size, modification_date, scan_date, "
+        f"file_path_hash, scan_log_id, host_id, last_verified) "
+        f"SELECT s.file_path, s.md5_checksum, s.file_size, s.modification_date, NOW(), s.file_path_hash, %s, "
+        f"s.host_id, NOW() FROM {table} s {_CURRENT} WHERE {condition} AND m.id IS NULL",
+        (scan_log_id, *args))
+    return new, changed
+
+
+def _merge_files_chunk(cursor, table, condition, args):
+    """
+    Insert new paths into files and refresh the ones another scanner added.
+    Returns (new, changed, content_groups changes).
+    """
+    join = "f.host_id = s.host_id AND f.file_path = s.file_path"
+    cursor.execute(
+        f"SELECT s.host_id, s.md5_checksum, s.file_size, f.md5_checksum, f.file_size, f.status "
+        f"FROM {table} s LEFT JOIN files f ON {join} WHERE {condition} "
+        f"AND (f.id IS NULL OR NOT (f.md5_checksum <=> s.md5_checksum) OR f.status <> 'active')", args)
+    changes = []
+    new = changed = 0
+    for host_id, md5_digest, file_size, old_md5, old_size, old_status in cursor.fetchall():
+        if old_status is None:
+            new += 1
+        else:
+            changed += 1
+            if old_status == 'active':
+                changes.append((host_id, old_md5, old_size, -1))
+        changes.append((host_id, md5_digest, file_size, 1))
+
+    cursor.execute(
+        f"UPDATE files f JOIN {table} s ON {join} "
+        f"SET f.md5_checksum = s.md5_checksum, f.file_size = s.file_size, "
+        f"f.modification_date = s.modification_date, f.last_seen = COALESCE(s.last_seen, NOW()), "
+        f"f.status = 'active', f.missed_scans = 0 WHERE {condition}", args)
+    cursor.execute(
+        f"INSERT INTO files (host_id, file_path, md5_checksum, file_size, modification_date, last_seen) "
+        f"SELECT s.host_id, s.file_path, s.md5_checksum, s.file_size, s.modification_date, "
+        f"COALESCE(s.last_seen, NOW()) FROM {table} s LEFT JOIN files f ON {join} "
+        f"WHERE {condition} AND f.id IS NULL", args)
+    return new, changed, changes
+
+
+def merge(cnx, scan_log_id, target, chunk_size=MERGE_CHUNK_SIZE):
+    """
+    Apply a scan's staging table to file_metadata or files, one committed
+    chunk at a time, then drop it. Returns (staged rows, new, changed).
+    """
+    if target not in TARGETS:
+        raise ValueError(f"unknown merge target: {target}")
+    table = table_name(scan_log_id)
+    staged = new = changed = 0
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        staged = int(cursor.fetchone()[0])
+        # One sort now instead of index maintenance on every staged insert
+        cursor.execute(f"SHOW INDEX FROM {table} WHERE Key_name = 'idx_staging_hash'")
+        if not cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {table} ADD INDEX idx_staging_hash (file_path_hash)")
+
+        bounds = cnx.cursor()
+        try:
+            for condition, args in _chunks(bounds, table, chunk_size):
+                if target == "metadata":
+                    chunk_new, chunk_changed = _merge_metadata_chunk(cursor, table, scan_log_id, condition, args)
+                    directory_sizes.flush(cnx)
+                else:
+                    chunk_new, chunk_changed, changes = _merge_files_chunk(cursor, table, condition, args)
+                    content_groups.apply_changes(cnx, changes)
+                cnx.commit()
+                new += chunk_new
+                changed += chunk_changed
+        finally:
+            bounds.close()
+        cursor.execute(f"DROP TABLE {table}")
+    except BaseException:
+        cnx.rollback()
+        directory_sizes.discard()
+        raise
+    finally:
+        cursor.close()
+    return staged, new, changed
+
+
+def drop(cnx, scan_log_id):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name(scan_log_id)}")
+    finally:
+        cursor.close()
+
+
+def pending_tables(cnx):
+    """Yield (scan_log id, staged rows, scan directory, scan status) of staging tables left unmerged."""
+    cursor = cnx.cursor()
+    try:
+        cursor.execute("SELECT table_name, table_rows FROM information_schema.tables "
+                       "WHERE table_schema = DATABASE() AND table_name LIKE %s",
+                       (registry_paths.escape_like(TABLE_PREFIX.encode()).decode() + "%",))
+        tables = cursor.fetchall()
+        for name, rows in tables:
+            scan_log_id = int(name[len(TABLE_PREFIX):])
+            cursor.execute("SELECT directory_path, status FROM scan_log WHERE id = %s", (scan_log_id,))
+            row = cursor.fetchone()
+            directory, status = row if row else (None, None)
+            yield scan_log_id, rows, registry_paths.path_from_db(directory), status
+    finally:
+        cursor.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and merge the staging tables of scans.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('list', help='list staging tables that were not merged')
+
+    merge_parser = subparsers.add_parser('merge', help='merge a scan\'s staging table')
+    merge_parser.add_argument('scan_log_id', type=int, help='scan_log id of the scan')
+    merge_parser.add_argument('--into', choices=TARGETS, required=True,
+                              help='metadata for md5_metadata_scanner scans, files for file_registry scans')
+    merge_parser.add_argument('--chunk-size', type=int, default=MERGE_CHUNK_SIZE,
+                              help=f'staged rows per transaction (default: {MERGE_CHUNK_SIZE})')
+
+    drop_parser = subparsers.add_parser('drop', help='discard a scan\'s staging table')
+    drop_parser.add_argument('scan_log_id', type=int, help='scan_log id of the scan')
+    args = parser.parse_args()
+
+    cnx = registry_database.get_database_connection()
+    if cnx and registry_database.is_connection_valid(cnx):
+        try:
+            if args.command == 'list':
+                for scan_log_id, rows, directory, status in pending_tables(cnx):
+                    print(f"{scan_log_id:>8}  ~{rows} rows  {status or '-':<12} "
+                          f"{registry_paths.display_path(directory) if directory else '-'}")
+            elif args.command == 'merge':
+                staged, new, changed = merge(cnx, args.scan_log_id, args.into, args.chunk_size)
+                print(f"Merged {staged} staged rows: {new} new, {changed} changed")
+            else:
+                drop(cnx, args.scan_log_id)
+        finally:
+            cnx.close()
+    else:
+        print("Failed to connect to the database or connection timed out.")
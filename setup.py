@@ -184,12 +184,41 @@ def setup_excluded_dirs(templates):
     
     print(f"✓ Excluded directories configuration saved to {excluded_dirs_path}")
 
+def setup_exclusions(templates):
+    """Set up the exclusion rules shared by the scanners."""
+    exclusions = templates["exclusions.json"]
+    exclusions_path = os.path.join(CONFIG_DIR, "exclusions.json")
+
+    if os.path.exists(exclusions_path):
+        print(f"✓ Keeping existing exclusion rules in {exclusions_path}")
+        return
+
+    with open(exclusions_path, 'w') as file:
+        json.dump(exclusions, file, indent=4)
+
+    print(f"✓ Exclusion rules saved to {exclusions_path}")
+
+def setup_parallel_walk(templates):
+    """Set up the per-mount worker counts of the parallel directory walk."""
+    walk_config = templates["parallel_walk.json"]
+    walk_config_path = os.path.join(CONFIG_DIR, "parallel_walk.json")
+
+    if os.path.exists(walk_config_path):
+        print(f"✓ Keeping existing parallel walk settings in {walk_config_path}")
+        return
+
+    with open(walk_config_path, 'w') as file:
+        json.dump(walk_config, file, indent=4)
+
+    print(f"✓ Parallel walk settings saved to {walk_config_path}")
+
 def verify_setup():
     """Verify that all required files exist."""
     required_files = [
         os.path.join(CONFIG_DIR, "credentials.json"),
         os.path.join(CONFIG_DIR, "excluded_files.json"),
         os.path.join(CONFIG_DIR, "excluded_dirs.json"),
+        os.path.join(CONFIG_DIR, "exclusions.json"),
         DB_SETUP_FILE
     ]
     
@@ -231,6 +260,8 @@ def main():
     
     setup_excluded_files(templates)
     setup_excluded_dirs(templates)
+    setup_exclusions(templates)
+    setup_parallel_walk(templates)
     
     # Verify setup
     print("\n" + "-" * 60)
@@ -0,0 +1,86 @@
+import hashlib
+import random
+
+import pytest
+
+import content_chunks
+from content_chunks import Chunker
+
+
+def random_bytes(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def chunk(data, feed=100_000, **sizes):
+    chunker = Chunker(**sizes)
+    chunks = []
+    for start in range(0, len(data), feed):
+        chunks.extend(chunker.update(data[start:start + feed]))
+    chunks.extend(chunker.finish())
+    return chunks
+
+
+@pytest.fixture(params=["bytewise", "numpy"])
+def implementation(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(content_chunks, "NUMPY_AVAILABLE", True)
+    else:
+        monkeypatch.setattr(content_chunks, "NUMPY_AVAILABLE", False)
+    return request.param
+
+
+def test_chunks_cover_the_input_within_bounds(implementation):
+    data = random_bytes(2_000_000)
+    chunks = chunk(data)
+    assert b"".join(data[offset:offset + length] for offset, length, _ in chunks) == data
+    for offset, length, digest in chunks[:-1]:
+        assert content_chunks.DEFAULT_MIN_SIZE < length <= content_chunks.DEFAULT_MAX_SIZE
+        assert digest == hashlib.md5(data[offset:offset + length]).digest()
+
+
+def test_boundaries_do_not_depend_on_the_read_size(implementation):
+    data = random_bytes(1_000_000, seed=2)
+    assert chunk(data, feed=4096) == chunk(data, feed=1_000_000)
+
+
+def test_insertion_only_changes_nearby_chunks(implementation):
+    data = random_bytes(1_500_000, seed=3)
+    edited = data[:700_000] + b"inserted" + data[700_000:]
+    before = {digest for _, _, digest in chunk(data)}
+    after = {digest for _, _, digest in chunk(edited)}
+    assert len(before - after) <= 3
+
+
+def test_numpy_and_bytewise_boundaries_agree(monkeypatch):
+    pytest.importorskip("numpy")
+    data = random_bytes(1_000_000, seed=4)
+    monkeypatch.setattr(content_chunks, "NUMPY_AVAILABLE", True)
+    vectorized = chunk(data, feed=65536, min_size=4096, avg_size=8192, max_size=32768)
+    monkeypatch.setattr(content_chunks, "NUMPY_AVAILABLE", False)
+    bytewise = chunk(data, feed=65536, min_size=4096, avg_size=8192, max_size=32768)
+    assert vectorized == bytewise
+
+
+def test_average_size_follows_the_setting():
+    pytest.importorskip("numpy")
+    data = random_bytes(8_000_000, seed=5)
+    chunks = chunk(data)
+    average = len(data) / len(chunks)
+    assert 0.75 * content_chunks.DEFAULT_AVG_SIZE < average < 1.25 * content_chunks.DEFAULT_AVG_SIZE
+
+
+def test_invalid_sizes_are_rejected():
+    with pytest.raises(ValueError):
+        Chunker(min_size=32, avg_size=64, max_size=128)
+    with pytest.raises(ValueError):
+        Chunker(min_size=4096, avg_size=4096, max_size=8192)
+
+
+def test_chunk_file_hashes_in_the_same_pass(tmp_path):
+    data = random_bytes(300_000, seed=6)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    md5_checksum, chunks = content_chunks.chunk_file(str(path), read_size=65536)
+    assert md5_checksum == hashlib.md5(data).hexdigest()
+    assert sum(length for _, length, _ in chunks) == len(data)
@@ -0,0 +1,115 @@
+import hashlib
+import struct
+
+import pytest
+
+import digest_filter
+from digest_filter import DigestFilter, KnownContent
+
+
+def digest(index):
+    return hashlib.md5(str(index).encode()).digest()
+
+
+def test_added_pairs_are_always_found():
+    bloom = DigestFilter.for_items(1000, fp_rate=0.01)
+    for index in range(1000):
+        bloom.add(digest(index), index)
+    assert all(bloom.might_contain(digest(index), index) for index in range(1000))
+
+
+def test_false_positive_rate_is_near_the_target():
+    bloom = DigestFilter.for_items(5000, fp_rate=0.01)
+    for index in range(5000):
+        bloom.add(digest(index), index)
+    false_positives = sum(bloom.might_contain(digest(index), index) for index in range(5000, 25000))
+    assert false_positives / 20000 < 0.02
+    assert bloom.expected_fp_rate() == pytest.approx(0.01, rel=0.2)
+
+
+def test_size_is_part_of_the_key():
+    bloom = DigestFilter.for_items(10, fp_rate=0.0001)
+    bloom.add(digest(1), 100)
+    assert not bloom.might_contain(digest(1), 101)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    bloom = DigestFilter.for_items(100, fp_rate=0.001, source="metadata")
+    for index in range(100):
+        bloom.add(digest(index), index)
+    path = tmp_path / "known.bloom"
+    bloom.save(str(path))
+    loaded = DigestFilter.load(str(path))
+    assert (loaded.bits, loaded.hashes, loaded.items, loaded.source) == (bloom.bits, bloom.hashes, 100, "metadata")
+    assert all(loaded.might_contain(digest(index), index) for index in range(100))
+
+
+def test_version_1_files_load_as_content_groups(tmp_path):
+    bloom = DigestFilter.for_items(10)
+    bloom.add(digest(1), 1)
+    path = tmp_path / "old.bloom"
+    path.write_bytes(digest_filter.HEADER_V1.pack(digest_filter.MAGIC, 1, bloom.hashes, bloom.items,
+                                                  bloom.bits, bloom.fp_rate) + bytes(bloom.data))
+    loaded = DigestFilter.load(str(path))
+    assert loaded.source == "groups"
+    assert loaded.might_contain(digest(1), 1)
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * 128)
+    with pytest.raises(ValueError):
+        DigestFilter.load(str(path))
+    truncated = tmp_path / "truncated.bloom"
+    truncated.write_bytes(digest_filter.HEADER.pack(digest_filter.MAGIC, digest_filter.VERSION, 3, 0, 1 << 20,
+                                                    0.01, b"groups"))
+    with pytest.raises(ValueError):
+        DigestFilter.load(str(truncated))
+
+
+def test_known_content_without_a_connection():
+    bloom = DigestFilter.for_items(10, fp_rate=0.0001)
+    bloom.add(digest(1), 10)
+    known = KnownContent(bloom)
+    assert known.check("/a", digest(1).hex(), 10) == "probable"
+    assert known.check("/b", digest(2).hex(), 20) == "new"
+    known.confirm()
+    assert (known.new, known.new_bytes, known.probable, known.probable_bytes) == (1, 20, 1, 10)
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def execute(self, query, args):
+        self.queries.append(query)
+        self.args = args
+
+    def fetchall(self):
+        return [row for row in self.rows if row[0] in self.args]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.last_cursor = FakeCursor(rows)
+
+    def cursor(self):
+        return self.last_cursor
+
+
+def test_confirmation_matches_digest_and_size():
+    bloom = DigestFilter.for_items(10, fp_rate=0.0001, source="metadata")
+    for size in (10, 20):
+        bloom.add(digest(1), size)
+    cnx = FakeConnection([(digest(1), 10)])
+    known = KnownContent(bloom, cnx)
+    assert known.check("/same", digest(1).hex(), 10) == "probable"
+    assert known.check("/other-size", digest(1).hex(), 20) == "probable"
+    known.confirm()
+    assert (known.known, known.known_bytes) == (1, 10)
+    assert (known.false_positives, known.new, known.new_bytes) == (1, 1, 20)
+    assert cnx.last_cursor.queries[0].startswith(digest_filter.SOURCES["metadata"][2])
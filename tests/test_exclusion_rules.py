@@ -0,0 +1,68 @@
+import os
+
+import exclusion_rules
+from exclusion_rules import ExclusionRules
+
+
+def make_tree(root, paths):
+    for path in paths:
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as f:
+            f.write(b"x" * 10)
+
+
+def walked_files(top, rules):
+    found = set()
+    for dirpath, _, filenames in exclusion_rules.walk(str(top), rules):
+        for name in filenames:
+            found.add(exclusion_rules.relative_path(os.path.join(dirpath, name), str(top)))
+    return found
+
+
+def test_plain_names_match_at_any_depth():
+    rules = ExclusionRules({"exclude": [".git/", "*.tmp"]})
+    assert rules.excludes_dir(".git", ".git")
+    assert rules.excludes_dir("a/b/.git", ".git")
+    assert not rules.excludes_file("a/.git", ".git")
+    assert rules.excludes_file("a/b/c.tmp", "c.tmp")
+    assert not rules.excludes_file("a/b/c.txt", "c.txt")
+
+
+def test_anchored_and_double_star_patterns():
+    rules = ExclusionRules({"exclude": ["/scratch/", "**/cache/*.tmp"]})
+    assert rules.excludes_dir("scratch", "scratch")
+    assert not rules.excludes_dir("a/scratch", "scratch")
+    assert rules.excludes_file("cache/x.tmp", "x.tmp")
+    assert rules.excludes_file("a/b/cache/x.tmp", "x.tmp")
+    assert not rules.excludes_file("a/cache/sub/x.tmp", "x.tmp")
+
+
+def test_last_matching_pattern_wins():
+    rules = ExclusionRules({"exclude": ["*.tmp", "!keep.tmp"]})
+    assert rules.excludes_file("a/drop.tmp", "drop.tmp")
+    assert not rules.excludes_file("a/keep.tmp", "keep.tmp")
+
+
+def test_regex_extension_and_size_rules(tmp_path):
+    rules = ExclusionRules({"regex": [r"\.~lock\..*#$"], "extensions": ["BAK"], "min_size": 100})
+    assert rules.excludes_file("a/.~lock.doc#", ".~lock.doc#")
+    assert rules.excludes_file("a/old.bak", "old.bak")
+    small = tmp_path / "small.txt"
+    small.write_bytes(b"x" * 10)
+    assert rules.excludes_file("small.txt", "small.txt", os.stat(small))
+    assert not rules.excludes_file("small.txt", "small.txt")
+
+
+def test_walk_prunes_excluded_directories(tmp_path):
+    make_tree(tmp_path, ["a/keep.txt", "a/drop.tmp", "a/.git/config", "b/c/keep.txt", "node_modules/x.js"])
+    rules = ExclusionRules({"exclude": [".git/", "node_modules/", "*.tmp"]})
+    assert walked_files(tmp_path, rules) == {"a/keep.txt", "b/c/keep.txt"}
+
+
+def test_load_rules_reads_the_given_file(tmp_path):
+    path = tmp_path / "exclusions.json"
+    path.write_text('{"exclude": ["*.log"]}')
+    rules = exclusion_rules.load_rules(str(path))
+    assert rules.excludes_file("x/y.log", "y.log")
+    assert not rules.excludes_file("x/y.txt", "y.txt")
@@ -0,0 +1,59 @@
+import os
+import random
+
+import pytest
+
+import page_cache
+from page_cache import BlockReader, CacheStats
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    data = random.Random(1).randbytes(3 * 65536 + 123)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    return str(path), data
+
+
+def read_all(reader):
+    blocks = []
+    for block in iter(reader.read, b""):
+        blocks.append(bytes(block))
+    return b"".join(blocks)
+
+
+@pytest.mark.parametrize("mode", page_cache.MODES)
+def test_every_mode_reads_the_whole_file(data_file, mode):
+    path, data = data_file
+    stats = CacheStats()
+    with BlockReader(path, mode, stats, block_size=65536) as reader:
+        assert read_all(reader) == data
+    assert stats.files == 1
+    assert stats.bytes_read == len(data)
+    assert "Page cache" in stats.summary()
+
+
+def test_unknown_mode_is_rejected(data_file):
+    with pytest.raises(ValueError):
+        BlockReader(data_file[0], "bogus")
+
+
+def test_resident_runs_lie_within_the_file(data_file):
+    if not page_cache.MINCORE_AVAILABLE:
+        pytest.skip("mincore is not available")
+    path, data = data_file
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.read(fd, len(data))
+        runs = page_cache.resident_runs(fd, len(data))
+    finally:
+        os.close(fd)
+    if runs is None:
+        pytest.skip("residency cannot be measured here")
+    assert all(0 <= start < end <= len(data) for start, end in runs)
+
+
+def test_cache_stats_without_residency():
+    stats = CacheStats()
+    stats.add(1000)
+    assert "residency not measured" in stats.summary()
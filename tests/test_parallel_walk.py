@@ -0,0 +1,49 @@
+import os
+
+import exclusion_rules
+import parallel_walk
+from exclusion_rules import ExclusionRules
+
+
+def make_tree(root):
+    for top in range(4):
+        for sub in range(3):
+            directory = os.path.join(root, f"d{top}", f"s{sub}")
+            os.makedirs(directory)
+            for index in range(5):
+                with open(os.path.join(directory, f"f{index}.txt"), "wb") as f:
+                    f.write(b"x" * (index + 1))
+            with open(os.path.join(directory, "skip.tmp"), "wb") as f:
+                f.write(b"tmp")
+    os.makedirs(os.path.join(root, "d0", ".git"))
+    with open(os.path.join(root, "d0", ".git", "config"), "wb") as f:
+        f.write(b"git")
+
+
+def file_set(walk):
+    return {os.path.join(dirpath, name) for dirpath, _, filenames in walk for name in filenames}
+
+
+def test_walk_matches_the_single_threaded_walk(tmp_path):
+    make_tree(str(tmp_path))
+    rules = ExclusionRules({"exclude": [".git/", "*.tmp"]})
+    expected = file_set(exclusion_rules.walk(str(tmp_path), rules))
+    assert len(expected) == 60
+    for workers in (1, 4):
+        assert file_set(parallel_walk.walk(str(tmp_path), rules, workers)) == expected
+
+
+def test_cached_stat_reports_size_and_mtime(tmp_path):
+    make_tree(str(tmp_path))
+    rules = ExclusionRules({"exclude": [".git/", "*.tmp"]})
+    for _, _, entries in parallel_walk.walk_entries(str(tmp_path), rules, workers=3):
+        for entry in entries:
+            st = os.stat(entry.path)
+            assert parallel_walk.cached_stat(entry) == parallel_walk.FileStat(st.st_size, st.st_mtime)
+
+
+def test_stopping_early_releases_the_workers(tmp_path):
+    make_tree(str(tmp_path))
+    walk = parallel_walk.walk_entries(str(tmp_path), ExclusionRules(), workers=2)
+    next(walk)
+    walk.close()
@@ -0,0 +1,117 @@
+import datetime
+import hashlib
+import os
+
+import pytest
+
+import registry_paths
+import registry_snapshot
+from registry_snapshot import RegistrySnapshot
+
+HOSTS = [(1, "alpha"), (2, "beta")]
+
+FILES = [
+    ("/data/projects/Report.pdf", 1),
+    ("/data/projects/report-v2.pdf", 1),
+    ("/data/media/clip.mov", 2),
+    ("/data/media/" + os.fsdecode(b"caf\xe9.txt"), 2),
+    ("/data/projects/Report.pdf", 2),
+]
+
+
+class FakeCursor:
+    """Answers the two queries export_snapshot runs."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def execute(self, query, args=()):
+        if "FROM hosts" in query:
+            self.result = list(HOSTS)
+        else:
+            self.result = sorted(self.rows, key=lambda row: row[0])
+
+    def fetchmany(self, size):
+        rows, self.result = self.result[:size], self.result[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.result))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+
+def row(file_path, host_id):
+    stored = registry_paths.path_to_db(file_path)
+    return (hashlib.md5(stored).digest(), stored, hashlib.md5(stored).digest(), len(stored),
+            datetime.datetime(2024, 1, 2, 3, 4, 5), host_id)
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = str(tmp_path / "registry.snap")
+    assert registry_snapshot.export_snapshot(FakeConnection([row(*f) for f in FILES]), path) == len(FILES)
+    with RegistrySnapshot(path) as snap:
+        yield snap
+
+
+def test_lookup_by_path_returns_every_host(snapshot):
+    entries = list(snapshot.by_path("/data/projects/Report.pdf"))
+    assert sorted(entry[4] for entry in entries) == ["alpha", "beta"]
+    assert entries[0][3] == 1704164645
+    assert list(snapshot.by_path("/data/projects/missing.pdf")) == []
+
+
+def test_lookup_by_md5(snapshot):
+    md5_checksum = hashlib.md5(b"/data/media/clip.mov").hexdigest()
+    assert [entry[0] for entry in snapshot.by_md5(md5_checksum)] == ["/data/media/clip.mov"]
+
+
+def test_undecodable_paths_round_trip(snapshot):
+    file_path = "/data/media/" + os.fsdecode(b"caf\xe9.txt")
+    assert [entry[0] for entry in snapshot.by_path(file_path)] == [file_path]
+
+
+def test_search_reports_each_path_once(snapshot):
+    assert sorted(entry[0] for entry in snapshot.search("projects/")) == [
+        "/data/projects/Report.pdf", "/data/projects/Report.pdf", "/data/projects/report-v2.pdf"]
+    assert len(list(snapshot.search("/data/", limit=2))) == 2
+    assert list(snapshot.search("")) == []
+
+
+def test_search_ignores_case_like_the_database(snapshot):
+    assert sorted(entry[0] for entry in snapshot.search("REPORT")) == [
+        "/data/projects/Report.pdf", "/data/projects/Report.pdf", "/data/projects/report-v2.pdf"]
+    assert [entry[0] for entry in snapshot.search("Report", case_sensitive=True)] == [
+        "/data/projects/Report.pdf", "/data/projects/Report.pdf"]
+    assert [entry[0] for entry in snapshot.search(os.fsdecode(b"CAF\xe9"))] == [
+        "/data/media/" + os.fsdecode(b"caf\xe9.txt")]
+
+
+def test_fold_case_keeps_the_length():
+    for value in ["Report.PDF".encode(), "ÉTÉ/Ärger".encode(), b"caf\xc9", "İstanbul".encode()]:
+        assert len(registry_snapshot.fold_case(value)) == len(value)
+    assert registry_snapshot.fold_case("ÉTÉ".encode()) == "été".encode()
+
+
+def test_search_does_not_match_across_paths(snapshot):
+    # Paths are stored back to back; the tail of one and the head of the next must not match
+    assert list(snapshot.search("pdf/data")) == []
+    assert list(snapshot.search("mov/data")) == []
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * registry_snapshot.HEADER.size)
+    with pytest.raises(ValueError):
+        RegistrySnapshot(str(path))
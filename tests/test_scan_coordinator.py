@@ -0,0 +1,110 @@
+"""
+End-to-end run of the distributed scan against a local MySQL database set up
+from db_setup.sql (see CONTRIBUTING.md). Skipped when no database is reachable
+with config/credentials.json, or with the file named by
+FILE_REGISTRY_TEST_CREDENTIALS.
+"""
+
+import json
+import multiprocessing
+import os
+
+import pytest
+
+from conftest import REPO_ROOT
+
+mysql_connector = pytest.importorskip("mysql.connector")
+
+import registry_database  # noqa: E402
+import registry_paths  # noqa: E402
+import scan_coordinator  # noqa: E402
+from exclusion_rules import ExclusionRules  # noqa: E402
+
+CREDENTIALS_FILE = os.environ.get("FILE_REGISTRY_TEST_CREDENTIALS",
+                                  os.path.join(REPO_ROOT, registry_database.CREDENTIALS_FILE))
+
+
+def connect():
+    if not os.path.exists(CREDENTIALS_FILE):
+        return None
+    with open(CREDENTIALS_FILE) as f:
+        credentials = json.load(f)
+    try:
+        return mysql_connector.connect(**credentials, connection_timeout=5)
+    except mysql_connector.Error:
+        return None
+
+
+@pytest.fixture
+def cnx(monkeypatch):
+    cnx = connect()
+    if cnx is None:
+        pytest.skip("no local MySQL database to test against")
+    # The forked workers inherit the credentials path and the working directory
+    monkeypatch.setattr(registry_database, "CREDENTIALS_FILE", os.path.abspath(CREDENTIALS_FILE))
+    monkeypatch.chdir(REPO_ROOT)
+    yield cnx
+    cnx.close()
+
+
+def make_tree(root):
+    files = []
+    for top in range(4):
+        for sub in range(3):
+            directory = os.path.join(root, f"d{top}", f"s{sub}")
+            os.makedirs(directory)
+            for index in range(5):
+                file_path = os.path.join(directory, f"f{index}.bin")
+                with open(file_path, "wb") as f:
+                    f.write(f"{top}-{sub}-{index}".encode())
+                files.append(file_path)
+    return files
+
+
+def scalar(cnx, query, args):
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(query, args)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="workers are forked")
+def test_three_workers_finish_a_split_job(cnx, tmp_path):
+    root = str(tmp_path / "tree")
+    files = make_tree(root)
+    exclusions = tmp_path / "exclusions.json"
+    exclusions.write_text('{"exclude": []}')
+
+    job_id = scan_coordinator.create_job(cnx, root, split_depth=1, rules=ExclusionRules())
+    assert job_id is not None
+
+    # A low split threshold makes the workers hand subdirectories back to the queue
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=scan_coordinator.run_worker,
+                               args=(job_id, "database", 60, 3, False, str(exclusions)))
+               for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(300)
+        assert worker.exitcode == 0
+    cnx.commit()
+
+    (units, done, split), = scalar(
+        cnx, "SELECT COUNT(*), SUM(status = 'done'), SUM(parent_unit_id IS NOT NULL) "
+             "FROM scan_work_units WHERE job_id = %s", (job_id,))
+    assert units == done
+    assert split > 0
+
+    versions = scalar(
+        cnx, "SELECT file_path, COUNT(*) FROM file_metadata "
+             "WHERE valid_to_scan_id IS NULL AND file_path LIKE %s GROUP BY file_path",
+        (registry_paths.prefix_pattern(root),))
+    assert sorted(registry_paths.path_from_db(path) for path, _ in versions) == sorted(files)
+    assert all(count == 1 for _, count in versions)
+
+    (status, files_scanned), = scalar(cnx, "SELECT status, files_scanned FROM scan_log WHERE id = %s", (job_id,))
+    assert status == "completed"
+    assert files_scanned == len(files)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Verify Replica
+--------------
+Confirm that a replicated volume holds the same files as its source.
+
+Each side is a stream of (relative path, size, md5) sorted by the raw bytes
+of the relative path, read either from the registry (a host and a root
+directory; the host's active files rows in index order) or from a scan
+manifest written by the manifest command. The two sorted streams are merged
+like a sort-merge join, so memory use does not grow with the volume and
+neither side needs an index on md5_checksum.
+
+    python verify_replica.py fileserver1:/data/projects backup2:/replica/projects
+    python verify_replica.py manifest /replica/projects replica.ndjson
+    python verify_replica.py fileserver1:/data/projects replica.ndjson
+
+Files only on the first side are reported as missing, files only on the
+second side as extra, and files whose size or MD5 differ as mismatched. The
+exit status is 1 when any difference was found.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+
+import exclusion_rules
+import page_cache
+import registry_paths
+
+FETCH_SIZE = 5000
+
+
+def db_entries(cnx, host_id, root):
+    """Yield (relative path bytes, size, md5 hex) of a host's active files under root, sorted by path."""
+    prefix = registry_paths.path_to_db(os.path.join(root, ""))
+    cursor = cnx.cursor()
+    try:
+        cursor.execute(
+            "SELECT file_path, file_size, md5_checksum FROM files "
+            "WHERE host_id = %s AND file_path LIKE %s AND status = 'active' ORDER BY file_path",
+            (host_id, registry_paths.prefix_pattern(root)))
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for file_path, file_size, md5_digest in rows:
+                yield (bytes(file_path)[len(prefix):], file_size,
+                       bytes(md5_digest).hex() if md5_digest is not None else None)
+    finally:
+        cursor.close()
+
+
+def manifest_entries(manifest_path):
+    """Yield the (relative path bytes, size, md5 hex) records of a manifest."""
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "path" not in record:
+                # Header line
+                continue
+            yield registry_paths.path_to_db(record["path"]), record.get("size"), record.get("md5")
+
+
+def _sorted_walk(top, rules, dirpath=None, rel_dir=b""):
+    """
+    Yield (relative path bytes, path) of the files under top in byte order of
+    the relative paths. Entries of a directory are visited in order of name,
+    or name + '/' for subdirectories, which orders whole relative paths
+    bytewise; only one listing per directory level is held at a time.
+    """
+    dirpath = dirpath or top
+    rel_root = exclusion_rules.relative_path(dirpath, top)
+    rel_root = "" if rel_root == "." else rel_root + "/"
+    entries = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                name = os.fsencode(entry.name)
+                if is_dir:
+                    if not rules.excludes_dir(rel_root + entry.name, entry.name):
+                        entries.append((name + b"/", entry.path, True))
+                elif entry.is_file() and not rules.excludes_file(rel_root + entry.name, entry.name, entry.stat):
+                    entries.append((name, entry.path, False))
+    except OSError as e:
+        print(f"Cannot read {registry_paths.display_path(dirpath)}: {e}", file=sys.stderr)
+        return
+    entries.sort()
+    for key, path, is_dir in entries:
+        if is_dir:
+            yield from _sorted_walk(top, rules, path, rel_dir + key)
+        else:
+            yield rel_dir + key, path
+
+
+def write_manifest(root, output_path, rules=None, cache_mode="dontneed"):
+    """Hash the files under root into a sorted manifest. Returns the number of files."""
+    rules = rules or exclusion_rules.load_rules()
+    count = 0
+    with open(output_path, "w", encoding="utf-8") as out:
+        out.write(json.dumps({"root": root, "host": platform.node()}) + "\n")
+        for rel_path, path in _sorted_walk(root, rules):
+            hash_md5 = hashlib.md5()
+            try:
+                with page_cache.BlockReader(path, cache_mode) as reader:
+                    for block in iter(reader.read, b""):
+                        hash_md5.update(block)
+                    size = reader.offset
+            except OSError as e:
+                print(f"Cannot read {registry_paths.display_path(path)}: {e}", file=sys.stderr)
+                continue
+            out.write(json.dumps({"path": os.fsdecode(rel_path), "size": size,
+                                  "md5": hash_md5.hexdigest()}) + "\n")
+            count += 1
+    return count
+
+
+def compare(source, replica):
+    """
+    Merge two sorted entry streams. Yields (kind, relative path bytes, source
+    entry, replica entry) with kind 'missing', 'extra' or 'mismatch'.
+    """
+    def checked(entries, name):
+        previous = None
+        for entry in entries:
+            if previous is not None and entry[0] <= previous:
+                raise ValueError(f"{name} is not sorted by path at {registry_paths.display_path(entry[0])}")
+            previous = entry[0]
+            yield entry
+
+    source = checked(source, "source")
+    replica = checked(replica, "replica")
+    a = next(source, None)
+    b = next(replica, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield "missing", a[0], a, None
+            a = next(source, None)
+        elif a is None or b[0] < a[0]:
+            yield "extra", b[0], None, b
+            b = next(replica, None)
+        else:
+            same_size = a[1] is None or b[1] is None or a[1] == b[1]
+            same_md5 = a[2] is None or b[2] is None or a[2] == b[2]
+            if not (same_size and same_md5):
+                yield "mismatch", a[0], a, b
+            a = next(source, None)
+            b = next(replica, None)
+
+
+def open_source(spec):
+    """
+    Return (entries, connection or None) for a source spec: an existing
+    manifest file, or HOST:ROOT for a host's files in the registry.
+    """
+    if os.path.isfile(spec):
+        return manifest_entries(spec), None
+    host, sep, root = spec.partition(":")
+    if not sep or not root:
+        raise ValueError(f"{spec} is neither a manifest file nor HOST:ROOT")
+
+    import registry_database
+
+    # Each database side streams on its own connection
+    cnx = registry_database.get_database_connection()
+    if not cnx or not registry_database.is_connection_valid(cnx):
+        raise ConnectionError("Failed to connect to the database or connection timed out.")
+    host_id = registry_database.get_host_id(cnx, host, create=False)
+    if host_id is None:
+        cnx.close()
+        raise ValueError(f"Host {host} is not in the registry.")
+    return db_entries(cnx, host_id, root.rstrip("/") or "/"), cnx
+
+
+def _describe(entry):
+    return f"{entry[1]} bytes, {entry[2] or 'no md5'}"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'manifest':
+        parser = argparse.ArgumentParser(prog='verify_replica.py manifest',
+                                         description='Hash a directory into a sorted scan manifest.')
+        parser.add_argument('root', type=str, help='directory to hash')
+        parser.add_argument('output', type=str, help='manifest file to write')
+        parser.add_argument('--exclusions', type=str, default=None,
+                            help=f'exclusion rules file (default: {exclusion_rules.RULES_FILE})')
+        parser.add_argument('--cache-mode', choices=page_cache.MODES, default='dontneed',
+                            help='page cache use while hashing (default: dontneed)')
+        args = parser.parse_args(sys.argv[2:])
+        count = write_manifest(args.root, args.output, exclusion_rules.load_rules(args.exclusions), args.cache_mode)
+        print(f"Wrote {count} files to {args.output}")
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(
+        description='Compare a replica with its source. Sides are HOST:ROOT in the registry or a manifest file; '
+                    'use "verify_replica.py manifest ROOT OUTPUT" to write a manifest.')
+    parser.add_argument('source', type=str, help='HOST:ROOT or manifest of the original')
+    parser.add_argument('replica', type=str, help='HOST:ROOT or manifest of the replica')
+    parser.add_argument('--summary', action='store_true', help='only print the totals')
+    args = parser.parse_args()
+
+    connections = []
+    counts = {"missing": 0, "extra": 0, "mismatch": 0}
+    try:
+        source, cnx = open_source(args.source)
+        connections.append(cnx)
+        replica, cnx = open_source(args.replica)
+        connections.append(cnx)
+        for kind, rel_path, a, b in compare(source, replica):
+            counts[kind] += 1
+            if args.summary:
+                continue
+            if kind == "mismatch":
+                print(f"mismatch  {registry_paths.display_path(rel_path)}  ({_describe(a)} vs {_describe(b)})")
+            else:
+                print(f"{kind:<8}  {registry_paths.display_path(rel_path)}")
+    except (ValueError, ConnectionError) as e:
+        print(e)
+        sys.exit(2)
+    finally:
+        for cnx in connections:
+            if cnx is not None:
+                cnx.close()
+
+    print(f"{counts['missing']} missing, {counts['extra']} extra, {counts['mismatch']} mismatched")
+    sys.exit(1 if any(counts.values()) else 0)